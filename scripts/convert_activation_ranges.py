@@ -0,0 +1,11 @@
+import argparse
+
+from vdna.utils.io import convert_activation_ranges
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert activation ranges from a JSON file to a faster to load NPZ file.")
+    parser.add_argument("json_path", type=str, help="path to the JSON file with activation ranges")
+    parser.add_argument("npz_path", type=str, nargs="?", default=None, help="path to save the NPZ file to (default: next to the JSON file)")
+
+    args = parser.parse_args()
+    print(f"Saved activation ranges to {convert_activation_ranges(args.json_path, args.npz_path)}")
@@ -1,49 +1,66 @@
 import argparse
 import json
 from pathlib import Path
+
 from vdna import VDNAProcessor
+from vdna.utils.io import save_activation_ranges
+
 
-def save_activation_ranges(args):
+def save_activation_ranges_from_source(args):
     vdna_proc = VDNAProcessor()
 
+    distribution_name = "activation-ranges" if args.quantile == 0 else f"activation-ranges-q{args.quantile:g}"
     vdna = vdna_proc.make_vdna(
         source=args.source,
         feat_extractor_name=args.feat_extractor_name,
-        distribution_name="activation-ranges",
+        distribution_name=distribution_name,
         seed=args.seed,
         batch_size=args.batch_size,
         device=args.device,
         verbose=args.verbose,
         crop_to_square_pre_resize="center",
-        num_workers=4,
+        num_workers=args.num_workers,
     )
 
-    neurons_list = vdna.neurons_list
+    # Copy whole layers at once rather than each neuron value
     mins_per_neuron = {}
     maxs_per_neuron = {}
-    for layer in neurons_list:
-        mins_per_neuron[layer] = {}
-        maxs_per_neuron[layer] = {}
-        for neuron in range(neurons_list[layer]):
-            mins_per_neuron[layer][neuron] = vdna.get_neuron_dist(layer, neuron)["min"].item()
-            maxs_per_neuron[layer][neuron] = vdna.get_neuron_dist(layer, neuron)["max"].item()
-
-    out = {"mins_per_neuron": mins_per_neuron, "maxs_per_neuron": maxs_per_neuron}
+    for layer in vdna.neurons_list:
+        layer_ranges = vdna.get_all_neurons_in_layer_dist(layer)
+        mins_per_neuron[layer] = layer_ranges["min"].reshape(-1).cpu().numpy()
+        maxs_per_neuron[layer] = layer_ranges["max"].reshape(-1).cpu().numpy()
+
     save_dir = Path(args.save_dir)
     save_dir.mkdir(parents=True, exist_ok=True)
-    data = json.dumps(out, indent=4)
-    with open(save_dir / "activation_ranges.json", "w") as f:
-        f.write(data)
+    if args.format == "npz":
+        out = {"mins_per_neuron": mins_per_neuron, "maxs_per_neuron": maxs_per_neuron}
+        save_activation_ranges(save_dir / "activation_ranges.npz", out)
+    else:
+        out = {
+            "mins_per_neuron": {layer: dict(enumerate(mins.tolist())) for layer, mins in mins_per_neuron.items()},
+            "maxs_per_neuron": {layer: dict(enumerate(maxs.tolist())) for layer, maxs in maxs_per_neuron.items()},
+        }
+        with open(save_dir / "activation_ranges.json", "w") as f:
+            f.write(json.dumps(out, indent=4))
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Save activation ranges of a model to a JSON file.")
+    parser = argparse.ArgumentParser(description="Save activation ranges of a model to a JSON or NPZ file.")
     parser.add_argument("source", type=str, help="source to give to VDNAProcessor.make_vdna")
     parser.add_argument("feat_extractor_name", type=str, help="name of the feature extractor to give to VDNAProcessor.make_vdna")
     parser.add_argument("save_dir", type=str, help="directory to save the activation ranges to")
     parser.add_argument("--seed", type=int, default=0, help="random seed to use (default: 0)")
     parser.add_argument("--batch-size", type=int, default=64, help="batch size to use (default: 64)")
+    parser.add_argument("--num-workers", type=int, default=4, help="number of workers loading images (default: 4)")
     parser.add_argument("--device", type=str, default="cuda:0", help="device to use (default: 'cuda:0')")
     parser.add_argument("--verbose", action="store_true", help="whether to print verbose output (default: False)")
+    parser.add_argument(
+        "--quantile",
+        type=float,
+        default=0.0,
+        help="percentile used for robust ranges, e.g. 0.1 keeps ranges between the 0.1th and 99.9th percentiles. Estimated with a streaming sketch. If 0, raw minimums and maximums are used (default: 0)",
+    )
+    parser.add_argument("--format", type=str, default="json", choices=["json", "npz"], help="output format (default: json)")
 
     args = parser.parse_args()
-    save_activation_ranges(args)
+    save_activation_ranges_from_source(args)
@@ -1,5 +1,21 @@
 from .distances import EMD, FD, NFD
-from .vdna_processor import (VDNAProcessor, load_vdna_from_files,
-                             load_vdna_from_hub)
-from .vdnas import VDNA
+from .neuron_selection import NeuronSelection
+from .vdnas import VDNA, merge_vdnas
 from .version import __version__
+
+# The processor pulls in the feature extraction code, so it is only imported when first used
+_LAZY_ATTRIBUTES = {"VDNAProcessor", "load_vdna_from_files", "load_vdna_from_hub"}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from . import vdna_processor
+
+    value = getattr(vdna_processor, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -0,0 +1,63 @@
+"""
+Measure the time taken to import vdna in a fresh interpreter, and check which heavy modules get imported.
+
+Usage:
+    python -m vdna.benchmarks.import_time [--repeats 5] [--statement "import vdna"]
+"""
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+# Modules which should only be imported when extracting features or saving images
+HEAVY_MODULES = [
+    "torchvision",
+    "scipy",
+    "huggingface_hub",
+    "vdna.networks.clip",
+    "vdna.networks.dino_resnet50",
+    "vdna.networks.dino_vit",
+    "vdna.networks.inception_pytorch",
+    "vdna.networks.mugs_vit",
+    "vdna.networks.random_resnet50",
+    "vdna.networks.vgg16",
+    "vdna.networks.cityscapes_resnet101",
+]
+
+DEFAULT_STATEMENT = "import vdna; from vdna import EMD, load_vdna_from_files"
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time_s": elapsed, "imported": [m for m in {heavy_modules!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(statement: str = DEFAULT_STATEMENT, heavy_modules: List[str] = HEAVY_MODULES) -> Dict:
+    script = _SCRIPT.format(statement=statement, heavy_modules=list(heavy_modules))
+    out = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--statement", type=str, default=DEFAULT_STATEMENT)
+    args = parser.parse_args()
+
+    results = [measure_import(args.statement) for _ in range(args.repeats)]
+    times = sorted(r["time_s"] for r in results)
+    report = {
+        "statement": args.statement,
+        "min_s": times[0],
+        "median_s": times[len(times) // 2],
+        "heavy_modules_imported": results[0]["imported"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Compare the speed of feature extraction modes, and how far the VDNAs they give drift from float32 ones.
+
+Each mode is a precision ("fp32", "bf16", or "int8" for the quantized variant of the feature extractor), optionally
+followed by "+channels_last". VDNAs made with each mode are compared to VDNAs made in fp32 with the contiguous memory
+format, using the EMD for histograms and quantiles and the NFD for Gaussians.
+
+Usage:
+    python -m vdna.benchmarks.precision_parity /path/to/images --feat-extractors vgg16 dino_resnet50 \
+        --modes fp32+channels_last bf16 bf16+channels_last int8 --device cpu --num-threads 16
+"""
+import argparse
+import copy
+import json
+import time
+from typing import Dict, List
+
+import torch
+
+from .. import EMD, NFD, VDNAProcessor
+from ..networks.registry import QUANTIZED_SUFFIX
+
+REFERENCE_MODE = "fp32"
+
+
+def parse_mode(mode: str) -> Dict[str, str]:
+    parts = mode.split("+")
+    assert parts[0] in ["fp32", "bf16", "int8"], f"Unknown precision in mode {mode}"
+    assert all(part == "channels_last" for part in parts[1:]), f"Unknown memory format in mode {mode}"
+    return {
+        "precision": "bf16" if parts[0] == "bf16" else "fp32",
+        "memory_format": "channels_last" if len(parts) > 1 else "contiguous",
+    }
+
+
+def get_drift(vdna, reference_vdna) -> Dict[str, float]:
+    if vdna.feature_extractor_name != reference_vdna.feature_extractor_name:
+        # Quantized variants are compared to the network they quantize
+        vdna = copy.copy(vdna)
+        vdna.feature_extractor_name = reference_vdna.feature_extractor_name
+    distance_fn = NFD if vdna.type in ["gaussian", "layer-gaussian"] else EMD
+    per_neuron = distance_fn(vdna, reference_vdna, return_neuron_wise=True)
+    per_neuron = torch.cat([per_neuron[layer].reshape(-1) for layer in per_neuron])
+    return {
+        "distance": distance_fn.__name__,
+        "mean_drift": float(per_neuron.mean()),
+        "max_neuron_drift": float(per_neuron.max()),
+    }
+
+
+def run_parity(
+    source: str,
+    feat_extractors: List[str],
+    modes: List[str],
+    distribution_name: str = "histogram-1000",
+    num_images: int = -1,
+    **make_vdna_kwargs,
+) -> List[Dict]:
+    vdna_proc = VDNAProcessor(max_cached_models=2)
+    results = []
+    for feat_extractor_name in feat_extractors:
+        reference_vdna = None
+        for mode in [REFERENCE_MODE] + [mode for mode in modes if mode != REFERENCE_MODE]:
+            mode_kwargs = dict(make_vdna_kwargs, **parse_mode(mode))
+            mode_feat_extractor_name = feat_extractor_name + (QUANTIZED_SUFFIX if mode.startswith("int8") else "")
+            kwargs = dict(
+                feat_extractor_name=mode_feat_extractor_name,
+                distribution_name=distribution_name,
+                verbose=False,
+                **mode_kwargs,
+            )
+            # Build the network and run a first batch untimed, so that timings do not include building or compilation
+            vdna_proc.make_vdna(source=source, num_images=mode_kwargs.get("batch_size", 64), **kwargs)
+
+            start = time.perf_counter()
+            vdna = vdna_proc.make_vdna(source=source, num_images=num_images, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            result = {
+                "feat_extractor": feat_extractor_name,
+                "mode": mode,
+                "time_s": elapsed,
+                "images_per_s": vdna.num_images / elapsed,
+            }
+            if reference_vdna is None:
+                reference_vdna = vdna
+            else:
+                result.update(get_drift(vdna, reference_vdna))
+            results.append(result)
+        vdna_proc.evict()
+    vdna_proc.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", type=str, help="source of images to give to VDNAProcessor.make_vdna")
+    parser.add_argument("--feat-extractors", type=str, nargs="+", default=["mugs_vit_base"])
+    parser.add_argument("--modes", type=str, nargs="+", default=["fp32+channels_last", "bf16", "bf16+channels_last"])
+    parser.add_argument("--distribution", type=str, default="histogram-1000")
+    parser.add_argument("--num-images", type=int, default=-1)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--num-threads", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--calibration-source",
+        type=str,
+        default=None,
+        help="images calibrating int8 convolutional networks (default: the source)",
+    )
+    parser.add_argument("--output", type=str, default=None, help="path to save the report as JSON")
+    args = parser.parse_args()
+
+    results = run_parity(
+        args.source,
+        args.feat_extractors,
+        args.modes,
+        distribution_name=args.distribution,
+        num_images=args.num_images,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        num_threads=args.num_threads,
+        device=args.device,
+        calibration_source=args.calibration_source if args.calibration_source is not None else args.source,
+    )
+    for result in results:
+        drift = "reference"
+        if "distance" in result:
+            drift = f"{result['distance']} drift {result['mean_drift']:.3g} (max {result['max_neuron_drift']:.3g})"
+        print(f"{result['feat_extractor']:<24} {result['mode']:<20} {result['images_per_s']:8.1f} images/s  {drift}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
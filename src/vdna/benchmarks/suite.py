@@ -0,0 +1,393 @@
+"""
+Benchmark feature extraction, histogramming, distances and saving/loading of VDNAs, offline.
+
+Feature extractors are randomly initialised (pretrained=False) and images are synthetic, so nothing is downloaded and
+results can be compared between versions and machines. Sections are:
+    extraction: images per second of make_vdna for each feature extractor and distribution
+    histogram: throughput of binning features of a batch into histograms, for each layer shape
+    distances: latency of EMD, NFD and FD over all neurons, one layer, one neuron, neuron-wise, and a neuron selection
+    io: save and load times and file sizes of VDNAs, for each distribution and histogram storage format
+
+Results are printed and optionally saved as JSON along with the versions and host they were measured on.
+
+Usage:
+    python -m vdna.benchmarks.suite --sections extraction histogram distances io --device cpu --output bench.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+
+from .. import EMD, FD, NFD, NeuronSelection, VDNAProcessor, load_vdna_from_files
+from ..networks.autotune import get_host_key
+from ..networks.registry import get_extractor_spec
+from ..utils.stats import StreamingQuantiles, get_hist_bin_params, histogram_per_channel_from_bin_params
+from ..vdnas import VDNA, get_vdna
+from ..version import __version__
+
+SECTIONS = ["extraction", "histogram", "distances", "io"]
+DEFAULT_FEAT_EXTRACTORS = ["vgg16", "inception", "dino_resnet50", "mugs_vit_base"]
+DEFAULT_DISTRIBUTIONS = ["histogram-1000", "gaussian", "quantiles-256"]
+# Shapes of the features of one image at typical layers of convolutional networks and vision transformers, as C,H,W
+DEFAULT_HIST_SHAPES = ["64,112,112", "256,56,56", "512,28,28", "2048,7,7", "768,197,1"]
+# Distances and the distributions they are benchmarked on
+DISTANCE_DISTRIBUTIONS = [
+    ("EMD", "histogram-1000"),
+    ("EMD", "quantiles-256"),
+    ("NFD", "gaussian"),
+    ("FD", "layer-gaussian"),
+]
+DISTANCE_MODES = ["all", "layer", "neuron", "neuron_wise", "selection"]
+HIST_STORAGE_FORMATS = [(dtype, sparse) for dtype in ["auto", "uint32", "int64", "float16"] for sparse in [False, True]]
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_call(fn: Callable, repeats: int = 5, device="cpu") -> Dict[str, float]:
+    """Time fn after a first untimed call, returning the median and minimum times in ms."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        _synchronize(device)
+        start = time.perf_counter()
+        fn()
+        _synchronize(device)
+        times.append(1000 * (time.perf_counter() - start))
+    return {"median_ms": statistics.median(times), "min_ms": min(times)}
+
+
+def write_synthetic_images(directory: Path, num_images: int, size: int = 256, seed: int = 0) -> Path:
+    from PIL import Image
+
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(num_images):
+        # Smooth noise compresses like natural images more than white noise does
+        low_res = rng.integers(0, 256, (size // 8, size // 8, 3), dtype=np.uint8)
+        Image.fromarray(low_res).resize((size, size), Image.BILINEAR).save(directory / f"{i:05d}.jpg", quality=90)
+    return directory
+
+
+def make_synthetic_vdna(
+    distribution_name: str, feat_extractor_name: str, num_samples: int = 256, device="cpu", seed: int = 0
+) -> VDNA:
+    """Make a VDNA of a distribution for the layers of a feature extractor, from random features instead of images."""
+    vdna = get_vdna(distribution_name)
+    neurons_per_layer = get_extractor_spec(feat_extractor_name).network_settings.neurons_per_layer
+    generator = torch.Generator().manual_seed(seed)
+    features_dict = {}
+    for layer, n_neurons in neurons_per_layer.items():
+        # Heavy tailed features, as activations usually are
+        feats = torch.randn(num_samples, n_neurons, 2, 2, generator=generator) ** 3
+        if vdna.type == "histogram":
+            norm_mean, norm_std = torch.zeros(1, n_neurons, 1, 1), torch.full((1, n_neurons, 1, 1), 3.0)
+            scale, offset = get_hist_bin_params(norm_mean, norm_std, vdna.hist_nb_bins, [-1, 1], feats.dtype)
+            features_dict[layer] = histogram_per_channel_from_bin_params(feats, scale, offset, vdna.hist_nb_bins)
+        elif vdna.type == "quantiles":
+            features_dict[layer] = StreamingQuantiles()
+            features_dict[layer].update(feats)
+        else:
+            features_dict[layer] = feats.mean(dim=(2, 3), keepdim=True)
+    vdna._fit_distribution(features_dict)
+    vdna.feature_extractor_name = feat_extractor_name
+    vdna.neurons_list = dict(neurons_per_layer)
+    vdna.num_images = num_samples
+    if device != "cpu":
+        vdna.data = {layer: _to_device(data, device) for layer, data in vdna.data.items()}
+        vdna.device = str(device)
+    return vdna
+
+
+def _to_device(data, device):
+    if isinstance(data, dict):
+        return {key: value.to(device) for key, value in data.items()}
+    return data.to(device)
+
+
+def bench_extraction(
+    feat_extractors: List[str],
+    distributions: List[str],
+    num_images: int = 128,
+    batch_size: int = 32,
+    device: str = "cpu",
+    num_workers: int = 4,
+    image_dir: Optional[Path] = None,
+) -> List[Dict]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if image_dir is None:
+            image_dir = write_synthetic_images(Path(tmp_dir) / "images", num_images)
+        vdna_proc = VDNAProcessor(max_cached_models=1)
+        results = []
+        for feat_extractor_name in feat_extractors:
+            for distribution_name in distributions:
+                kwargs = dict(
+                    feat_extractor_name=feat_extractor_name,
+                    distribution_name=distribution_name,
+                    batch_size=batch_size,
+                    device=device,
+                    num_workers=num_workers,
+                    pretrained=False,
+                    verbose=False,
+                )
+                # Build the network and run a first batch untimed, so that timings do not include building it
+                vdna_proc.make_vdna(source=str(image_dir), num_images=batch_size, **kwargs)
+                _synchronize(device)
+                start = time.perf_counter()
+                vdna = vdna_proc.make_vdna(source=str(image_dir), num_images=num_images, **kwargs)
+                _synchronize(device)
+                elapsed = time.perf_counter() - start
+                results.append(
+                    {
+                        "feat_extractor": feat_extractor_name,
+                        "distribution": distribution_name,
+                        "num_images": vdna.num_images,
+                        "batch_size": batch_size,
+                        "time_s": elapsed,
+                        "images_per_s": vdna.num_images / elapsed,
+                    }
+                )
+            vdna_proc.evict()
+        vdna_proc.close()
+    return results
+
+
+def bench_histograms(
+    shapes: List[str], batch_size: int = 32, hist_nb_bins: int = 1000, device: str = "cpu", repeats: int = 5
+) -> List[Dict]:
+    results = []
+    for shape in shapes:
+        n_channels, height, width = (int(size) for size in shape.split(","))
+        feats = torch.randn(batch_size, n_channels, height, width, device=device)
+        scale, offset = get_hist_bin_params(
+            torch.zeros(1, n_channels, 1, 1, device=device),
+            torch.ones(1, n_channels, 1, 1, device=device),
+            hist_nb_bins,
+            [-1, 1],
+            feats.dtype,
+        )
+        timing = time_call(
+            lambda: histogram_per_channel_from_bin_params(feats, scale, offset, hist_nb_bins), repeats, device
+        )
+        results.append(
+            dict(
+                {"shape": [batch_size, n_channels, height, width], "hist_nb_bins": hist_nb_bins},
+                **timing,
+                images_per_s=1000 * batch_size / timing["median_ms"],
+                values_per_s=1000 * feats.numel() / timing["median_ms"],
+            )
+        )
+        del feats
+    return results
+
+
+def bench_distances(feat_extractor_name: str, device: str = "cpu", repeats: int = 5) -> List[Dict]:
+    distance_fns = {"EMD": EMD, "NFD": NFD, "FD": FD}
+    neurons_per_layer = get_extractor_spec(feat_extractor_name).network_settings.neurons_per_layer
+    layer = list(neurons_per_layer)[-1]
+    # A quarter of the neurons of every layer
+    selection = NeuronSelection({name: range(0, n_neurons, 4) for name, n_neurons in neurons_per_layer.items()})
+    mode_kwargs = {
+        "all": {},
+        "layer": {"use_neurons_from_layer": layer},
+        "neuron": {"use_neurons_from_layer": layer, "use_neuron_index": 0},
+        "neuron_wise": {"return_neuron_wise": True},
+        "selection": {"neuron_selection": selection},
+    }
+    results = []
+    for distance_name, distribution_name in DISTANCE_DISTRIBUTIONS:
+        vdna1 = make_synthetic_vdna(distribution_name, feat_extractor_name, device=device, seed=0)
+        vdna2 = make_synthetic_vdna(distribution_name, feat_extractor_name, device=device, seed=1)
+        for mode in DISTANCE_MODES:
+            distance_fn = distance_fns[distance_name]
+            timing = time_call(lambda: distance_fn(vdna1, vdna2, **mode_kwargs[mode]), repeats, device)
+            results.append(
+                dict(
+                    {
+                        "distance": distance_name,
+                        "distribution": distribution_name,
+                        "feat_extractor": feat_extractor_name,
+                        "mode": mode,
+                    },
+                    **timing,
+                )
+            )
+    return results
+
+
+def _get_io_formats() -> List[Dict]:
+    formats = [
+        {"distribution": "histogram-1000", "storage_dtype": dtype, "sparse_storage": sparse}
+        for dtype, sparse in HIST_STORAGE_FORMATS
+    ]
+    formats += [{"distribution": name} for name in ["gaussian", "layer-gaussian", "quantiles-256"]]
+    return formats
+
+
+def bench_io(feat_extractor_name: str, repeats: int = 5) -> List[Dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for io_format in _get_io_formats():
+            vdna = make_synthetic_vdna(io_format["distribution"], feat_extractor_name)
+            if "storage_dtype" in io_format:
+                vdna.storage_dtype = io_format["storage_dtype"]
+                vdna.sparse_storage = io_format["sparse_storage"]
+            file_path = Path(tmp_dir) / "vdna"
+            save_timing = time_call(lambda: vdna.save(file_path), repeats)
+            load_timing = time_call(lambda: load_vdna_from_files(file_path), repeats)
+            results.append(
+                dict(
+                    io_format,
+                    feat_extractor=feat_extractor_name,
+                    save_median_ms=save_timing["median_ms"],
+                    load_median_ms=load_timing["median_ms"],
+                    file_bytes=sum(path.stat().st_size for path in Path(tmp_dir).glob("vdna.*")),
+                )
+            )
+    return results
+
+
+def get_environment(device: str = "cpu") -> Dict:
+    return {
+        "vdna_version": __version__,
+        "torch_version": torch.__version__,
+        "python_version": platform.python_version(),
+        "host": get_host_key(device),
+        "device": device,
+        "num_threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run_suite(
+    sections: List[str] = SECTIONS,
+    feat_extractors: List[str] = DEFAULT_FEAT_EXTRACTORS,
+    distributions: List[str] = DEFAULT_DISTRIBUTIONS,
+    hist_shapes: List[str] = DEFAULT_HIST_SHAPES,
+    distance_feat_extractor: str = "mugs_vit_base",
+    num_images: int = 128,
+    batch_size: int = 32,
+    device: str = "cpu",
+    num_workers: int = 4,
+    repeats: int = 5,
+    image_dir: Optional[str] = None,
+) -> Dict:
+    """
+    Run benchmark sections, returning a dict with the environment they ran in and a list of results per section.
+
+    Args:
+        sections (List[str]): Sections to run, among "extraction", "histogram", "distances" and "io".
+        feat_extractors (List[str]): Feature extractors of the extraction section.
+        distributions (List[str]): Distributions of the extraction section.
+        hist_shapes (List[str]): Shapes of the features of one image in the histogram section, as "C,H,W".
+        distance_feat_extractor (str): Feature extractor whose layers VDNAs of the distances and io sections have.
+        num_images (int): Number of images of the extraction section.
+        batch_size (int): Batch size of the extraction and histogram sections.
+        device (str): Device to run on.
+        num_workers (int): Number of dataloader workers of the extraction section.
+        repeats (int): Number of timed repeats in the histogram, distances and io sections.
+        image_dir (str or None): Images of the extraction section. If None, synthetic JPEG images are written to a
+            temporary directory.
+    """
+    for section in sections:
+        assert section in SECTIONS, f"Unknown benchmark section {section}, choose from {SECTIONS}"
+    report = {"environment": get_environment(device)}
+    if "extraction" in sections:
+        report["extraction"] = bench_extraction(
+            feat_extractors,
+            distributions,
+            num_images=num_images,
+            batch_size=batch_size,
+            device=device,
+            num_workers=num_workers,
+            image_dir=Path(image_dir) if image_dir is not None else None,
+        )
+    if "histogram" in sections:
+        report["histogram"] = bench_histograms(hist_shapes, batch_size=batch_size, device=device, repeats=repeats)
+    if "distances" in sections:
+        report["distances"] = bench_distances(distance_feat_extractor, device=device, repeats=repeats)
+    if "io" in sections:
+        report["io"] = bench_io(distance_feat_extractor, repeats=repeats)
+    return report
+
+
+def format_report(report: Dict) -> str:
+    lines = []
+    for result in report.get("extraction", []):
+        lines.append(
+            f"extraction {result['feat_extractor']:<20} {result['distribution']:<16} "
+            f"{result['images_per_s']:8.1f} images/s"
+        )
+    for result in report.get("histogram", []):
+        shape = "x".join(str(size) for size in result["shape"])
+        lines.append(
+            f"histogram  {shape:<20} {result['median_ms']:8.2f} ms  {result['values_per_s'] / 1e6:8.1f} M values/s"
+        )
+    for result in report.get("distances", []):
+        lines.append(
+            f"distance   {result['distance']:<4} {result['distribution']:<16} {result['mode']:<12} "
+            f"{result['median_ms']:8.2f} ms"
+        )
+    for result in report.get("io", []):
+        io_format = result["distribution"]
+        if "storage_dtype" in result:
+            io_format += f" {result['storage_dtype']} {'sparse' if result['sparse_storage'] else 'dense'}"
+        lines.append(
+            f"io         {io_format:<30} save {result['save_median_ms']:8.1f} ms  "
+            f"load {result['load_median_ms']:8.1f} ms  {result['file_bytes'] / 2**20:8.2f} MB"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=str, nargs="+", default=SECTIONS, choices=SECTIONS)
+    parser.add_argument("--feat-extractors", type=str, nargs="+", default=DEFAULT_FEAT_EXTRACTORS)
+    parser.add_argument("--distributions", type=str, nargs="+", default=DEFAULT_DISTRIBUTIONS)
+    parser.add_argument("--hist-shapes", type=str, nargs="+", default=DEFAULT_HIST_SHAPES, help="shapes as C,H,W")
+    parser.add_argument("--distance-feat-extractor", type=str, default="mugs_vit_base")
+    parser.add_argument("--num-images", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--num-threads", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--image-dir", type=str, default=None, help="images to extract (default: synthetic images)")
+    parser.add_argument("--output", type=str, default=None, help="path to save the report as JSON")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    report = run_suite(
+        sections=args.sections,
+        feat_extractors=args.feat_extractors,
+        distributions=args.distributions,
+        hist_shapes=args.hist_shapes,
+        distance_feat_extractor=args.distance_feat_extractor,
+        num_images=args.num_images,
+        batch_size=args.batch_size,
+        device=args.device,
+        num_workers=args.num_workers,
+        repeats=args.repeats,
+        image_dir=args.image_dir,
+    )
+    report["environment"]["argv"] = sys.argv[1:] if argv is None else list(argv)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import List, Optional
+
+from .utils.settings import ExtractionSettings
+
+# Commands building, comparing and inspecting VDNAs print their results as JSON on stdout, and progress on stderr
+
+
+def prefetch(args):
+    from .networks import QUANTIZED_SUFFIX, list_feature_extractors, prefetch_feature_extractor
+    from .utils.cache import get_cache_dir, load_manifest, verify_artifacts
+
+    # Quantized variants use the same files as the network they quantize
+    names = (
+        [name for name in list_feature_extractors() if not name.endswith(QUANTIZED_SUFFIX)]
+        if args.all
+        else args.feat_extractors
+    )
+    for name in names:
+        print(f"Prefetching files for {name}")
+        prefetch_feature_extractor(name, ExtractionSettings(device="cpu", hub_repo=args.hub_repo))
+    print(f"{len(load_manifest())} files cached in {get_cache_dir()}")
+
+    if args.verify:
+        invalid_keys = verify_artifacts()
+        for key in invalid_keys:
+            print(f"Checksum mismatch or missing file: {key}")
+        if len(invalid_keys) > 0:
+            return 1
+    return 0
+
+
+def print_json(result):
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+def is_vdna_saved(path: Path) -> bool:
+    # The metadata of a VDNA is moved in place last when saved by save_vdna_atomically
+    return path.with_suffix(".json").is_file() and path.with_suffix(".npz").is_file()
+
+
+def save_vdna_atomically(vdna, path: Path, extra_metadata: Optional[dict] = None):
+    # Files are written to a temporary directory then moved, so that interrupted jobs never leave partial VDNAs
+    tmp_dir = path.parent / f".tmp-{path.name}-{os.getpid()}"
+    vdna.save(tmp_dir / path.name)
+    if extra_metadata:
+        metadata_path = (tmp_dir / path.name).with_suffix(".json")
+        metadata = json.load(open(metadata_path))
+        metadata.update(extra_metadata)
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f, indent=4)
+    for suffix in [".npz", ".json"]:
+        os.replace((tmp_dir / path.name).with_suffix(suffix), path.with_suffix(suffix))
+    shutil.rmtree(tmp_dir)
+
+
+def get_files_hash(files: List) -> str:
+    # Saved with each shard, so that shards made from other files are not reused when resuming
+    return hashlib.sha256("\n".join(str(file) for file in files).encode()).hexdigest()
+
+
+def get_make_kwargs(args) -> dict:
+    return dict(
+        feat_extractor_name=args.feat_extractor,
+        distribution_name=args.distribution,
+        seed=args.seed,
+        batch_size=args.batch_size,
+        device=args.device,
+        verbose=args.verbose,
+        num_workers=args.num_workers,
+        crop_to_square_pre_resize=args.crop_to_square_pre_resize,
+        precision=args.precision,
+        memory_format=args.memory_format,
+        backend=args.backend,
+        pretrained=not args.random_init,
+    )
+
+
+def make(args):
+    from .networks.feature_extraction_model import get_files_list
+    from .utils.settings import DataSettings
+    from .vdna_processor import VDNAProcessor, load_vdna_from_files
+    from .vdnas import merge_vdnas
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    processor = VDNAProcessor(max_cached_models=1)
+    make_kwargs = get_make_kwargs(args)
+    sharded = args.shard_size > 0 or args.num_shards > 1
+    if not sharded:
+        with redirect_stdout(sys.stderr):
+            vdna = processor.make_vdna(
+                args.source, num_images=args.num_images, shuffle_files=args.shuffle_files, **make_kwargs
+            )
+        save_vdna_atomically(vdna, output)
+        print_json({"output": str(output), "num_images": vdna.num_images, "name": vdna.name})
+        return 0
+
+    if args.source.endswith(".zip"):
+        raise ValueError("Zip files cannot be split in shards, extract them first")
+    files = get_files_list(
+        DataSettings(source=args.source, num_images=args.num_images, shuffle_files=args.shuffle_files), args.seed
+    )
+    if args.num_shards > 1:
+        # Only one shard is made, e.g. by one job of an array of cluster jobs. Shards are merged with vdna merge.
+        if not 0 <= args.shard_index < args.num_shards:
+            raise ValueError(f"Shard index {args.shard_index} is not in [0, {args.num_shards})")
+        # Shard sizes differ by at most one image, so that every shard has images if there are enough of them
+        start = len(files) * args.shard_index // args.num_shards
+        end = len(files) * (args.shard_index + 1) // args.num_shards
+        shards = [(output, files[start:end])]
+    else:
+        # Shards are saved next to the output, so that an interrupted job resumes from the first shard not saved
+        shards_dir = output.parent / f"{output.name}_shards"
+        shards_dir.mkdir(exist_ok=True)
+        shards = [
+            (shards_dir / f"shard-{i // args.shard_size:05d}", files[i : i + args.shard_size])
+            for i in range(0, len(files), args.shard_size)
+        ]
+
+    shard_results = []
+    for shard_path, shard_files in shards:
+        if len(shard_files) == 0:
+            raise ValueError(f"Shard {shard_path} has no images, use fewer shards")
+        files_hash = get_files_hash(shard_files)
+        if is_vdna_saved(shard_path) and not args.overwrite:
+            metadata = json.load(open(shard_path.with_suffix(".json")))
+            if metadata.get("files_hash") != files_hash:
+                raise ValueError(
+                    f"Shard {shard_path} was made from other images than the {len(shard_files)} images of this shard, "
+                    "remove it or use --overwrite"
+                )
+            shard_results.append({"path": str(shard_path), "num_images": metadata["num_images"], "status": "skipped"})
+            continue
+        with redirect_stdout(sys.stderr):
+            vdna = processor.make_vdna(shard_files, **make_kwargs)
+        vdna.data_settings_used.source = args.source
+        save_vdna_atomically(vdna, shard_path, extra_metadata={"files_hash": files_hash})
+        shard_results.append({"path": str(shard_path), "num_images": vdna.num_images, "status": "made"})
+        print(f"Saved {shard_path} ({len(shard_results)}/{len(shards)} shards)", file=sys.stderr)
+
+    result = {"output": str(output), "num_images": sum(shard["num_images"] for shard in shard_results)}
+    if args.num_shards <= 1:
+        vdna = merge_vdnas([load_vdna_from_files(shard_path) for shard_path, _ in shards])
+        vdna.data_settings_used.source = args.source
+        save_vdna_atomically(vdna, output)
+        result["num_images"] = vdna.num_images
+        result["name"] = vdna.name
+    result["shards"] = shard_results
+    print_json(result)
+    return 0
+
+
+def merge(args):
+    from .vdna_processor import load_vdna_from_files
+    from .vdnas import merge_vdnas
+
+    # Paths of either file of a VDNA are accepted, so that shell globs such as shard-* can be used
+    inputs = [
+        str(Path(path).with_suffix("")) if Path(path).suffix in [".json", ".npz"] else path for path in args.inputs
+    ]
+    inputs = list(dict.fromkeys(inputs))
+    vdna = merge_vdnas([load_vdna_from_files(path, device=args.device) for path in inputs])
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    save_vdna_atomically(vdna, output)
+    print_json({"output": str(output), "num_images": vdna.num_images, "name": vdna.name, "inputs": inputs})
+    return 0
+
+
+def to_json_value(value):
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return value
+
+
+def compare(args):
+    from .distances import DEFAULT_DISTANCES, DISTANCES
+    from .neuron_selection import NeuronSelection
+    from .vdna_processor import load_vdna_from_files
+
+    vdnas = {path: load_vdna_from_files(path, device=args.device) for path in args.vdnas + (args.against or [])}
+    rows = args.vdnas
+    columns = args.against if args.against else args.vdnas
+    distance = args.distance if args.distance is not None else DEFAULT_DISTANCES[vdnas[rows[0]].type]
+    distance_fn = DISTANCES[distance]
+    neuron_selection = None
+    if args.selection is not None:
+        neuron_selection = NeuronSelection(json.load(open(args.selection)))
+
+    matrix = []
+    for row in rows:
+        matrix_row = []
+        for column in columns:
+            if row == column and not args.neuron_wise:
+                matrix_row.append(0.0)
+                continue
+            value = distance_fn(
+                vdnas[row],
+                vdnas[column],
+                use_neurons_from_layer=args.layer,
+                use_neuron_index=args.neuron,
+                return_neuron_wise=args.neuron_wise,
+                neuron_selection=neuron_selection,
+            )
+            matrix_row.append(to_json_value(value) if args.neuron_wise else float(value))
+        matrix.append(matrix_row)
+    print_json(
+        {
+            "distance": distance,
+            "layer": args.layer,
+            "neuron": args.neuron,
+            "selection": args.selection,
+            "rows": rows,
+            "columns": columns,
+            "matrix": matrix,
+        }
+    )
+    return 0
+
+
+def convert(args):
+    from .vdna_processor import load_vdna_from_files
+    from .vdnas.vdna_hist import HIST_STORAGE_DTYPES
+
+    if args.storage_dtype not in HIST_STORAGE_DTYPES:
+        raise ValueError(f"Storage dtype must be one of {HIST_STORAGE_DTYPES}")
+    vdna = load_vdna_from_files(args.input)
+    if vdna.type == "histogram":
+        vdna.storage_dtype = args.storage_dtype
+        vdna.sparse_storage = {"auto": None, "sparse": True, "dense": False}[args.storage]
+    elif args.storage_dtype != "auto" or args.storage != "auto":
+        raise ValueError(f"Storage options only apply to histograms, {args.input} uses {vdna.name}")
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    save_vdna_atomically(vdna, output)
+
+    result = {"input": args.input, "output": str(output)}
+    if vdna.type == "histogram":
+        result["storage_dtype"], result["sparse_storage"] = vdna.get_storage_format()
+    result["bytes"] = {
+        "input": sum(Path(args.input).with_suffix(suffix).stat().st_size for suffix in [".json", ".npz"]),
+        "output": sum(output.with_suffix(suffix).stat().st_size for suffix in [".json", ".npz"]),
+    }
+    print_json(result)
+    return 0
+
+
+def inspect(args):
+    # Only metadata is read, so that large VDNAs are inspected instantly
+    results = []
+    for path in args.vdnas:
+        metadata = json.load(open(Path(path).with_suffix(".json")))
+        result = {
+            "path": path,
+            "name": metadata["name"],
+            "type": metadata["type"],
+            "feature_extractor": metadata["feature_extractor_name"],
+            "num_images": metadata["num_images"],
+            "num_neurons": sum(metadata["neurons_list"].values()),
+            "layers": metadata["neurons_list"],
+            "distribution": metadata["distribution"],
+            "vdna_version": metadata.get("vdna_version"),
+            "time_of_compute": metadata.get("time_of_compute"),
+            "npz_bytes": Path(path).with_suffix(".npz").stat().st_size,
+        }
+        if args.settings:
+            result["extraction_settings"] = metadata["extraction_settings"]
+            result["data_settings"] = metadata["data_settings"]
+        results.append(result)
+    print_json(results)
+    return 0
+
+
+def bench(args):
+    from .benchmarks.suite import main as run_benchmarks
+
+    run_benchmarks(args.suite_args + ["--json"])
+    return 0
+
+
+def serve(args):
+    from .service import run_service
+
+    # References are named after their files, unless given as name=path
+    references = {}
+    for reference in args.references:
+        name, _, path = reference.rpartition("=")
+        references[name or Path(path).name] = path
+    run_service(
+        references,
+        host=args.host,
+        port=args.port,
+        unix_socket=args.unix_socket,
+        max_body_size=int(args.max_body_mb * 2**20),
+        device=args.device,
+        batch_size=args.batch_size,
+        max_wait_ms=args.max_wait_ms,
+        distance=args.distance,
+        precision=args.precision,
+    )
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vdna", description="Visual DNA command line tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        help="Download and cache the files needed by feature extractors, so that they can be built offline.",
+    )
+    prefetch_parser.add_argument("feat_extractors", nargs="*", help="Names of the feature extractors.")
+    prefetch_parser.add_argument("--all", action="store_true", help="Prefetch all registered feature extractors.")
+    prefetch_parser.add_argument("--hub-repo", default=ExtractionSettings.hub_repo)
+    prefetch_parser.add_argument("--verify", action="store_true", help="Check the checksums of all cached files.")
+    prefetch_parser.set_defaults(func=prefetch)
+
+    make_parser = subparsers.add_parser(
+        "make",
+        help="Make a VDNA from images, optionally in shards which are saved as they are made and merged at the end.",
+    )
+    make_parser.add_argument("source", help="Directory, image, or .txt file with the paths of images.")
+    make_parser.add_argument("output", help="Path to save the VDNA to, without extensions.")
+    make_parser.add_argument("--feat-extractor", default="mugs_vit_base")
+    make_parser.add_argument("--distribution", default="histogram-1000")
+    make_parser.add_argument("--num-images", type=int, default=-1)
+    make_parser.add_argument("--shuffle-files", action="store_true")
+    make_parser.add_argument("--seed", type=int, default=0)
+    make_parser.add_argument("--device", default="cuda:0")
+    make_parser.add_argument("--batch-size", type=int, default=64)
+    make_parser.add_argument("--num-workers", type=int, default=12)
+    make_parser.add_argument("--crop-to-square-pre-resize", default="none", choices=["none", "center", "random"])
+    make_parser.add_argument("--precision", default=ExtractionSettings.precision)
+    make_parser.add_argument("--memory-format", default=ExtractionSettings.memory_format)
+    make_parser.add_argument("--backend", default=ExtractionSettings.backend)
+    make_parser.add_argument(
+        "--random-init", action="store_true", help="Use a randomly initialised feature extractor, for tests."
+    )
+    make_parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="Make the VDNA in shards of this many images, saved in OUTPUT_shards. Shards already saved are skipped, "
+        "so that interrupted jobs resume where they stopped.",
+    )
+    make_parser.add_argument(
+        "--num-shards", type=int, default=1, help="Only make shard --shard-index of this many shards, saved to OUTPUT."
+    )
+    make_parser.add_argument("--shard-index", type=int, default=0)
+    make_parser.add_argument("--overwrite", action="store_true", help="Make shards again even if they are saved.")
+    make_parser.add_argument("--verbose", action="store_true", help="Print progress on stderr.")
+    make_parser.set_defaults(func=make)
+
+    merge_parser = subparsers.add_parser("merge", help="Merge VDNAs of different images into the VDNA of all images.")
+    merge_parser.add_argument("inputs", nargs="+", help="Paths to VDNAs, without extensions.")
+    merge_parser.add_argument("--output", "-o", required=True)
+    merge_parser.add_argument("--device", default="cpu")
+    merge_parser.set_defaults(func=merge)
+
+    compare_parser = subparsers.add_parser("compare", help="Compute the matrix of distances between VDNAs.")
+    compare_parser.add_argument("vdnas", nargs="+", help="Paths to VDNAs, without extensions.")
+    compare_parser.add_argument(
+        "--against", nargs="+", default=None, help="Compare to these VDNAs instead of between all pairs of VDNAs."
+    )
+    compare_parser.add_argument("--distance", default=None, choices=["EMD", "NFD", "FD"])
+    compare_parser.add_argument("--layer", default=None, help="Only use neurons of this layer.")
+    compare_parser.add_argument("--neuron", type=int, default=None, help="Only use this neuron of --layer.")
+    compare_parser.add_argument("--neuron-wise", action="store_true", help="Give the distance of each neuron.")
+    compare_parser.add_argument(
+        "--selection",
+        default=None,
+        help="JSON file mapping layers to null for all their neurons, a list of neuron indices, or a dict of neuron "
+        "weights, to average distances over.",
+    )
+    compare_parser.add_argument("--device", default="cpu")
+    compare_parser.set_defaults(func=compare)
+
+    convert_parser = subparsers.add_parser("convert", help="Save a VDNA again, changing how histograms are stored.")
+    convert_parser.add_argument("input")
+    convert_parser.add_argument("output")
+    convert_parser.add_argument("--storage-dtype", default="auto", help="Type histogram counts are saved with.")
+    convert_parser.add_argument("--storage", default="auto", choices=["auto", "sparse", "dense"])
+    convert_parser.set_defaults(func=convert)
+
+    inspect_parser = subparsers.add_parser("inspect", help="Show the layers, number of images and settings of VDNAs.")
+    inspect_parser.add_argument("vdnas", nargs="+")
+    inspect_parser.add_argument("--settings", action="store_true", help="Include extraction and data settings.")
+    inspect_parser.set_defaults(func=inspect)
+
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Run the benchmark suite, printing its report as JSON. Other arguments are passed to the suite, see "
+        "python -m vdna.benchmarks.suite --help.",
+    )
+    bench_parser.set_defaults(func=bench)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Serve comparisons of images to reference VDNAs over HTTP, batching images of concurrent requests.",
+    )
+    serve_parser.add_argument(
+        "references", nargs="+", help="Paths to reference VDNAs, without extensions, optionally as name=path."
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--unix-socket", default=None, help="Listen on a Unix socket instead of a TCP port.")
+    serve_parser.add_argument("--device", default="cpu")
+    serve_parser.add_argument("--batch-size", type=int, default=64)
+    serve_parser.add_argument(
+        "--max-wait-ms", type=float, default=5.0, help="Time to wait for more images before running a batch."
+    )
+    serve_parser.add_argument("--distance", default=None, choices=["EMD", "NFD", "FD"])
+    serve_parser.add_argument(
+        "--max-body-mb", type=float, default=64, help="Largest request body accepted, in MiB (default: 64)."
+    )
+    serve_parser.add_argument("--precision", default=ExtractionSettings.precision)
+    serve_parser.set_defaults(func=serve)
+
+    # Unknown arguments are only accepted by bench, which passes them to the benchmark suite
+    args, suite_args = parser.parse_known_args(argv)
+    if args.command == "bench":
+        args.suite_args = suite_args
+    elif len(suite_args) > 0:
+        parser.error(f"unrecognized arguments: {' '.join(suite_args)}")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
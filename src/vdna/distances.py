@@ -2,12 +2,19 @@ from typing import Dict, Optional, Union
 
 import torch
 
-from .utils.stats import earth_movers_distance, frechet_distance_1d, frechet_distance_multidim
+from .neuron_selection import CompiledNeuronSelection, NeuronSelection
+from .utils.stats import (
+    earth_movers_distance,
+    earth_movers_distance_quantiles,
+    frechet_distance_1d,
+    frechet_distance_multidim,
+)
 from .utils.utils import convert_gaussian_to_neuron_gaussian
 from .vdnas.vdna_base import VDNA
 from .vdnas.vdna_gauss import VDNAGauss
-from .vdnas.vdna_hist import VDNAHist
+from .vdnas.vdna_hist import VDNAHist, resample_to_bins_of
 from .vdnas.vdna_layer_gauss import VDNALayerGauss
+from .vdnas.vdna_quantiles import VDNAQuantiles
 
 
 def common_check_vdna_comps(
@@ -16,6 +23,7 @@ def common_check_vdna_comps(
     use_neurons_from_layer: Optional[str],
     use_neuron_index: Optional[int],
     return_neuron_wise: bool,
+    neuron_selection: Optional[NeuronSelection] = None,
 ):
     """
     Check that two VDNAs have the same feature extractor, are on the same device,
@@ -29,11 +37,13 @@ def common_check_vdna_comps(
         use_neuron_index (int or None): The index of the neuron to use in the specified layer,
             or None if not using a specific neuron.
         return_neuron_wise (bool): Whether to return neuron-wise distance.
+        neuron_selection (NeuronSelection or None): Neurons and weights to average distances over, or None.
 
     Raises:
         AssertionError: If the feature extractors are not the same, the specified
             neuron index is out of bounds, or the VDNAs are on different devices.
-        ValueError: If `return_neuron_wise` is True and `use_neuron_index` is not None.
+        ValueError: If `return_neuron_wise` is True and `use_neuron_index` is not None, or if a neuron selection is
+            used with a layer, a neuron index or neuron-wise distances.
     """
     assert vdna1.feature_extractor_name == vdna2.feature_extractor_name, "Feature extractors must be the same"
     assert (
@@ -54,27 +64,53 @@ def common_check_vdna_comps(
     if return_neuron_wise and use_neuron_index is not None:
         raise ValueError("Cannot return neuron-wise distance when specifying a specific neuron to use")
 
+    if neuron_selection is not None and (
+        use_neurons_from_layer is not None or use_neuron_index is not None or return_neuron_wise
+    ):
+        raise ValueError("A neuron selection cannot be combined with a layer, a neuron index or neuron-wise distance")
+
     assert vdna1.device == vdna2.device, "VDNAs must be on the same device"
 
 
+def gather_selected_neurons(
+    vdna: VDNA, selection: CompiledNeuronSelection
+) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
+    """Gather the distributions of selected neurons of a VDNA, as a tensor or dict of tensors with a row per neuron."""
+    per_layer = {layer: vdna.get_all_neurons_in_layer_dist(layer) for layer in selection.layers}
+    first = per_layer[selection.layers[0]]
+    if isinstance(first, dict):
+        return {key: selection.gather({layer: dists[key] for layer, dists in per_layer.items()}) for key in first}
+    return selection.gather(per_layer)
+
+
 def EMD(
-    vdna1: VDNAHist,
-    vdna2: VDNAHist,
+    vdna1: Union[VDNAHist, VDNAQuantiles],
+    vdna2: Union[VDNAHist, VDNAQuantiles],
     use_neurons_from_layer: Optional[str] = None,
     use_neuron_index: Optional[int] = None,
     return_neuron_wise: bool = False,
+    neuron_selection: Optional[NeuronSelection] = None,
 ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
     """
-    Calculates the Earth Mover's Distance (EMD) between histograms of two VDNAs.
+    Calculates the Earth Mover's Distance (EMD) between histograms or quantiles of two VDNAs.
+
+    With histograms, the EMD is measured in bins of vdna1. Histograms of vdna2 with different bin ranges, such as
+    histograms with adaptive ranges, or with different numbers of bins are first resampled to the bins of vdna1, so
+    distances of several VDNAs to the same vdna1 are in the same units and can be ranked. Swapping the two VDNAs can
+    then change the distance. With quantiles, it is computed exactly between the quantile functions and measured in
+    normalised activation units, where the histogram range [-1, 1] spans 2 units. EMDs of histograms with N bins are
+    then approximately N / 2 times EMDs of quantiles.
 
     Args:
-        vdna1 (VDNAHist): The first VDNA with histograms.
-        vdna2 (VDNAHist): The second VDNA with histograms.
+        vdna1 (VDNAHist or VDNAQuantiles): The first VDNA with histograms or quantiles.
+        vdna2 (VDNAHist or VDNAQuantiles): The second VDNA with the same distribution type as the first VDNA.
         use_neurons_from_layer (str or None, optional): The name of the layer to use neurons from,
             or None if not using a specific layer. Defaults to None.
         use_neuron_index (int or None, optional): The index of the neuron to use in the specified layer,
             or None if not using a specific neuron. Defaults to None.
         return_neuron_wise (bool, optional): Whether to return neuron-wise distance. Defaults to False.
+        neuron_selection (NeuronSelection or None, optional): Neurons of any layers to use, with a weight each. If
+            given, returns the weighted mean of the EMDs of selected neurons. Defaults to None.
 
     Returns:
         torch.Tensor or Dict[str, torch.Tensor]: The EMD between the two VDNAs.
@@ -83,9 +119,10 @@ def EMD(
             If `return_neuron_wise` is False, returns a single EMD value from the average of selected neurons.
 
     Raises:
-        AssertionError: If the first VDNA is not a histogram, the second VDNA is not a histogram,
-            the histograms do not have the same number of bins, or the specified neuron index
-            is out of bounds.
+        AssertionError: If the VDNAs are not both histograms or both quantiles, quantiles of the same layers are not
+            both normalised or both raw, or the specified neuron index is out of bounds.
+        ValueError: If the histograms have different bins without bin ranges to resample them, or either VDNA has
+            adaptive ranges without bin ranges.
 
     Example:
         >>> from vdna import load_vdna_from_files, EMD
@@ -99,10 +136,28 @@ def EMD(
         >>> # Calculate EMD between all neurons in layer "block_0" and return neuron-wise distance
         >>> EMD(vdna1, vdna2, use_neurons_from_layer="block_0", return_neuron_wise=True)
     """
-    assert vdna1.type == "histogram", "First VDNA must be a histogram for EMD"
-    assert vdna2.type == "histogram", "Second VDNA must be a histogram for EMD"
-    assert vdna1.hist_nb_bins == vdna2.hist_nb_bins, "Histograms must have the same number of bins"
-    common_check_vdna_comps(vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise)
+    assert vdna1.type in ["histogram", "quantiles"], "First VDNA must be a histogram or quantiles for EMD"
+    assert vdna2.type == vdna1.type, "Second VDNA must have the same distribution type as the first VDNA for EMD"
+    if vdna1.type == "histogram":
+        vdna1, vdna2 = resample_to_bins_of(vdna1, vdna2)
+        emd_fn = earth_movers_distance
+    else:
+        # Quantile functions can be compared exactly with different numbers of quantiles
+        assert vdna1.raw_layers == vdna2.raw_layers, (
+            "Quantiles of raw and normalised activations cannot be compared, VDNAs were made with different "
+            "activation ranges"
+        )
+        emd_fn = earth_movers_distance_quantiles
+    common_check_vdna_comps(
+        vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise, neuron_selection
+    )
+
+    if neuron_selection is not None:
+        # Only the distributions of selected neurons are gathered and compared
+        selection = neuron_selection.compile(vdna1.neurons_list, vdna1.device)
+        return selection.weighted_mean(
+            emd_fn(gather_selected_neurons(vdna1, selection), gather_selected_neurons(vdna2, selection))
+        )
 
     if not return_neuron_wise:
         if use_neurons_from_layer:
@@ -117,7 +172,7 @@ def EMD(
             vdna1_hists = vdna1.get_all_neurons_dists()
             vdna2_hists = vdna2.get_all_neurons_dists()
 
-        return torch.mean(earth_movers_distance(vdna1_hists, vdna2_hists))
+        return torch.mean(emd_fn(vdna1_hists, vdna2_hists))
 
     else:
         emds_per_neuron = {}
@@ -125,7 +180,7 @@ def EMD(
         for layer in layers_to_use:
             vdna1_hists = vdna1.get_all_neurons_in_layer_dist(layer)
             vdna2_hists = vdna2.get_all_neurons_in_layer_dist(layer)
-            emds_per_neuron[layer] = earth_movers_distance(vdna1_hists, vdna2_hists)
+            emds_per_neuron[layer] = emd_fn(vdna1_hists, vdna2_hists)
         return emds_per_neuron
 
 
@@ -135,6 +190,7 @@ def NFD(
     use_neurons_from_layer: Optional[str] = None,
     use_neuron_index: Optional[int] = None,
     return_neuron_wise: bool = False,
+    neuron_selection: Optional[NeuronSelection] = None,
 ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
     """
     Calculates the Neuron Fidelity Distance (NFD) between two VDNA Gaussian distributions.
@@ -147,6 +203,8 @@ def NFD(
         use_neuron_index (int or None, optional): The index of the neuron to use in the specified layer,
             or None if not using a specific neuron. Defaults to None.
         return_neuron_wise (bool, optional): Whether to return neuron-wise distance. Defaults to False.
+        neuron_selection (NeuronSelection or None, optional): Neurons of any layers to use, with a weight each. If
+            given, returns the weighted mean of the NFDs of selected neurons. Defaults to None.
 
     Returns:
         torch.Tensor or Dict[str, torch.Tensor]: The NFD between the two VDNAs.
@@ -179,7 +237,9 @@ def NFD(
         "layer-gaussian",
         "gaussian",
     ], "Second VDNA must use a Gaussian distribution for NFD"
-    common_check_vdna_comps(vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise)
+    common_check_vdna_comps(
+        vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise, neuron_selection
+    )
 
     # # If using gaussian distributions with full covariances, we just use about the variances
     if vdna1.type == "layer-gaussian":
@@ -188,6 +248,14 @@ def NFD(
     if vdna2.type == "layer-gaussian":
         vdna2 = convert_gaussian_to_neuron_gaussian(vdna2)
 
+    if neuron_selection is not None:
+        selection = neuron_selection.compile(vdna1.neurons_list, vdna1.device)
+        vdna1_dists = gather_selected_neurons(vdna1, selection)
+        vdna2_dists = gather_selected_neurons(vdna2, selection)
+        return selection.weighted_mean(
+            frechet_distance_1d(vdna1_dists["mu"], vdna1_dists["var"], vdna2_dists["mu"], vdna2_dists["var"])
+        )
+
     if not return_neuron_wise:
         if use_neurons_from_layer:
             if use_neuron_index is not None:
@@ -225,6 +293,7 @@ def FD(
     use_neurons_from_layer: Optional[str] = None,
     use_neuron_index: Optional[int] = None,
     return_neuron_wise: bool = False,
+    neuron_selection: Optional[NeuronSelection] = None,
 ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
     """Calculates the Frechet distance between two VDNA Gaussian distributions.
 
@@ -236,6 +305,9 @@ def FD(
         use_neuron_index (int or None, optional): The index of the neuron to use in the specified layer,
             or None if not using a specific neuron. Defaults to None.
         return_neuron_wise (bool, optional): Whether to return neuron-wise distance. Defaults to False.
+        neuron_selection (NeuronSelection or None, optional): Neurons of any layers to use. If given, returns the
+            mean over layers of the FDs between the Gaussians of the selected neurons of each layer. Neurons cannot be
+            weighted. Defaults to None.
 
     Returns:
         torch.Tensor or Dict[str, torch.Tensor]: The Frechet distance between the two VDNAs.
@@ -258,7 +330,26 @@ def FD(
     """
     assert vdna1.type == "layer-gaussian", "First VDNA must use a full-layer Gaussian distribution for FD"
     assert vdna2.type == "layer-gaussian", "Second VDNA must use a full-layer Gaussian distribution for FD"
-    common_check_vdna_comps(vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise)
+    common_check_vdna_comps(
+        vdna1, vdna2, use_neurons_from_layer, use_neuron_index, return_neuron_wise, neuron_selection
+    )
+
+    if neuron_selection is not None:
+        selection = neuron_selection.compile(vdna1.neurons_list, vdna1.device)
+        if not selection.uniform:
+            raise ValueError("Neurons cannot be weighted with FD, which compares the Gaussians of whole layers")
+        all_fds = []
+        for layer in selection.layers:
+            idx = selection.layer_indices[layer]
+            all_fds.append(
+                frechet_distance_multidim(
+                    vdna1.data[layer]["mu"][idx],
+                    vdna1.data[layer]["sigma"][idx][:, idx],
+                    vdna2.data[layer]["mu"][idx],
+                    vdna2.data[layer]["sigma"][idx][:, idx],
+                )
+            )
+        return torch.mean(torch.Tensor(all_fds))
 
     if not return_neuron_wise:
         if use_neurons_from_layer:
@@ -299,3 +390,8 @@ def FD(
                     vdna1_dists["mu"], vdna1_dists["sigma"], vdna2_dists["mu"], vdna2_dists["sigma"]
                 )
         return fd_per_neuron
+
+
+DISTANCES = {"EMD": EMD, "NFD": NFD, "FD": FD}
+# Distance used to compare VDNAs of each distribution type when none is chosen
+DEFAULT_DISTANCES = {"histogram": "EMD", "quantiles": "EMD", "gaussian": "NFD", "layer-gaussian": "NFD"}
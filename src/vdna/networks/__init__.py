@@ -1,48 +1,71 @@
+from dataclasses import replace
+from importlib import import_module
+
+import torch
+
+from ..utils.settings import ExtractionSettings
 from .feature_extraction_model import FeatureExtractionModel
+from .model_cache import ModelCache
+from .registry import (
+    _BUILTIN_SPECS,
+    QUANTIZED_SUFFIX,
+    ExtractorSpec,
+    get_extractor_spec,
+    get_network_settings,
+    list_feature_extractors,
+    register_feature_extractor,
+)
+
+# Feature extractor classes of the built-in specs are only imported when first used, so that loading and comparing
+# VDNAs does not import the code and dependencies of every network
+_LAZY_EXTRACTORS = {
+    attr_name: module_name for module_name, attr_name in (spec.factory.split(":") for spec in _BUILTIN_SPECS)
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXTRACTORS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name = _LAZY_EXTRACTORS[name]
+    value = getattr(import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_EXTRACTORS))
+
+
+def prefetch_feature_extractor(feature_extractor, extraction_settings=ExtractionSettings(device="cpu")):
+    # Building the feature extractor downloads and caches all the files it needs
+    extraction_settings = replace(extraction_settings, offline=False, pretrained=True)
+    spec = get_extractor_spec(feature_extractor)
+    if feature_extractor.endswith(QUANTIZED_SUFFIX):
+        # Quantized variants use the files of the network they quantize
+        spec = get_extractor_spec(spec.args[0])
+    spec.build(extraction_settings)
+
+
+# Seed of the weights of randomly initialised networks, so that they give the same features in every process
+RANDOM_INIT_SEED = 0
 
-from .clip import CLIPImEncoder
-from .dino_resnet50 import resnet50_feat_extractor as DINOResnet50FeatExtractor
-from .dino_vit import DINOViTFeatExtractor
-from .inception_pytorch import InceptionV3
-from .mugs_vit import MugsViTFeatExtractor
-from .random_resnet50 import resnet50_feat_extractor as RandomResnet50FeatExtractor
-from .vgg16 import VGG16FeatExtractor
-from .cityscapes_resnet101 import resnet101_feat_extractor as CityscapesResnet101FeatExtractor
 
 def get_feature_extractor(feature_extractor, extraction_settings):
-    if feature_extractor == "inception":
-        # Input is normalised already
-        model = InceptionV3(
-            output_blocks=[0, 1, 2, 3],
-            resize_input=False,
-            normalize_input=False,
-            extraction_settings=extraction_settings,
-        )
-    elif feature_extractor == "dino_resnet50":
-        model = DINOResnet50FeatExtractor(extraction_settings=extraction_settings)
-    elif feature_extractor == "dino_vit_base":
-        model = DINOViTFeatExtractor("base", extraction_settings=extraction_settings)
-    elif feature_extractor == "dino_vit_small":
-        model = DINOViTFeatExtractor("small", extraction_settings=extraction_settings)
-    elif feature_extractor == "rand_resnet50":
-        model = RandomResnet50FeatExtractor(extraction_settings=extraction_settings)
-    elif feature_extractor == "vgg16":
-        model = VGG16FeatExtractor(extraction_settings=extraction_settings)
-    elif feature_extractor == "mugs_vit_large":
-        model = MugsViTFeatExtractor("large", extraction_settings=extraction_settings)
-    elif feature_extractor == "mugs_vit_base":
-        model = MugsViTFeatExtractor("base", extraction_settings=extraction_settings)
-    elif feature_extractor == "mugs_vit_small":
-        model = MugsViTFeatExtractor("small", extraction_settings=extraction_settings)
-    elif "clip_im_" in feature_extractor:
-        model_version = feature_extractor[8:]
-        model = CLIPImEncoder(model_version, extraction_settings=extraction_settings)
-    elif feature_extractor == "cityscapes_resnet101":
-        model = CityscapesResnet101FeatExtractor(extraction_settings=extraction_settings)
+    spec = get_extractor_spec(feature_extractor)
+    if extraction_settings.pretrained:
+        model = spec.build(extraction_settings)
     else:
-        raise NotImplementedError(f"Feature extractor {feature_extractor} not implemented")
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(RANDOM_INIT_SEED)
+            model = spec.build(extraction_settings)
     model.name = feature_extractor
     device = extraction_settings.device
     model = model.to(device)
+    if extraction_settings.memory_format == "channels_last":
+        model = model.to(memory_format=torch.channels_last)
     model.eval()
+    if extraction_settings.backend != "eager":
+        from .export import BackendForward
+
+        model.backend_forward = BackendForward(model, extraction_settings.backend)
     return model
@@ -0,0 +1,253 @@
+import json
+import os
+import platform
+import time
+from dataclasses import replace
+from typing import Dict, List, Sequence
+
+import torch
+
+from ..utils.cache import get_cache_dir
+from ..utils.memory import PeakMemoryMonitor, get_total_memory_mb, release_free_memory
+from .feature_extraction_model import FeatureExtractionModel, forward_context, iter_in_context
+
+AUTOTUNE_CACHE_NAME = "autotune.json"
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+# Extraction settings changing the speed or memory of extraction, which tuned configurations are kept for
+AUTOTUNE_SETTINGS = (
+    "device",
+    "precision",
+    "memory_format",
+    "backend",
+    "num_threads",
+    "average_feats_spatially",
+    "accumulate_spatial_feats_in_hist",
+    "accumulate_sample_feats_in_hist",
+    "keep_only_min_max",
+    "keep_quantile_sketch",
+    "normalise_feats",
+    "hist_nb_bins",
+    "quantile_sketch_levels",
+)
+
+
+def get_host_key(device="cpu") -> str:
+    """Get a key identifying the host and device, to keep configurations tuned on different machines apart."""
+    device = torch.device(device)
+    parts = [platform.node(), platform.machine(), str(os.cpu_count()), f"{get_total_memory_mb('cpu') or 0:.0f}MB"]
+    if device.type == "cuda":
+        parts.append(torch.cuda.get_device_name(device))
+    parts.append("torch" + torch.__version__)
+    return "/".join(parts)
+
+
+def get_autotune_key(
+    model: FeatureExtractionModel, memory_budget_mb: float, batch_sizes: Sequence[int], host_key: str
+) -> str:
+    settings = ",".join(f"{field}={getattr(model.extraction_settings, field)}" for field in AUTOTUNE_SETTINGS)
+    return f"{model.name}|{host_key}|{settings}|budget={memory_budget_mb}|batch_sizes={list(batch_sizes)}"
+
+
+def load_autotune_cache() -> Dict:
+    cache_path = get_cache_dir() / AUTOTUNE_CACHE_NAME
+    if not cache_path.is_file():
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def _save_autotune_result(key: str, result: Dict):
+    cache = load_autotune_cache()
+    cache[key] = result
+    cache_path = get_cache_dir() / AUTOTUNE_CACHE_NAME
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def probe_extraction(
+    model: FeatureExtractionModel, batch_size: int, hist_chunk_size: int = 0, n_batches: int = 2
+) -> Dict:
+    """
+    Extract features from batches of random images with a batch size and histogram chunk size, measuring the time and
+    peak memory of each stage. A first warm-up batch is not timed.
+
+    Stages are "input" (creating the batch), "forward" (running the network) and "statistics" (reducing features to
+    histograms or statistics). Peak memory is measured above the memory used before the probe.
+
+    Args:
+        model (FeatureExtractionModel): Feature extractor, with extraction settings set for the distribution to make.
+        batch_size (int): Number of images in each batch.
+        hist_chunk_size (int): Number of images binned at a time in histograms, or 0 to bin the whole batch at once.
+        n_batches (int): Number of timed batches.
+
+    Returns:
+        dict: Configuration, throughput in images per second, peak memory in MB, and time and peak memory per stage.
+    """
+    settings = model.extraction_settings
+    model.extraction_settings = replace(settings, batch_size=batch_size, hist_chunk_size=hist_chunk_size)
+    device = torch.device(settings.device)
+    use_bf16 = settings.precision == "bf16"
+    release_free_memory(device)
+    monitor = PeakMemoryMonitor(device)
+    stage_times = {"input": 0.0, "forward": 0.0, "statistics": 0.0}
+    acc_feats, hist_bin_params, n_values_per_neuron = {}, {}, {}
+    try:
+        for batch_idx in range(n_batches + 1):
+            start = time.perf_counter()
+            with monitor.stage("input"):
+                batch = torch.randn(batch_size, 3, *model.network_settings.expected_size)
+            stage_times["input"] += time.perf_counter() - start
+
+            batch_feats = iter_in_context(
+                model.iter_batch_features(batch, device), lambda: forward_context(device.type, use_bf16)
+            )
+            while True:
+                start = time.perf_counter()
+                with monitor.stage("forward"):
+                    layer_feats = next(batch_feats, None)
+                    _synchronize(device)
+                stage_times["forward"] += time.perf_counter() - start
+                if layer_feats is None:
+                    break
+
+                start = time.perf_counter()
+                with monitor.stage("statistics"):
+                    acc_feats = model.accumulate_layer_features(
+                        acc_feats, *layer_feats, hist_bin_params, n_values_per_neuron=n_values_per_neuron
+                    )
+                    del layer_feats
+                    _synchronize(device)
+                stage_times["statistics"] += time.perf_counter() - start
+            del batch
+
+            if batch_idx == 0:
+                # The first batch warms up the network, and is only used to measure memory
+                stage_times = {stage: 0.0 for stage in stage_times}
+    finally:
+        model.extraction_settings = settings
+        del acc_feats
+
+    total_time = sum(stage_times.values())
+    return {
+        "batch_size": batch_size,
+        "hist_chunk_size": hist_chunk_size,
+        "images_per_s": n_batches * batch_size / total_time,
+        "peak_mb": monitor.max_peak_mb,
+        "stages": {
+            stage: {"time_s": stage_times[stage] / n_batches, "peak_mb": monitor.peak_mb.get(stage, 0.0)}
+            for stage in stage_times
+        },
+    }
+
+
+def _get_chunk_sizes(model: FeatureExtractionModel, batch_size: int) -> List[int]:
+    # Whole batches are binned first, then smaller chunks which use less memory when whole batches do not fit
+    settings = model.extraction_settings
+    if not (settings.accumulate_spatial_feats_in_hist or settings.accumulate_sample_feats_in_hist):
+        return [0]
+    chunk_sizes = {size for size in [batch_size // 4, batch_size // 16, 1] if 0 < size < batch_size}
+    return [0] + sorted(chunk_sizes, reverse=True)
+
+
+def autotune_extraction(
+    model: FeatureExtractionModel,
+    memory_budget_mb: float,
+    batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+    n_batches: int = 2,
+    use_cache: bool = True,
+) -> Dict:
+    """
+    Find the batch size and histogram chunk size extracting features the fastest within a memory budget.
+
+    Batch sizes are probed in increasing order with random images. For each batch size, histograms are first built from
+    whole batches, then from smaller chunks of images if whole batches use too much memory. The search stops when no
+    configuration of a batch size fits in the budget, or when throughput decreased for two batch sizes in a row.
+    Results are cached per feature extractor, host and extraction settings, in the cache directory.
+
+    Memory used by the distribution accumulated over a whole dataset, such as the features kept for Gaussians, and by
+    dataloader workers is not included.
+
+    Args:
+        model (FeatureExtractionModel): Feature extractor, with extraction settings set for the distribution to make.
+        memory_budget_mb (float): Maximum peak memory used by extraction on the device, above the memory used by the
+            feature extractor, in MB.
+        batch_sizes (Sequence[int]): Batch sizes to probe, in increasing order.
+        n_batches (int): Number of timed batches for each probe.
+        use_cache (bool): Whether to reuse a configuration already tuned for the same feature extractor and host.
+
+    Returns:
+        dict: The chosen configuration and its measurements, as returned by probe_extraction, along with the host, the
+            memory budget, all probes, and whether it was loaded from the cache.
+
+    Raises:
+        ValueError: If no configuration fits in the memory budget.
+    """
+    host_key = get_host_key(model.extraction_settings.device)
+    key = get_autotune_key(model, memory_budget_mb, batch_sizes, host_key)
+    if use_cache:
+        cached = load_autotune_cache().get(key)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+    probes = []
+    best = None
+    n_slower = 0
+    for batch_size in batch_sizes:
+        fitting_probe = None
+        for hist_chunk_size in _get_chunk_sizes(model, batch_size):
+            try:
+                probe = probe_extraction(model, batch_size, hist_chunk_size, n_batches)
+            except (MemoryError, torch.cuda.OutOfMemoryError):
+                probe = {"batch_size": batch_size, "hist_chunk_size": hist_chunk_size, "out_of_memory": True}
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            probes.append(probe)
+            if not probe.get("out_of_memory") and probe["peak_mb"] <= memory_budget_mb:
+                fitting_probe = probe
+                break
+        if fitting_probe is None:
+            break
+
+        if best is None or fitting_probe["images_per_s"] > best["images_per_s"]:
+            best = fitting_probe
+            n_slower = 0
+        else:
+            n_slower += 1
+            if n_slower == 2:
+                break
+
+    if best is None:
+        raise ValueError(
+            f"No batch size of {list(batch_sizes)} extracts features of {model.name} within {memory_budget_mb} MB"
+        )
+
+    result = dict(
+        best,
+        feat_extractor=model.name,
+        host=host_key,
+        memory_budget_mb=memory_budget_mb,
+        probes=probes,
+    )
+    _save_autotune_result(key, result)
+    return dict(result, cached=False)
+
+
+def format_autotune_report(result: Dict) -> str:
+    lines = [
+        f"Tuned extraction of {result['feat_extractor']} on {result['host']}"
+        + (" (from cache)" if result.get("cached") else ""),
+        f"  batch_size={result['batch_size']} hist_chunk_size={result['hist_chunk_size']}: "
+        f"{result['images_per_s']:.1f} images/s, peak {result['peak_mb']:.0f} MB "
+        f"of {result['memory_budget_mb']:.0f} MB budget",
+    ]
+    for stage, stage_result in result["stages"].items():
+        time_ms = stage_result["time_s"] * 1000
+        lines.append(f"  {stage:<10} {time_ms:8.1f} ms/batch  peak {stage_result['peak_mb']:.0f} MB")
+    return "\n".join(lines)
@@ -8,13 +8,67 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import os
+from importlib import resources
+from pathlib import Path
+
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
+from ..utils.cache import get_cache_dir, get_file_cache_key, load_state_dict_file, save_state_dict_file
+from ..utils.io import load_activation_ranges
+from ..utils.settings import ExtractionSettings
 from .feature_extraction_model import FeatureExtractionModel
+from .registry import get_extractor_spec, get_network_settings
+
+# Activation ranges shipped as package data in vdna/networks/data
+DEFAULT_ACTIVATION_RANGES_FILE = "activation_ranges_cityscapes_resnet101.json"
+WEIGHTS_PATH_ENV_VAR = "VDNA_CITYSCAPES_RESNET101_WEIGHTS"
+ACTIVATION_RANGES_PATH_ENV_VAR = "VDNA_CITYSCAPES_RESNET101_ACTIVATION_RANGES"
+
+
+def load_cityscapes_activation_ranges(extraction_settings: ExtractionSettings) -> dict:
+    path = extraction_settings.activation_ranges_path or os.environ.get(ACTIVATION_RANGES_PATH_ENV_VAR, "")
+    if not path:
+        with resources.as_file(resources.files(__package__) / "data" / DEFAULT_ACTIVATION_RANGES_FILE) as path:
+            return load_activation_ranges(path)
+    path = Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(
+            f"Activation ranges for cityscapes_resnet101 not found at {path}. "
+            f"Set activation_ranges_path or the {ACTIVATION_RANGES_PATH_ENV_VAR} environment variable."
+        )
+    return load_activation_ranges(path)
+
+
+def get_weights_path(extraction_settings: ExtractionSettings) -> Path:
+    path = extraction_settings.weights_path or os.environ.get(WEIGHTS_PATH_ENV_VAR, "")
+    if not path:
+        # The spec gives the name of the checkpoint provided by the user, as local://<file name>
+        file_name = get_extractor_spec("cityscapes_resnet101").weights_source[len("local://") :]
+        raise ValueError(
+            f"cityscapes_resnet101 needs the DeepLabV3+ checkpoint {file_name}. "
+            f"Set weights_path or the {WEIGHTS_PATH_ENV_VAR} environment variable to its location."
+        )
+    path = Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f"Weights for cityscapes_resnet101 not found at {path}")
+    return path
+
+
+def strip_backbone_prefix(state_dict):
+    # DeepLab checkpoints store the backbone under "backbone.", next to the segmentation head we don't use
+    return {k[len("backbone.") :]: v for k, v in state_dict.items() if k.startswith("backbone.")}
+
+
+def load_backbone_state_dict(weights_path: Path):
+    # The stripped backbone is cached, keyed by the checkpoint path, size and modification time
+    cache_path = get_cache_dir() / "cityscapes_resnet101" / f"backbone_{get_file_cache_key(weights_path)}.pt"
+    if not cache_path.is_file():
+        checkpoint = torch.load(weights_path, map_location="cpu")
+        save_state_dict_file(strip_backbone_prefix(checkpoint["model_state"]), cache_path)
+        del checkpoint
+    return load_state_dict_file(cache_path, mmap=True)
 
 
 def make_feature_dict(feature_list, preprend_name):
@@ -177,56 +231,12 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         dont_return_features=False,
         extraction_settings=ExtractionSettings(),
     ):
-        # activation_ranges = hf_hub_download(
-        #     repo_id=extraction_settings.hub_repo, filename="Random/rand_resnet50/activation_ranges.json"
-        # )
-        # min_max_act_per_neuron = load_dict(activation_ranges)
-        # TODO: load activation ranges from a file
-        filepath = "/media/henry/Data/msc/lab/proj/vdna/activation_ranges_cityscapes_resnet101.json"
-        # min_max_act_per_neuron = load_dict("/media/henry/Data/Downloads/Random_rand_resnet101_activation_ranges.json")
-        min_max_act_per_neuron = load_dict(filepath)
-
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            {
-                "layer1_0": 256,
-                "layer1_1": 256,
-                "layer1_2": 256,
-                "layer2_0": 512,
-                "layer2_1": 512,
-                "layer2_2": 512,
-                "layer2_3": 512,
-                "layer3_0": 1024,
-                "layer3_1": 1024,
-                "layer3_2": 1024,
-                "layer3_3": 1024,
-                "layer3_4": 1024,
-                "layer3_5": 1024,
-                "layer3_6": 1024,
-                "layer3_7": 1024,
-                "layer3_8": 1024,
-                "layer3_9": 1024,
-                "layer3_10": 1024,
-                "layer3_11": 1024,
-                "layer3_12": 1024,
-                "layer3_13": 1024,
-                "layer3_14": 1024,
-                "layer3_15": 1024,
-                "layer3_16": 1024,
-                "layer3_17": 1024,
-                "layer3_18": 1024,
-                "layer3_19": 1024,
-                "layer3_20": 1024,
-                "layer3_21": 1024,
-                "layer3_22": 1024,
-                "layer4_0": 2048,
-                "layer4_1": 2048,
-                "layer4_2": 2048,
-            },
-            (224, 224),
-            "cityscapes_resnet101_backbone",
-        )
+        if extraction_settings.pretrained:
+            min_max_act_per_neuron = load_cityscapes_activation_ranges(extraction_settings)
+        else:
+            min_max_act_per_neuron = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+
+        network_settings = get_network_settings("cityscapes_resnet101")
 
         super(ResNetFeatureExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
         if norm_layer is None:
@@ -426,12 +436,12 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         for end_idx in idx_crops:
             if self.dont_return_features:
                 _out = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
                 features = {}
             else:
                 _out, features = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
             if start_idx == 0:
                 output = _out
@@ -444,16 +454,17 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
 
         return features
 
+    def iter_features(self, batch):
+        # Blocks are run one at a time, yielding their outputs rather than collecting the features of all blocks
+        x = self.maxpool(self.relu(self.bn1(self.conv1(self.padding(batch)))))
+        for layer_name in ["layer1", "layer2", "layer3", "layer4"]:
+            for i, block in enumerate(getattr(self, layer_name)):
+                x, _ = block(x)
+                yield layer_name + "_" + str(i), x
+
     def get_features(self, batch):
-        return self.forward(batch)
+        return dict(self.iter_features(batch))
 
-    def load_state_dict_with_key_update(self, state_dict):
-        new_state_dict = {}
-        for k, v in state_dict.items():
-            if k.startswith("backbone."):
-                new_k = k[len("backbone."):]
-                new_state_dict[new_k] = v
-        self.load_state_dict(new_state_dict)
 
 class MultiPrototypes(nn.Module):
     def __init__(self, output_dim, nmb_prototypes):
@@ -471,14 +482,10 @@ class MultiPrototypes(nn.Module):
 
 def resnet101_feat_extractor(extraction_settings):
     resnet = ResNetFeatureExtractor(Bottleneck, [3, 4, 23, 3], extraction_settings=extraction_settings)
-    # weights = hf_hub_download(repo_id=extraction_settings.hub_repo, filename="Random/rand_resnet50/weights.pth")
-    weights_path = "/media/henry/Data/Downloads/best_deeplabv3plus_resnet101_cityscapes_os16.pth"
-    checkpoint = torch.load(weights_path)
-    # resnet.load_state_dict(checkpoint["model_state"])
-    resnet.load_state_dict_with_key_update(checkpoint["model_state"])
-    # for name, param in resnet.named_parameters():
-        # print(f"name: {name}")
-        # if "layer1" in name:
-            # print(f"name: {name}")
-            # print(f"param: {param}")
+    if not extraction_settings.pretrained:
+        return resnet
+    resnet.load_state_dict(load_backbone_state_dict(get_weights_path(extraction_settings)))
     return resnet
+
+
+CityscapesResnet101FeatExtractor = resnet101_feat_extractor
@@ -6,23 +6,63 @@ from typing import Dict, Tuple, Union
 import numpy as np
 import torch
 import torch.nn.functional as F
-from huggingface_hub import hf_hub_download
 from torch import nn
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
-
-_MODELS = {
-    "rn50": "https://openaipublic.azureedge.net/clip/models/afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
-    # "rn101": "https://openaipublic.azureedge.net/clip/models/8fa8567bab74a42d41c5915025a8e4538c3bdbe8804a470a72f30b0d94fab599/RN101.pt",
-    # "rn50x4": "https://openaipublic.azureedge.net/clip/models/7e526bd135e493cef0776de27d5f42653e6b4c8bf9e0f653bb11773263205fdd/RN50x4.pt",
-    # "rn50x16": "https://openaipublic.azureedge.net/clip/models/52378b407f34354e150460fe41077663dd5b39c54cd0bfd2b27167a4a06ec9aa/RN50x16.pt",
-    # "rn50x64": "https://openaipublic.azureedge.net/clip/models/be1cfb55d75a9666199fb2206c106743da0f6468c9d327f3e0d0a543a9919d9c/RN50x64.pt",
-    "vit_b32": "https://openaipublic.azureedge.net/clip/models/40d365715913c9da98579312b702a82c18be219cc2a73407c4526f58eba950af/ViT-B-32.pt",
-    "vit_b16": "https://openaipublic.azureedge.net/clip/models/5806e77cd80f8b59890b7e101eabd078d9fb84e6937f9e85e4ecb61988df416f/ViT-B-16.pt",
-    "vit_l14": "https://openaipublic.azureedge.net/clip/models/b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
-    # "vit_l14@336px": "https://openaipublic.azureedge.net/clip/models/3035c92b350959924f9f00213499208652fc7ea050643e8b385c2dac08641f02/ViT-L-14-336px.pt",
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
+
+# Arguments of CLIP for each model, as found by build_model from their weights, to build randomly initialised models
+_ARCHITECTURES = {
+    "rn50": dict(
+        embed_dim=1024,
+        image_resolution=224,
+        vision_layers=(3, 4, 6, 3),
+        vision_width=64,
+        vision_patch_size=None,
+        context_length=77,
+        vocab_size=49408,
+        transformer_width=512,
+        transformer_heads=8,
+        transformer_layers=12,
+    ),
+    "vit_b32": dict(
+        embed_dim=512,
+        image_resolution=224,
+        vision_layers=12,
+        vision_width=768,
+        vision_patch_size=32,
+        context_length=77,
+        vocab_size=49408,
+        transformer_width=512,
+        transformer_heads=8,
+        transformer_layers=12,
+    ),
+    "vit_b16": dict(
+        embed_dim=512,
+        image_resolution=224,
+        vision_layers=12,
+        vision_width=768,
+        vision_patch_size=16,
+        context_length=77,
+        vocab_size=49408,
+        transformer_width=512,
+        transformer_heads=8,
+        transformer_layers=12,
+    ),
+    "vit_l14": dict(
+        embed_dim=768,
+        image_resolution=224,
+        vision_layers=24,
+        vision_width=1024,
+        vision_patch_size=14,
+        context_length=77,
+        vocab_size=49408,
+        transformer_width=768,
+        transformer_heads=12,
+        transformer_layers=12,
+    ),
 }
 
 
@@ -163,16 +203,27 @@ class ModifiedResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        def stem(x):
-            x = self.relu1(self.bn1(self.conv1(x)))
-            x = self.relu2(self.bn2(self.conv2(x)))
-            x = self.relu3(self.bn3(self.conv3(x)))
-            x = self.avgpool(x)
-            return x
+    def stem(self, x):
+        x = self.relu1(self.bn1(self.conv1(x)))
+        x = self.relu2(self.bn2(self.conv2(x)))
+        x = self.relu3(self.bn3(self.conv3(x)))
+        x = self.avgpool(x)
+        return x
 
+    def iter_feats(self, x):
+        # Same features as forward, yielded as soon as they are computed. Each block gets its own feature list, so
+        # that the outputs of previous blocks are not kept.
+        x = self.stem(x.type(self.conv1.weight.dtype))
+        yield x
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                x = block({"x": x, "feats": []})["x"]
+                yield x
+        yield self.attnpool(x).unsqueeze(2).unsqueeze(3)
+
+    def forward(self, x):
         x = x.type(self.conv1.weight.dtype)
-        x = stem(x)
+        x = self.stem(x)
 
         out = {"x": x, "feats": [x]}
         out = self.layer1(out)
@@ -259,7 +310,7 @@ class VisionTransformer(nn.Module):
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
 
-    def forward(self, x: torch.Tensor):
+    def embed(self, x: torch.Tensor):
         x = self.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
@@ -272,7 +323,20 @@ class VisionTransformer(nn.Module):
             dim=1,
         )  # shape = [*, grid ** 2 + 1, width]
         x = x + self.positional_embedding.to(x.dtype)
-        x = self.ln_pre(x)
+        return self.ln_pre(x)
+
+    def iter_feats(self, x: torch.Tensor):
+        # Same features as forward, yielded as soon as they are computed. Each block gets its own feature list, so
+        # that the outputs of previous blocks are not kept.
+        x = self.embed(x).permute(1, 0, 2)  # NLD -> LND
+        for block in self.transformer.resblocks:
+            x = block({"x": x, "feats": []})["x"]
+            yield x
+        x = self.ln_post(x.permute(1, 0, 2)[:, 0, :])  # LND -> NLD
+        yield x.reshape(x.shape[0], 1, x.shape[1])
+
+    def forward(self, x: torch.Tensor):
+        x = self.embed(x)
 
         x = x.permute(1, 0, 2)  # NLD -> LND
         out = self.transformer(x)
@@ -389,6 +453,9 @@ class CLIP(nn.Module):
     def encode_image(self, image):
         return self.visual(image.type(self.dtype))
 
+    def iter_image_feats(self, image):
+        return self.visual.iter_feats(image.type(self.dtype))
+
     def encode_text(self, text):
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
@@ -503,104 +570,40 @@ class CLIPImEncoder(FeatureExtractionModel):
         extraction_settings=ExtractionSettings(),
     ):
 
-        activation_ranges = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename=f"CLIP/clip_im_{model_version}/activation_ranges.json"
-        )
         if "vit_b16" in model_version:
-            min_max_act_per_neuron = load_dict(activation_ranges)
+            min_max_act_per_neuron = load_network_activation_ranges(
+                f"hf://CLIP/clip_im_{model_version}/activation_ranges.json", extraction_settings
+            )
         else:
             min_max_act_per_neuron = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
 
-        if "vit_b" in model_version:
-            neurons_per_layer = {
-                "block_0": 768,
-                "block_1": 768,
-                "block_2": 768,
-                "block_3": 768,
-                "block_4": 768,
-                "block_5": 768,
-                "block_6": 768,
-                "block_7": 768,
-                "block_8": 768,
-                "block_9": 768,
-                "block_10": 768,
-                "block_11": 768,
-                "last_norm": 768,
-            }
-        elif "vit_l" in model_version:
-            neurons_per_layer = {
-                "block_0": 1024,
-                "block_1": 1024,
-                "block_2": 1024,
-                "block_3": 1024,
-                "block_4": 1024,
-                "block_5": 1024,
-                "block_6": 1024,
-                "block_7": 1024,
-                "block_8": 1024,
-                "block_9": 1024,
-                "block_10": 1024,
-                "block_11": 1024,
-                "block_12": 1024,
-                "block_13": 1024,
-                "block_14": 1024,
-                "block_15": 1024,
-                "block_16": 1024,
-                "block_17": 1024,
-                "block_18": 1024,
-                "block_19": 1024,
-                "block_20": 1024,
-                "block_21": 1024,
-                "block_22": 1024,
-                "block_23": 1024,
-                "last_norm": 1024,
-            }
-        elif "rn50" in model_version:
-            neurons_per_layer = {
-                "block_0": 64,
-                "block_1": 256,
-                "block_2": 256,
-                "block_3": 256,
-                "block_4": 512,
-                "block_5": 512,
-                "block_6": 512,
-                "block_7": 512,
-                "block_8": 1024,
-                "block_9": 1024,
-                "block_10": 1024,
-                "block_11": 1024,
-                "block_12": 1024,
-                "block_13": 1024,
-                "block_14": 2048,
-                "block_15": 2048,
-                "block_16": 2048,
-                "last_norm": 1024,
-            }
-        else:
+        if model_version not in _ARCHITECTURES:
             raise ValueError("Unsupported CLIP version{}".format(model_version))
 
-        network_settings = NetworkSettings(
-            [0.48145466, 0.4578275, 0.40821073],
-            [0.26862954, 0.26130258, 0.27577711],
-            neurons_per_layer,
-            (224, 224),
-            "clip_im_" + model_version,
-        )
+        network_settings = get_network_settings("clip_im_" + model_version)
         super(CLIPImEncoder, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
 
-        tmp_model = torch.hub.load_state_dict_from_url(
-            _MODELS[model_version], progress=True, map_location=torch.device("cpu")
-        ).eval()
-        self.model = build_model(tmp_model.state_dict())
+        if extraction_settings.pretrained:
+            weights_source = get_extractor_spec("clip_im_" + model_version).weights_source
+            tmp_model = torch.load(
+                get_artifact(weights_source, extraction_settings), map_location="cpu", weights_only=False
+            ).eval()
+            self.model = build_model(tmp_model.state_dict())
+        else:
+            self.model = CLIP(**_ARCHITECTURES[model_version])
+            convert_weights(self.model)
+            self.model.eval()
 
         for param in self.model.parameters():
             param.requires_grad = False
         self.model_version = model_version
 
+    def iter_features(self, x):
+        layers = list(self.network_settings.neurons_per_layer)
+        for layer, o in zip(layers, self.model.iter_image_feats(x)):
+            if "vit" in self.model_version:
+                o = o.permute(1, 2, 0).unsqueeze(3)
+            yield layer, o
+
     def get_features(self, x):
-        out = self.model.encode_image(x)[1]
-        if "vit" in self.model_version:
-            out = [o.permute(1, 2, 0).unsqueeze(3) for o in out]
-        out_dict = {"block_" + str(i): o for i, o in enumerate(out[:-1])}
-        out_dict["last_norm"] = out[-1]
-        return out_dict
+        return dict(self.iter_features(x))
@@ -10,18 +10,11 @@
 
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
-
-try:
-    from torchvision.models.utils import load_state_dict_from_url
-except ImportError:
-    from torch.utils.model_zoo import load_url as load_state_dict_from_url
-
-DINO_WEIGHTS_URL = "https://dl.fbaipublicfiles.com/dino/dino_resnet50_pretrain/dino_resnet50_pretrain.pth"
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 
 def make_feature_dict(feature_list, preprend_name):
@@ -185,34 +178,10 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         extraction_settings=ExtractionSettings(),
     ):
 
-        activation_ranges = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename="DINO/dino_resnet50/activation_ranges.json"
-        )
-        min_max_act_per_neuron = load_dict(activation_ranges)
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            {
-                "layer1_0": 256,
-                "layer1_1": 256,
-                "layer1_2": 256,
-                "layer2_0": 512,
-                "layer2_1": 512,
-                "layer2_2": 512,
-                "layer2_3": 512,
-                "layer3_0": 1024,
-                "layer3_1": 1024,
-                "layer3_2": 1024,
-                "layer3_3": 1024,
-                "layer3_4": 1024,
-                "layer3_5": 1024,
-                "layer4_0": 2048,
-                "layer4_1": 2048,
-                "layer4_2": 2048,
-            },
-            (224, 224),
-            "dino_resnet50_backbone",
+        min_max_act_per_neuron = load_network_activation_ranges(
+            "hf://DINO/dino_resnet50/activation_ranges.json", extraction_settings
         )
+        network_settings = get_network_settings("dino_resnet50")
 
         super(ResNetFeatureExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
         if norm_layer is None:
@@ -412,12 +381,12 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         for end_idx in idx_crops:
             if self.dont_return_features:
                 _out = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
                 features = {}
             else:
                 _out, features = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
             if start_idx == 0:
                 output = _out
@@ -430,8 +399,16 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
 
         return features
 
+    def iter_features(self, batch):
+        # Blocks are run one at a time, yielding their outputs rather than collecting the features of all blocks
+        x = self.maxpool(self.relu(self.bn1(self.conv1(self.padding(batch)))))
+        for layer_name in ["layer1", "layer2", "layer3", "layer4"]:
+            for i, block in enumerate(getattr(self, layer_name)):
+                x, _ = block(x)
+                yield layer_name + "_" + str(i), x
+
     def get_features(self, batch):
-        return self.forward(batch)
+        return dict(self.iter_features(batch))
 
 
 class MultiPrototypes(nn.Module):
@@ -448,9 +425,15 @@ class MultiPrototypes(nn.Module):
         return out
 
 
-def resnet50_feat_extractor(**kwargs):
-    resnet = ResNetFeatureExtractor(Bottleneck, [3, 4, 6, 3], **kwargs)
-    state_dict = load_state_dict_from_url(DINO_WEIGHTS_URL, progress=True, map_location="cpu")
+def resnet50_feat_extractor(extraction_settings=ExtractionSettings()):
+    resnet = ResNetFeatureExtractor(Bottleneck, [3, 4, 6, 3], extraction_settings=extraction_settings)
+    if not extraction_settings.pretrained:
+        return resnet
+    weights_source = get_extractor_spec("dino_resnet50").weights_source
+    state_dict = torch.load(get_artifact(weights_source, extraction_settings), map_location="cpu")
     state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
     resnet.load_state_dict(state_dict, strict=True)
     return resnet
+
+
+DINOResnet50FeatExtractor = resnet50_feat_extractor
@@ -22,21 +22,11 @@ from functools import partial
 
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
-
-try:
-    from torchvision.models.utils import load_state_dict_from_url
-except ImportError:
-    from torch.utils.model_zoo import load_url as load_state_dict_from_url
-
-WEIGHTS_LINKS = {
-    "base": "https://dl.fbaipublicfiles.com/dino/dino_vitbase16_pretrain/dino_vitbase16_pretrain.pth",
-    "small": "https://dl.fbaipublicfiles.com/dino/dino_deitsmall16_pretrain/dino_deitsmall16_pretrain.pth",
-}
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
@@ -304,16 +294,21 @@ class VisionTransformer(nn.Module):
 
         return self.pos_drop(x)
 
+    def iter_feats(self, x):
+        # Outputs of each block and of the last norm, yielded as soon as they are computed
+        x = self.prepare_tokens(x)
+        for blk in self.blocks:
+            x = blk(x)
+            yield x
+        yield self.norm(x)
+
     def forward(self, x, return_all_feats=False):
-        all_feats = []
+        if return_all_feats:
+            return list(self.iter_feats(x))
         x = self.prepare_tokens(x)
         for blk in self.blocks:
             x = blk(x)
-            all_feats.append(x)
         x = self.norm(x)
-        all_feats.append(x)
-        if return_all_feats:
-            return all_feats
         return x[:, 0]
 
     def get_last_selfattention(self, x):
@@ -423,30 +418,17 @@ class DINOViTFeatExtractor(FeatureExtractionModel):
         model_version,
         extraction_settings=ExtractionSettings(),
     ):
-        if model_version == "small":
-            n_neurons_per_layer = 384
-        if model_version == "base":
-            n_neurons_per_layer = 768
-        else:
+        if model_version not in ("small", "base"):
             raise ValueError("Unsupported DINO ViT version{}".format(model_version))
 
         if model_version == "base":
-            activation_ranges = hf_hub_download(
-                repo_id=extraction_settings.hub_repo, filename="DINO/dino_vit_base/activation_ranges.json"
+            min_max_act_per_neuron = load_network_activation_ranges(
+                "hf://DINO/dino_vit_base/activation_ranges.json", extraction_settings
             )
-            min_max_act_per_neuron = load_dict(activation_ranges)
         else:
             min_max_act_per_neuron = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
 
-        neurons_per_layer = {"block_" + str(i): n_neurons_per_layer for i in range(12)}
-        neurons_per_layer["last_norm"] = n_neurons_per_layer
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            neurons_per_layer,
-            (224, 224),
-            "dino_vit_" + model_version,
-        )
+        network_settings = get_network_settings("dino_vit_" + model_version)
         super(DINOViTFeatExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
 
         if model_version == "small":
@@ -454,15 +436,18 @@ class DINOViTFeatExtractor(FeatureExtractionModel):
         if model_version == "base":
             self.model = vit_base(num_relation_blocks=1)
 
-        state_dict = load_state_dict_from_url(WEIGHTS_LINKS[model_version], progress=True, map_location="cpu")
-        self.model.load_state_dict(state_dict, strict=True)
+        if extraction_settings.pretrained:
+            weights_source = get_extractor_spec("dino_vit_" + model_version).weights_source
+            state_dict = torch.load(get_artifact(weights_source, extraction_settings), map_location="cpu")
+            self.model.load_state_dict(state_dict, strict=True)
 
         for param in self.model.parameters():
             param.requires_grad = False
 
+    def iter_features(self, x):
+        n_blocks = len(self.model.blocks)
+        for i, o in enumerate(self.model.iter_feats(x)):
+            yield ("block_" + str(i) if i < n_blocks else "last_norm"), o.permute(0, 2, 1).unsqueeze(3)
+
     def get_features(self, x):
-        out = self.model(x, return_all_feats=True)
-        out = [o.permute(0, 2, 1).unsqueeze(3) for o in out]
-        out_dict = {"block_" + str(i): o for i, o in enumerate(out[:-1])}
-        out_dict["last_norm"] = out[-1]
-        return out_dict
+        return dict(self.iter_features(x))
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+from ..utils.cache import get_cache_dir, get_file_cache_key
+from .model_cache import get_model_cache_key
+
+BACKENDS = ["eager", "compile", "torchscript", "export", "onnxruntime"]
+# Backends giving standalone graphs, which are saved in the cache directory and reloaded by later processes
+EXPORT_BACKENDS = {"torchscript": ".pt", "export": ".pt2", "onnxruntime": ".onnx"}
+
+
+class _GetFeatures(nn.Module):
+    # Graph of a feature extractor from a batch of images to the dict of features of each layer
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.get_features(x)
+
+
+def get_calibration_files(settings) -> List[str]:
+    # Images used to calibrate the quantization of a feature extractor, as picked by quantized_feat_extractor
+    from ..utils.settings import DataSettings
+    from .feature_extraction_model import get_files_list
+
+    data_settings = DataSettings(
+        source=settings.calibration_source, num_images=settings.calibration_num_images, shuffle_files=True
+    )
+    return get_files_list(data_settings, settings.seed)
+
+
+def get_exported_path(model: nn.Module, backend: str, input_shape: Tuple[int, ...]) -> Path:
+    """Get the cache path of the graph of a feature extractor exported with a backend for batches of a given shape."""
+    settings = model.extraction_settings
+    key = [
+        repr(get_model_cache_key(model.name, settings)),
+        torch.__version__,
+        backend,
+        str(tuple(input_shape)),
+    ]
+    # Weights are part of the exported graph, so local weights files are identified by their content
+    for path in [settings.weights_path, settings.calibration_source]:
+        if path and Path(path).is_file():
+            key.append(get_file_cache_key(path))
+    if settings.calibration_source and Path(settings.calibration_source).is_dir():
+        # Quantization scales depend on the calibration images, which are identified as they are for weights files
+        key.extend(get_file_cache_key(path) for path in get_calibration_files(settings))
+    digest = hashlib.sha256(":".join(key).encode()).hexdigest()[:16]
+    return get_cache_dir() / "exported" / f"{model.name}-{backend}-{digest}{EXPORT_BACKENDS[backend]}"
+
+
+def export_feat_extractor(model: nn.Module, backend: str, example: torch.Tensor, path: Path):
+    """Export the graph computing the features of a feature extractor for batches shaped like example, saving it to path."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # torch.export expects archives ending in .pt2, so the temporary file keeps the suffix of the path
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+    graph = _GetFeatures(model).eval()
+    # Graphs are exported in float32. With the bf16 precision, autocast is applied to their operations when they run,
+    # which is why onnxruntime sessions, out of reach of autocast, only run in fp32.
+    with torch.no_grad(), torch.autocast(example.device.type, enabled=False):
+        if backend == "torchscript":
+            # strict=False allows returning a dict of features
+            torch.jit.save(torch.jit.trace(graph, example, strict=False), str(tmp_path))
+        elif backend == "export":
+            torch.export.save(torch.export.export(graph, (example,)), str(tmp_path))
+        elif backend == "onnxruntime":
+            layers = list(graph(example).keys())
+            torch.onnx.export(graph, (example,), str(tmp_path), input_names=["images"], output_names=layers)
+    os.replace(tmp_path, path)
+
+
+def load_exported(backend: str, path: Path, device: torch.device) -> Callable[[torch.Tensor], Dict[str, torch.Tensor]]:
+    """Load a graph saved by export_feat_extractor, as a function from a batch to the dict of features of each layer."""
+    if backend == "torchscript":
+        return torch.jit.load(str(path), map_location=device)
+    if backend == "export":
+        return torch.export.load(str(path)).module().to(device)
+
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    layers = [output.name for output in session.get_outputs()]
+
+    def run_session(x):
+        outputs = session.run(None, {"images": x.contiguous().numpy()})
+        return {layer: torch.from_numpy(output) for layer, output in zip(layers, outputs)}
+
+    return run_session
+
+
+class BackendForward:
+    """
+    Computes the features of batches with a feature extractor compiled or exported with a backend.
+
+    Exported graphs have a fixed input shape. They are exported for the batch size of the extraction settings the
+    first time a shape is seen, or loaded from the cache directory if a previous process already exported them.
+    Smaller batches, such as the last one of a dataset, are padded with zeros and their padding features are dropped.
+
+    Args:
+        model (FeatureExtractionModel): The feature extractor, whose get_features method is compiled or exported.
+        backend (str): "compile" to use torch.compile, or "torchscript", "export" or "onnxruntime" for exported graphs.
+    """
+
+    def __init__(self, model: nn.Module, backend: str):
+        assert backend in BACKENDS and backend != "eager", f"Unknown backend {backend}"
+        if backend == "onnxruntime":
+            assert torch.device(model.extraction_settings.device).type == "cpu", "The onnxruntime backend only runs on CPU"
+            assert model.extraction_settings.precision == "fp32", "The onnxruntime backend only runs in fp32"
+            try:
+                import onnxruntime  # noqa: F401
+                import onnxscript  # noqa: F401
+            except ImportError:
+                raise ImportError("The onnxruntime backend needs onnx packages, install them with pip install vdna[onnx]")
+        self.model = model
+        self.backend = backend
+        self.compiled = torch.compile(_GetFeatures(model)) if backend == "compile" else None
+        self.graphs = {}
+
+    def get_graph(self, input_shape: Tuple[int, ...], device: torch.device):
+        key = tuple(input_shape)
+        if key not in self.graphs:
+            path = get_exported_path(self.model, self.backend, input_shape)
+            if not path.is_file():
+                logging.info(f"Exporting {self.model.name} with the {self.backend} backend to {path}")
+                example = torch.zeros(input_shape, device=device).contiguous(memory_format=self._get_memory_format())
+                # Batches from the extraction loop are inference tensors, which cannot be used to trace graphs
+                with torch.inference_mode(False):
+                    export_feat_extractor(self.model, self.backend, example, path)
+            self.graphs[key] = load_exported(self.backend, path, device)
+        return self.graphs[key]
+
+    def __call__(self, batch: torch.Tensor) -> Dict[str, torch.Tensor]:
+        if self.compiled is not None:
+            return self.compiled(batch)
+
+        n_images, image_shape = batch.shape[0], tuple(batch.shape[1:])
+        # Use the smallest graph already exported for batches at least as large, to avoid exporting one for the last
+        # batch of each dataset
+        batch_sizes = [shape[0] for shape in self.graphs if shape[1:] == image_shape and shape[0] >= n_images]
+        batch_size = min(batch_sizes) if batch_sizes else max(n_images, self.model.extraction_settings.batch_size)
+        graph = self.get_graph((batch_size,) + image_shape, batch.device)
+
+        if batch_size > n_images:
+            padding = batch.new_zeros((batch_size - n_images,) + image_shape)
+            batch = torch.cat([batch, padding]).contiguous(memory_format=self._get_memory_format())
+        feats = graph(batch)
+        return {layer: feats[layer][:n_images] for layer in feats}
+
+    def _get_memory_format(self):
+        if self.model.extraction_settings.memory_format == "channels_last":
+            return torch.channels_last
+        return torch.contiguous_format
@@ -2,18 +2,29 @@ import logging
 import os
 import random
 import zipfile
+from contextlib import contextmanager
 from glob import glob
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn as nn
-from tqdm import tqdm
 
-from ..utils.im import IM_EXTENSIONS, ResizeDataset, denormalise_tensors
+from ..utils.cache import get_artifact
+from ..utils.im import (
+    IM_EXTENSIONS,
+    ArrayBatchDataset,
+    ArrayBatchLoader,
+    DataLoaderPool,
+    ImageReservoir,
+    ResizeDataset,
+    denormalise_tensors,
+)
+from ..utils.io import activation_ranges_to_arrays, load_activation_ranges
+from ..utils.profiling import ExtractionProfiler, format_profile_report
 from ..utils.settings import ExtractionSettings, NetworkSettings
-from ..utils.stats import histogram_per_channel
+from ..utils.stats import StreamingQuantiles, get_hist_bin_params, histogram_per_channel_from_bin_params
 
 
 def get_min_max_features(acc_feats, feats, layer):
@@ -48,28 +59,116 @@ def get_min_max_features(acc_feats, feats, layer):
     return acc_feats
 
 
+def accumulate_histograms(
+    acc_hist: Optional[torch.Tensor],
+    hist: torch.Tensor,
+    accumulation_dtype: str = "int64",
+    n_values_per_neuron: Optional[int] = None,
+) -> torch.Tensor:
+    """Add the histogram counts of a batch to the accumulated counts.
+
+    Counts accumulated in int32 are promoted to int64 when they could overflow, which is known without reading the
+    counts from n_values_per_neuron, the number of values put in the histogram of each neuron so far, this batch
+    included. Without it, the largest counts are compared instead. Counts accumulated in int64 are not checked, as
+    they would need more than 2**63 activations per neuron to overflow.
+    """
+    assert accumulation_dtype in ["int32", "int64"], f"Unknown histogram accumulation dtype {accumulation_dtype}"
+    if acc_hist is None:
+        # If first batch, then just keep the histogram
+        return hist.to(getattr(torch, accumulation_dtype))
+
+    if acc_hist.dtype == torch.int32:
+        max_count = torch.iinfo(torch.int32).max
+        if n_values_per_neuron is not None:
+            overflows = n_values_per_neuron > max_count
+        else:
+            overflows = hist.numel() > 0 and acc_hist.max() > max_count - hist.max()
+        if overflows:
+            logging.warning("Histogram counts could overflow int32, accumulating them in int64 instead")
+            acc_hist = acc_hist.to(torch.int64)
+    acc_hist += hist.to(acc_hist.dtype)
+    return acc_hist
+
+
+def set_num_threads(num_threads: int = 0, num_interop_threads: int = 0):
+    """Set the number of threads used by torch within and between operations. Values of 0 keep the current setting."""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0 and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Inter-op threads can only be set before torch runs any parallel work in the process
+            logging.warning(
+                f"Could not set the number of inter-op threads to {num_interop_threads}, keeping "
+                f"{torch.get_num_interop_threads()}. Set it before any other torch computation."
+            )
+
+
+def prefetch_to_device(batches: Iterable[torch.Tensor], device: torch.device) -> Iterator[torch.Tensor]:
+    """Copy the next batch to the CUDA device on a side stream while the current batch is being processed.
+
+    Copies only overlap with computations if batches are in pinned memory.
+
+    Args:
+        batches (iterable): Batches of images on the host.
+        device (torch.device): CUDA device to copy batches to.
+
+    Yields:
+        torch.Tensor: Batches on the device, ready to be used on the current stream.
+    """
+    copy_stream = torch.cuda.Stream(device=device)
+    current_batch = None
+    for batch in batches:
+        with torch.cuda.stream(copy_stream):
+            next_batch = batch.to(device, non_blocking=True)
+        if current_batch is not None:
+            yield current_batch
+        torch.cuda.current_stream(device).wait_stream(copy_stream)
+        next_batch.record_stream(torch.cuda.current_stream(device))
+        current_batch = next_batch
+    if current_batch is not None:
+        yield current_batch
+
+
+@contextmanager
+def forward_context(device_type: str, use_bf16: bool = False):
+    # Context in which networks compute features: without autograd, and with bfloat16 autocast if enabled
+    with torch.inference_mode(), torch.autocast(device_type, dtype=torch.bfloat16, enabled=use_bf16):
+        yield
+
+
+def iter_in_context(iterator: Iterable, context_fn) -> Iterator:
+    """Run each step of an iterator in a new context from context_fn, leaving the code consuming its items outside."""
+    iterator = iter(iterator)
+    while True:
+        with context_fn():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
 def get_pre_hist_norm_params_from_min_max(
-    min_max_per_neuron: Dict[str, Dict[str, Dict[int, float]]], range_scale: float, device: str = "cpu"
+    min_max_per_neuron: Dict[str, Dict[str, Union[Dict[int, float], np.ndarray]]], range_scale: float, device: str = "cpu"
 ) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
     """Get the parameters for normalisation of the histogram of the neuron activations.
 
     Args:
-        min_max_per_neuron (dict): Dictionary with the min and max activation for each neuron.
+        min_max_per_neuron (dict): Dictionary with the min and max activation for each neuron, per layer either as a
+            dict mapping neuron indices to values, or as an array.
         range_scale (float): Scaling to apply to the range boundaries before finding normalisation parameters.
 
     Returns:
         dict: Dictionary with the mean and std tensors to apply to each layer
     """
+    min_max_per_neuron = activation_ranges_to_arrays(min_max_per_neuron)
     norm_means_per_layer = {}
     norm_stds_per_layer = {}
-    for layer in min_max_per_neuron["mins_per_neuron"]:
-        min_activations = []
-        max_activations = []
-        for neuron in min_max_per_neuron["mins_per_neuron"][layer]:
-            min_activations.append(min_max_per_neuron["mins_per_neuron"][layer][neuron] * range_scale)
-            max_activations.append(min_max_per_neuron["maxs_per_neuron"][layer][neuron] * range_scale)
-        min_activations = torch.DoubleTensor(min_activations)
-        max_activations = torch.DoubleTensor(max_activations)
+    for layer, mins in min_max_per_neuron["mins_per_neuron"].items():
+        min_activations = torch.from_numpy(mins).double() * range_scale
+        max_activations = torch.from_numpy(min_max_per_neuron["maxs_per_neuron"][layer]).double() * range_scale
         mean = (min_activations + max_activations) / 2
         std = (max_activations - min_activations) / 2 + 1e-8
         norm_means_per_layer[layer] = mean.reshape(1, -1, 1, 1).to(device)
@@ -77,6 +176,80 @@ def get_pre_hist_norm_params_from_min_max(
     return norm_means_per_layer, norm_stds_per_layer
 
 
+# Activation range assumed for all neurons of randomly initialised networks, whose ranges were never measured
+PLACEHOLDER_ACTIVATION_RANGE = (-1.0, 1.0)
+
+
+def load_network_activation_ranges(source: str, extraction_settings: ExtractionSettings) -> Dict:
+    """Load the activation ranges measured for a pretrained network, from a source as given to get_artifact.
+
+    Randomly initialised networks (pretrained=False in the extraction settings) do not load any file, and are given
+    placeholder ranges by FeatureExtractionModel instead.
+    """
+    if not extraction_settings.pretrained:
+        return {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+    return load_activation_ranges(get_artifact(source, extraction_settings))
+
+
+def get_placeholder_activation_ranges(neurons_per_layer: Dict[str, int]) -> Dict:
+    low, high = PLACEHOLDER_ACTIVATION_RANGE
+    return {
+        "mins_per_neuron": {layer: np.full(n, low, dtype=np.float32) for layer, n in neurons_per_layer.items()},
+        "maxs_per_neuron": {layer: np.full(n, high, dtype=np.float32) for layer, n in neurons_per_layer.items()},
+    }
+
+
+def get_files_list(data_settings, seed: int = 0, verbose: bool = False) -> List[str]:
+    # get all relevant files in the dataset
+    if isinstance(data_settings.source, List):
+        # Check that all files exists and are images using pathlib
+        for file in data_settings.source:
+            assert Path(file).is_file(), f"File {file} does not exist"
+            assert file.split(".")[-1] in IM_EXTENSIONS, f"File {file} is not an image"
+        files = data_settings.source
+    elif data_settings.source.split(".")[-1] in IM_EXTENSIONS:
+        files = [data_settings.source]
+    elif data_settings.source.split(".")[-1] == "txt":
+        files = []
+        # Read the text file
+        with open(data_settings.source, "r") as f:
+            for line in f:
+                files.append(line.strip())
+                # If path is relative, make it absolute using the directory of the text file
+                if not os.path.isabs(files[-1]):
+                    files[-1] = os.path.join(os.path.abspath(os.path.dirname(data_settings.source)), files[-1])
+                # Check if the file is an image
+                assert files[-1].split(".")[-1] in IM_EXTENSIONS, f"File {files[-1]} is not an image"
+                # Check if the file exists
+                assert os.path.exists(files[-1]), f"File {files[-1]} does not exist"
+        # Sort files
+        files = sorted(files)
+    elif ".zip" in data_settings.source:
+        files = list(set(zipfile.ZipFile(data_settings.source).namelist()))
+        # remove the non-image files inside the zip
+        files = [x for x in files if os.path.splitext(x)[1].lower()[1:] in IM_EXTENSIONS]
+    else:
+        files = sorted(
+            [
+                file
+                for ext in IM_EXTENSIONS
+                for file in glob(os.path.join(data_settings.source, f"**/*.{ext}"), recursive=True)
+            ]
+        )
+
+    if verbose:
+        print(f"Found {len(files)} images in the provided source")
+    # use a subset number of files if needed
+    if data_settings.num_images > 0 and data_settings.num_images < len(files):
+        if data_settings.shuffle_files:
+            random.seed(seed)
+            random.shuffle(files)
+        files = files[: data_settings.num_images]
+    if verbose:
+        print(f"Using {len(files)} images")
+    return files
+
+
 class FeatureExtractionModel(nn.Module):
     def __init__(
         self,
@@ -87,27 +260,126 @@ class FeatureExtractionModel(nn.Module):
         super(FeatureExtractionModel, self).__init__()
         self.network_settings = network_settings
         self.extraction_settings = extraction_settings
+        if not extraction_settings.pretrained:
+            activation_ranges_per_neuron = get_placeholder_activation_ranges(network_settings.neurons_per_layer)
         self.norm_means_per_layer, self.norm_stds_per_layer = get_pre_hist_norm_params_from_min_max(
             activation_ranges_per_neuron,
             self.extraction_settings.range_scale_for_norm_params,
             device=self.extraction_settings.device,
         )
         self.name = "not_set"
+        # Set by get_feature_extractor to compute features with a compiled or exported graph instead of get_features
+        self.backend_forward = None
+        # Report of the stages of the last extraction, when profiling is enabled in the extraction settings
+        self.last_profile_report = None
 
     def get_features(self, batch):
         raise NotImplementedError
 
+    def iter_features(self, batch):
+        """
+        Yield the features of each layer for a batch of images, as (layer, features) pairs.
+
+        Networks can override it to produce the features of each layer as they run, so that extraction only keeps the
+        features of one layer at a time. By default, features of all layers are computed with get_features and released
+        one by one once they are consumed.
+        """
+        feats = self.get_features(batch)
+        for layer in list(feats):
+            yield layer, feats.pop(layer)
+
+    def get_norm_params(self, layer: str, norm_params: Optional[Tuple[Dict, Dict]] = None):
+        # Normalisation parameters of a layer, from the activation ranges of the network unless others are given
+        norm_means_per_layer, norm_stds_per_layer = (
+            norm_params if norm_params is not None else (self.norm_means_per_layer, self.norm_stds_per_layer)
+        )
+        return norm_means_per_layer[layer], norm_stds_per_layer[layer]
+
+    def get_hist_bin_params(
+        self,
+        layer: str,
+        dtype: torch.dtype,
+        device: torch.device,
+        norm_params: Optional[Tuple[Dict, Dict]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Scale and offset mapping activations of a layer to histogram bins, normalising them first if needed
+        if self.extraction_settings.normalise_feats:
+            norm_mean, norm_std = self.get_norm_params(layer, norm_params)
+        else:
+            norm_mean, norm_std = torch.zeros(1, 1, 1, 1), torch.ones(1, 1, 1, 1)
+        scale, offset = get_hist_bin_params(
+            norm_mean, norm_std, self.extraction_settings.hist_nb_bins, self.extraction_settings.hist_range, dtype
+        )
+        return scale.to(device), offset.to(device)
+
+    def get_hist_bin_ranges(self, norm_params: Optional[Tuple[Dict, Dict]] = None) -> Dict[str, torch.Tensor]:
+        # Lower and upper edges of the histogram bins of each neuron in activation units, as (neurons, 2) tensors
+        hist_range = torch.tensor(self.extraction_settings.hist_range, dtype=torch.double)
+        if not self.extraction_settings.normalise_feats:
+            return {
+                layer: hist_range.float().expand(n_neurons, 2)
+                for layer, n_neurons in self.network_settings.neurons_per_layer.items()
+            }
+
+        norm_means_per_layer, norm_stds_per_layer = (
+            norm_params if norm_params is not None else (self.norm_means_per_layer, self.norm_stds_per_layer)
+        )
+        bin_ranges = {}
+        for layer in norm_means_per_layer:
+            norm_mean = norm_means_per_layer[layer].double().cpu().reshape(-1, 1)
+            norm_std = norm_stds_per_layer[layer].double().cpu().reshape(-1, 1)
+            bin_ranges[layer] = (norm_mean + norm_std * hist_range).float()
+        return bin_ranges
+
     """
     Compute the features for a batch of images. Should return a dict with features at each layer.
     """
 
+    def batch_to_device(self, batch, device):
+        memory_format = (
+            torch.channels_last if self.extraction_settings.memory_format == "channels_last" else torch.contiguous_format
+        )
+        return batch.to(device, non_blocking=self.extraction_settings.pin_memory, memory_format=memory_format)
+
+    def iter_batch_features(self, batch, device):
+        batch = self.batch_to_device(batch, device)
+        if self.backend_forward is None:
+            yield from self.iter_features(batch)
+            return
+        # Compiled and exported graphs give the features of all layers at once
+        feats = self.backend_forward(batch)
+        for layer in list(feats):
+            yield layer, feats.pop(layer)
+
     def get_batch_features(self, batch, device):
-        return self.get_features(batch.to(device))
+        return dict(self.iter_batch_features(batch, device))
 
-    def get_dataloader(self, data_settings):
-        # Check if data_settings.source is a list of np arrays
-        if isinstance(data_settings.source, List) and isinstance(data_settings.source[0], np.ndarray):
-            images = data_settings.source
+    def get_dataloader(self, data_settings, dataloader_pool: Optional[DataLoaderPool] = None):
+        source = data_settings.source
+        if isinstance(source, (np.ndarray, torch.Tensor)):
+            if (
+                data_settings.custom_np_image_tranform is None
+                and data_settings.custom_pil_image_tranform is None
+                and data_settings.custom_fn_resize is None
+            ):
+                # Stacked images are preprocessed in batches in the main process, without copies or workers
+                dataset = ArrayBatchDataset(
+                    source,
+                    resize_mode=data_settings.resize_mode,
+                    crop_to_square_pre_resize=data_settings.crop_to_square_pre_resize,
+                    size=self.network_settings.expected_size,
+                    norm_mean=self.network_settings.norm_mean,
+                    norm_std=self.network_settings.norm_std,
+                )
+                return ArrayBatchLoader(dataset, batch_size=self.extraction_settings.batch_size)
+            # Custom transforms work on single images, so fall back to views of each image
+            if isinstance(source, torch.Tensor):
+                source = source.cpu().numpy()
+            source = list(source)
+
+        # Check if source is a list of np arrays
+        if isinstance(source, List) and isinstance(source[0], np.ndarray):
+            images = source
             l_files = None
         else:
             images = None
@@ -122,151 +394,224 @@ class FeatureExtractionModel(nn.Module):
             norm_mean=self.network_settings.norm_mean,
             norm_std=self.network_settings.norm_std,
         )
+        has_custom_transforms = False
         if data_settings.custom_np_image_tranform is not None:
             dataset.custom_np_image_tranform = data_settings.custom_np_image_tranform
+            has_custom_transforms = True
         if data_settings.custom_pil_image_tranform is not None:
             dataset.custom_pil_image_tranform = data_settings.custom_pil_image_tranform
+            has_custom_transforms = True
         if data_settings.custom_fn_resize is not None:
             dataset.fn_resize = data_settings.custom_fn_resize
+            has_custom_transforms = True
+
+        num_workers = self.extraction_settings.num_workers
+        if (
+            dataloader_pool is not None
+            and self.extraction_settings.persistent_workers
+            and num_workers > 0
+            and l_files is not None
+            and not has_custom_transforms
+        ):
+            # Workers can be reused as long as the preprocessing they apply is the same
+            preprocessing_key = (
+                data_settings.resize_mode,
+                data_settings.crop_to_square_pre_resize,
+                tuple(self.network_settings.expected_size),
+                tuple(self.network_settings.norm_mean),
+                tuple(self.network_settings.norm_std),
+            )
+            return dataloader_pool.get_dataloader(
+                dataset,
+                preprocessing_key,
+                batch_size=self.extraction_settings.batch_size,
+                num_workers=num_workers,
+                pin_memory=self.extraction_settings.pin_memory,
+                prefetch_factor=self.extraction_settings.prefetch_factor,
+            )
 
         dataloader = torch.utils.data.DataLoader(
             dataset,
             batch_size=self.extraction_settings.batch_size,
             shuffle=False,
             drop_last=False,
-            num_workers=self.extraction_settings.num_workers,
+            num_workers=num_workers,
+            pin_memory=self.extraction_settings.pin_memory,
+            prefetch_factor=self.extraction_settings.prefetch_factor if num_workers > 0 else None,
         )
 
         return dataloader
 
-    def get_data_features(self, data_settings):
-        dataloader = self.get_dataloader(data_settings)
+    def get_data_features(
+        self,
+        data_settings,
+        dataloader_pool: Optional[DataLoaderPool] = None,
+        norm_params: Optional[Tuple[Dict, Dict]] = None,
+    ):
+        # norm_params optionally replaces the normalisation parameters from the activation ranges of the network, as
+        # dicts of means and stds per layer
+        dataloader = self.get_dataloader(data_settings, dataloader_pool)
         # wrap the images in a dataloader for parallelizing the resize operation
         if (
             not self.extraction_settings.average_feats_spatially
             and not self.extraction_settings.accumulate_spatial_feats_in_hist
             and not self.extraction_settings.keep_only_min_max
+            and not self.extraction_settings.keep_quantile_sketch
         ):
             logging.warning(
                 "Will try to accumulate all features from dataset with no spatial reduction, expect huge RAM usage if using many images!"
             )
 
         device = torch.device(self.extraction_settings.device)
+        assert self.extraction_settings.precision in ["fp32", "bf16"], "Precision must be fp32 or bf16"
+        assert self.extraction_settings.memory_format in [
+            "contiguous",
+            "channels_last",
+        ], "Memory format must be contiguous or channels_last"
+        set_num_threads(self.extraction_settings.num_threads, self.extraction_settings.num_interop_threads)
+        use_bf16 = self.extraction_settings.precision == "bf16"
 
         # collect all features
         acc_feats = {}
         if self.extraction_settings.verbose:
+            from tqdm import tqdm
+
             pbar = tqdm(dataloader, desc=self.extraction_settings.description)
         else:
             pbar = dataloader
 
-        for batch in pbar:
-            with torch.no_grad():
-                feats = self.get_batch_features(batch, device)
-
-            if self.extraction_settings.average_feats_spatially:
-                for layer in feats:
-                    feats[layer] = torch.mean(feats[layer], dim=(2, 3), keepdim=True)
+        if device.type == "cuda" and self.extraction_settings.pin_memory:
+            pbar = prefetch_to_device(pbar, device)
+
+        # Sample images are taken from the batches going through the loop rather than loaded again at the end
+        image_reservoir = ImageReservoir(self.extraction_settings.n_sample_images, seed=self.extraction_settings.seed)
+
+        hist_bin_params = {}
+        n_values_per_neuron = {}
+        profiler = ExtractionProfiler(device, enabled=self.extraction_settings.profile)
+        profiler.start()
+
+        for batch in profiler.iterate(pbar, "data_loading"):
+            profiler.next_batch(len(batch))
+            image_reservoir.add_batch(batch)
+            with profiler.stage("host_to_device"):
+                batch = self.batch_to_device(batch, device)
+            # Features of each layer are consumed as soon as the network produces them, and released before the next
+            # layer is computed, so that only one layer of features is kept in memory at a time
+            batch_feats = iter_in_context(
+                self.iter_batch_features(batch, device), lambda: forward_context(device.type, use_bf16)
+            )
+            for layer, feats in profiler.iterate(batch_feats, "forward", get_layer=lambda layer_feats: layer_feats[0]):
+                profiler.record_layer_features(layer, feats)
+                acc_feats = self.accumulate_layer_features(
+                    acc_feats, layer, feats, hist_bin_params, norm_params, profiler, n_values_per_neuron
+                )
+                del feats
+
+        acc_feats = self.finalize_features(acc_feats)
+
+        profiler.stop(acc_feats)
+        self.last_profile_report = profiler.report() if profiler.enabled else None
+        if profiler.enabled:
+            if self.extraction_settings.profile_trace_path:
+                profiler.save_chrome_trace(self.extraction_settings.profile_trace_path)
+            if self.extraction_settings.verbose:
+                print(format_profile_report(self.last_profile_report))
 
-            if self.extraction_settings.normalise_feats:
-                for layer in feats:
-                    feats[layer] = (feats[layer] - self.norm_means_per_layer[layer]) / self.norm_stds_per_layer[layer]
+        dataset = dataloader.dataset
 
-            if (
-                self.extraction_settings.accumulate_spatial_feats_in_hist
-                or self.extraction_settings.accumulate_sample_feats_in_hist
-            ):
-                for layer in feats:
-                    feats[layer] = histogram_per_channel(
-                        feats[layer],
-                        hist_nb_bins=self.extraction_settings.hist_nb_bins,
-                        hist_range=self.extraction_settings.hist_range,
-                    )
-
-            for layer in feats:
-                if (
-                    not self.extraction_settings.accumulate_sample_feats_in_hist
-                    and not self.extraction_settings.keep_only_min_max
-                ):
-                    # Keep all features for each batch in a list
-                    acc_feats[layer] = acc_feats.get(layer, []) + [feats[layer]]
-                elif self.extraction_settings.keep_only_min_max:
-                    # Keep only min and max features over all samples
-                    acc_feats = get_min_max_features(acc_feats, feats, layer)
-                else:
-                    # Accumulate histograms
-                    if layer in acc_feats:
-                        # Sum the histograms over all samples
-                        acc_feats[layer] += feats[layer]
-                    else:
-                        # If first batch, then just keep the histogram
-                        acc_feats[layer] = feats[layer]
+        sample_images = denormalise_tensors(
+            image_reservoir.images, self.network_settings.norm_mean, self.network_settings.norm_std
+        )
+        return acc_feats, len(dataset), sample_images
 
+    def finalize_features(self, acc_feats: Dict) -> Dict:
+        # Features kept for each batch are concatenated. Histograms, min and max values and sketches are already complete.
         if (
             not self.extraction_settings.accumulate_sample_feats_in_hist
             and not self.extraction_settings.keep_only_min_max
+            and not self.extraction_settings.keep_quantile_sketch
         ):
             acc_feats = {layer: torch.cat(acc_feats[layer]) for layer in acc_feats}
+        return acc_feats
 
-        dataset = dataloader.dataset
-
-        n_sample_ims = min(len(dataset), self.extraction_settings.n_sample_images)
+    def accumulate_layer_features(
+        self,
+        acc_feats: Dict,
+        layer: str,
+        feats: torch.Tensor,
+        hist_bin_params: Dict,
+        norm_params: Optional[Tuple[Dict, Dict]] = None,
+        profiler: Optional[ExtractionProfiler] = None,
+        n_values_per_neuron: Optional[Dict[str, int]] = None,
+    ) -> Dict:
+        # Reduce the features of a layer for a batch as set in the extraction settings, and add them to acc_feats.
+        # hist_bin_params caches the histogram bin parameters of each layer between batches. n_values_per_neuron
+        # counts the activations put in the histogram of each neuron, to know when int32 counts could overflow.
+        if profiler is None:
+            profiler = ExtractionProfiler(enabled=False)
+
+        with profiler.stage("reduction", layer):
+            if self.extraction_settings.precision == "bf16":
+                # Only the network runs in bfloat16, statistics are computed in float32
+                feats = feats.float()
 
-        sample_images = [dataset[i] for i in random.sample(range(len(dataset)), n_sample_ims)]
-        sample_images = denormalise_tensors(
-            sample_images, self.network_settings.norm_mean, self.network_settings.norm_std
-        )
-        return acc_feats, len(dataset), sample_images
+            if self.extraction_settings.average_feats_spatially:
+                feats = torch.mean(feats, dim=(2, 3), keepdim=True)
 
-    def get_files_list(self, data_settings):
-        # get all relevant files in the dataset
-        if isinstance(data_settings.source, List):
-            # Check that all files exists and are images using pathlib
-            for file in data_settings.source:
-                assert Path(file).is_file(), f"File {file} does not exist"
-                assert file.split(".")[-1] in IM_EXTENSIONS, f"File {file} is not an image"
-            files = data_settings.source
-        elif data_settings.source.split(".")[-1] in IM_EXTENSIONS:
-            files = [data_settings.source]
-        elif data_settings.source.split(".")[-1] == "txt":
-            files = []
-            # Read the text file
-            with open(data_settings.source, "r") as f:
-                for line in f:
-                    files.append(line.strip())
-                    # If path is relative, make it absolute using the directory of the text file
-                    if not os.path.isabs(files[-1]):
-                        files[-1] = os.path.join(os.path.abspath(os.path.dirname(data_settings.source)), files[-1])
-                    # Check if the file is an image
-                    assert files[-1].split(".")[-1] in IM_EXTENSIONS, f"File {files[-1]} is not an image"
-                    # Check if the file exists
-                    assert os.path.exists(files[-1]), f"File {files[-1]} does not exist"
-            # Sort files
-            files = sorted(files)
-        elif ".zip" in data_settings.source:
-            files = list(set(zipfile.ZipFile(data_settings.source).namelist()))
-            # remove the non-image files inside the zip
-            files = [x for x in files if os.path.splitext(x)[1].lower()[1:] in IM_EXTENSIONS]
+        if (
+            self.extraction_settings.accumulate_spatial_feats_in_hist
+            or self.extraction_settings.accumulate_sample_feats_in_hist
+        ):
+            # Activations are mapped straight to bins, normalisation included, without intermediate copies
+            with profiler.stage("histogram", layer):
+                if n_values_per_neuron is not None:
+                    n_values_per_neuron[layer] = n_values_per_neuron.get(layer, 0) + feats.numel() // feats.shape[1]
+                if layer not in hist_bin_params:
+                    hist_bin_params[layer] = self.get_hist_bin_params(layer, feats.dtype, feats.device, norm_params)
+                feats = histogram_per_channel_from_bin_params(
+                    feats,
+                    *hist_bin_params[layer],
+                    hist_nb_bins=self.extraction_settings.hist_nb_bins,
+                    chunk_size=self.extraction_settings.hist_chunk_size,
+                )
+        elif self.extraction_settings.normalise_feats:
+            with profiler.stage("normalisation", layer):
+                norm_mean, norm_std = self.get_norm_params(layer, norm_params)
+                feats = (feats - norm_mean.to(feats.dtype)) / norm_std.to(feats.dtype)
+
+        with profiler.stage("accumulation", layer):
+            n_values = n_values_per_neuron.get(layer) if n_values_per_neuron is not None else None
+            acc_feats = self._accumulate_reduced_features(acc_feats, layer, feats, n_values)
+        return acc_feats
+
+    def _accumulate_reduced_features(
+        self, acc_feats: Dict, layer: str, feats: torch.Tensor, n_values_per_neuron: Optional[int] = None
+    ) -> Dict:
+        if (
+            not self.extraction_settings.accumulate_sample_feats_in_hist
+            and not self.extraction_settings.keep_only_min_max
+            and not self.extraction_settings.keep_quantile_sketch
+        ):
+            # Keep all features for each batch in a list
+            acc_feats[layer] = acc_feats.get(layer, []) + [feats]
+        elif self.extraction_settings.keep_only_min_max:
+            # Keep only min and max features over all samples
+            acc_feats = get_min_max_features(acc_feats, {layer: feats}, layer)
+        elif self.extraction_settings.keep_quantile_sketch:
+            # Keep a fixed-size summary of the distribution of each neuron over all samples and locations
+            if layer not in acc_feats:
+                acc_feats[layer] = StreamingQuantiles(n_levels=self.extraction_settings.quantile_sketch_levels)
+            acc_feats[layer].update(feats)
         else:
-            files = sorted(
-                [
-                    file
-                    for ext in IM_EXTENSIONS
-                    for file in glob(os.path.join(data_settings.source, f"**/*.{ext}"), recursive=True)
-                ]
+            # Sum the histograms over all samples
+            acc_feats[layer] = accumulate_histograms(
+                acc_feats.get(layer), feats, self.extraction_settings.hist_accumulation_dtype, n_values_per_neuron
             )
+        return acc_feats
 
-        if self.extraction_settings.verbose:
-            print(f"Found {len(files)} images in the provided source")
-        # use a subset number of files if needed
-        if data_settings.num_images > 0 and data_settings.num_images < len(files):
-            if data_settings.shuffle_files:
-                random.seed(self.extraction_settings.seed)
-                random.shuffle(files)
-            files = files[: data_settings.num_images]
-        if self.extraction_settings.verbose:
-            print(f"Using {len(files)} images")
-        return files
+    def get_files_list(self, data_settings):
+        return get_files_list(data_settings, self.extraction_settings.seed, self.extraction_settings.verbose)
 
     def forward(self, x):
-        self.get_features(x)
+        return self.get_features(x)
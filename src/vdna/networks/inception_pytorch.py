@@ -7,20 +7,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
-
-try:
-    from torchvision.models.utils import load_state_dict_from_url
-except ImportError:
-    from torch.utils.model_zoo import load_url as load_state_dict_from_url
-
-# Inception weights ported to Pytorch from
-# http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
-FID_WEIGHTS_URL = "https://github.com/mseitzer/pytorch-fid/releases/download/fid_weights/pt_inception-2015-12-05-6726825d.pth"  # noqa: E501
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 
 class InceptionV3(FeatureExtractionModel):
@@ -76,17 +67,10 @@ class InceptionV3(FeatureExtractionModel):
             strongly advised to set this parameter to true to get comparable
             results.
         """
-        activation_ranges = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename="Inception/inception_v3/activation_ranges.json"
-        )
-        min_max_act_per_neuron = load_dict(activation_ranges)
-        network_settings = NetworkSettings(
-            [0.5, 0.5, 0.5],
-            [0.5, 0.5, 0.5],
-            {"block_0": 64, "block_1": 192, "block_2": 768, "block_3": 2048},
-            (299, 299),
-            "inception_v3",
+        min_max_act_per_neuron = load_network_activation_ranges(
+            "hf://Inception/inception_v3/activation_ranges.json", extraction_settings
         )
+        network_settings = get_network_settings("inception")
         super(InceptionV3, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
 
         self.resize_input = resize_input
@@ -98,10 +82,15 @@ class InceptionV3(FeatureExtractionModel):
 
         self.blocks = nn.ModuleList()
 
-        if use_fid_inception:
-            inception = fid_inception_v3()
+        # Weights are loaded through the artifact cache, so that they can be used offline
+        if not extraction_settings.pretrained:
+            inception = fid_inception_v3() if use_fid_inception else torchvision_inception_v3()
+        elif use_fid_inception:
+            weights_source = get_extractor_spec("inception").weights_source
+            inception = fid_inception_v3(get_artifact(weights_source, extraction_settings))
         else:
-            inception = _inception_v3(pretrained=True)
+            weights_url = torchvision.models.Inception_V3_Weights.IMAGENET1K_V1.url
+            inception = torchvision_inception_v3(get_artifact(weights_url, extraction_settings))
 
         # Block 0: input to maxpool1
         block0 = [
@@ -156,7 +145,10 @@ class InceptionV3(FeatureExtractionModel):
         List of torch.autograd.Variable, corresponding to the selected output
         block, sorted ascending by index
         """
-        outp = {}
+        return dict(self.iter_features(inp))
+
+    def iter_features(self, inp):
+        # Outputs of the selected blocks, yielded as soon as they are computed
         x = inp
 
         if self.resize_input:
@@ -170,17 +162,13 @@ class InceptionV3(FeatureExtractionModel):
         for idx, block in enumerate(self.blocks):
             x = block(x)
             if idx in self.output_blocks:
-                outp["block_" + str(idx)] = x
+                yield "block_" + str(idx), x
 
             if idx == self.last_needed_block:
                 break
 
-        return outp
-
     def get_features(self, batch):
-        out = self.forward(batch)
-        out = {layer: out[layer] for layer in out}
-        return out
+        return self.forward(batch)
 
 
 def _inception_v3(*args, **kwargs):
@@ -200,14 +188,27 @@ def _inception_v3(*args, **kwargs):
     return torchvision.models.inception_v3(*args, **kwargs)
 
 
-def fid_inception_v3():
-    """Build pretrained Inception model for FID computation
+def torchvision_inception_v3(weights_path=None):
+    """Build torchvision's Inception model
+    The ImageNet weights are loaded from weights_path if given, with the
+    input transform torchvision uses with them.
+    """
+    if weights_path is None:
+        return _inception_v3()
+    inception = _inception_v3(transform_input=True)
+    inception.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    return inception
+
+
+def fid_inception_v3(weights_path=None):
+    """Build Inception model for FID computation
     The Inception model for FID computation uses a different set of weights
     and has a slightly different structure than torchvision's Inception.
     This method first constructs torchvision's Inception and then patches the
-    necessary parts that are different in the FID Inception model.
+    necessary parts that are different in the FID Inception model. The FID
+    weights are loaded from weights_path if given.
     """
-    inception = _inception_v3(num_classes=1008, aux_logits=False, pretrained=False)
+    inception = _inception_v3(num_classes=1008, aux_logits=False)
     inception.Mixed_5b = FIDInceptionA(192, pool_features=32)
     inception.Mixed_5c = FIDInceptionA(256, pool_features=64)
     inception.Mixed_5d = FIDInceptionA(288, pool_features=64)
@@ -217,9 +218,10 @@ def fid_inception_v3():
     inception.Mixed_6e = FIDInceptionC(768, channels_7x7=192)
     inception.Mixed_7b = FIDInceptionE_1(1280)
     inception.Mixed_7c = FIDInceptionE_2(2048)
+    if weights_path is None:
+        return inception
 
-    state_dict = load_state_dict_from_url(FID_WEIGHTS_URL, progress=False, map_location="cpu")
-    inception.load_state_dict(state_dict)
+    inception.load_state_dict(torch.load(weights_path, map_location="cpu"))
     return inception
 
 
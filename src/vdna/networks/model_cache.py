@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from ..utils.settings import ExtractionSettings
+
+# Extraction settings used when building a network. Other settings (batch size, verbosity, distribution specific
+# flags, ...) can change from one extraction to the next without rebuilding the network.
+NETWORK_EXTRACTION_SETTINGS = (
+    "device",
+    "memory_format",
+    "backend",
+    "hub_repo",
+    "pretrained",
+    "range_scale_for_norm_params",
+    "weights_path",
+    "activation_ranges_path",
+    "calibration_source",
+    "calibration_num_images",
+)
+
+
+def get_model_cache_key(feat_extractor_name: str, extraction_settings: ExtractionSettings) -> Tuple:
+    return (feat_extractor_name,) + tuple(
+        str(getattr(extraction_settings, field)) for field in NETWORK_EXTRACTION_SETTINGS
+    )
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    # Models wrapped by torch.compile keep the original module in _orig_mod
+    return getattr(model, "_orig_mod", model)
+
+
+def get_model_memory_size(model: nn.Module) -> int:
+    """Get the memory used by the parameters and buffers of a model, in bytes."""
+    model = unwrap_model(model)
+    size = sum(p.numel() * p.element_size() for p in model.parameters())
+    size += sum(b.numel() * b.element_size() for b in model.buffers())
+    for params_per_layer in [
+        getattr(model, "norm_means_per_layer", {}),
+        getattr(model, "norm_stds_per_layer", {}),
+    ]:
+        size += sum(p.numel() * p.element_size() for p in params_per_layer.values())
+    return size
+
+
+class ModelCache:
+    """
+    Least recently used cache of feature extractors, keyed by name and by the extraction settings used to build them.
+
+    Args:
+        max_models (int or None): Maximum number of models kept. If None, the number of models is not limited.
+        max_memory_mb (float or None): Maximum memory used by the parameters and buffers of the kept models, in MB.
+            The least recently used models are evicted first. The most recent model is always kept, even if it
+            alone exceeds the limit. If None, memory is not limited.
+    """
+
+    def __init__(self, max_models: Optional[int] = None, max_memory_mb: Optional[float] = None):
+        self.max_models = max_models
+        self.max_memory_mb = max_memory_mb
+        self.models = OrderedDict()
+        self.memory_sizes = {}
+
+    def __len__(self):
+        return len(self.models)
+
+    @property
+    def memory_used_mb(self) -> float:
+        return sum(self.memory_sizes.values()) / 2**20
+
+    def get(self, feat_extractor_name: str, extraction_settings: ExtractionSettings) -> Optional[nn.Module]:
+        key = get_model_cache_key(feat_extractor_name, extraction_settings)
+        if key not in self.models:
+            return None
+        self.models.move_to_end(key)
+        return self.models[key]
+
+    def add(self, feat_extractor_name: str, extraction_settings: ExtractionSettings, model: nn.Module):
+        key = get_model_cache_key(feat_extractor_name, extraction_settings)
+        self.models[key] = model
+        self.models.move_to_end(key)
+        self.memory_sizes[key] = get_model_memory_size(model)
+        self._enforce_limits()
+
+    def evict(self, feat_extractor_name: Optional[str] = None, device: Optional[str] = None) -> int:
+        """
+        Evict models from the cache.
+
+        Args:
+            feat_extractor_name (str or None): Only evict models with this name. If None, models with any name are evicted.
+            device (str or None): Only evict models on this device. If None, models on any device are evicted.
+
+        Returns:
+            int: Number of evicted models.
+        """
+        keys = [
+            key
+            for key in self.models
+            if (feat_extractor_name is None or key[0] == feat_extractor_name)
+            and (device is None or key[1 + NETWORK_EXTRACTION_SETTINGS.index("device")] == str(device))
+        ]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def _remove(self, key: Tuple):
+        del self.models[key]
+        del self.memory_sizes[key]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _enforce_limits(self):
+        while len(self.models) > 1 and (
+            (self.max_models is not None and len(self.models) > self.max_models)
+            or (self.max_memory_mb is not None and self.memory_used_mb > self.max_memory_mb)
+        ):
+            self._remove(next(iter(self.models)))
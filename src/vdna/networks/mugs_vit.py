@@ -27,11 +27,11 @@ from functools import partial
 
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
@@ -374,15 +374,16 @@ class VisionTransformer(nn.Module):
         x = x + self.interpolate_pos_encoding(x, w, h)
         return self.pos_drop(x)
 
-    def forward(self, x):
-        all_feats = []
+    def iter_feats(self, x):
+        # Outputs of each block and of the last norm, yielded as soon as they are computed
         x = self.prepare_tokens(x)
         for blk in self.blocks:
             x = blk(x)
-            all_feats.append(x)
-        x = self.norm(x)
-        all_feats.append(x)
-        return all_feats
+            yield x
+        yield self.norm(x)
+
+    def forward(self, x):
+        return list(self.iter_feats(x))
 
     def forward_knn(self, x):
         x = self.prepare_tokens(x)
@@ -480,35 +481,17 @@ class MugsViTFeatExtractor(FeatureExtractionModel):
         model_version,
         extraction_settings=ExtractionSettings(),
     ):
-        if model_version == "small":
-            depth = 12
-            n_neurons_per_layer = 384
-        elif model_version == "base":
-            depth = 12
-            n_neurons_per_layer = 768
-        elif model_version == "large":
-            depth = 24
-            n_neurons_per_layer = 1024
-        else:
+        if model_version not in ("small", "base", "large"):
             raise ValueError("Unsupported Mugs ViT version{}".format(model_version))
 
         if model_version == "base" or model_version == "large":
-            activation_ranges = hf_hub_download(
-                repo_id=extraction_settings.hub_repo, filename=f"Mugs/mugs_vit_{model_version}/activation_ranges.json"
+            min_max_act_per_neuron = load_network_activation_ranges(
+                f"hf://Mugs/mugs_vit_{model_version}/activation_ranges.json", extraction_settings
             )
-            min_max_act_per_neuron = load_dict(activation_ranges)
         else:
             min_max_act_per_neuron = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
 
-        neurons_per_layer = {"block_" + str(i): n_neurons_per_layer for i in range(depth)}
-        neurons_per_layer["last_norm"] = n_neurons_per_layer
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            neurons_per_layer,
-            (224, 224),
-            "mugs_vit_" + model_version,
-        )
+        network_settings = get_network_settings("mugs_vit_" + model_version)
         super(MugsViTFeatExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
 
         if model_version == "small":
@@ -518,17 +501,18 @@ class MugsViTFeatExtractor(FeatureExtractionModel):
         if model_version == "large":
             self.model = vit_large(num_relation_blocks=1)
 
-        model_weights = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename=f"Mugs/mugs_vit_{model_version}/weights.pth"
-        )
-        self.model.load_state_dict(torch.load(model_weights)["state_dict"], strict=True)
+        if extraction_settings.pretrained:
+            weights_source = get_extractor_spec("mugs_vit_" + model_version).weights_source
+            model_weights = get_artifact(weights_source, extraction_settings)
+            self.model.load_state_dict(torch.load(model_weights)["state_dict"], strict=True)
 
         for param in self.model.parameters():
             param.requires_grad = False
 
+    def iter_features(self, x):
+        n_blocks = len(self.model.blocks)
+        for i, o in enumerate(self.model.iter_feats(x)):
+            yield ("block_" + str(i) if i < n_blocks else "last_norm"), o.permute(0, 2, 1).unsqueeze(3)
+
     def get_features(self, x):
-        out = self.model(x)
-        out = [o.permute(0, 2, 1).unsqueeze(3) for o in out]
-        out_dict = {"block_" + str(i): o for i, o in enumerate(out[:-1])}
-        out_dict["last_norm"] = out[-1]
-        return out_dict
+        return dict(self.iter_features(x))
@@ -0,0 +1,123 @@
+import logging
+from dataclasses import replace
+
+import torch
+import torch.nn as nn
+
+from ..utils.io import load_activation_ranges
+from ..utils.settings import DataSettings, ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, get_pre_hist_norm_params_from_min_max
+from .registry import QUANTIZED_SUFFIX, get_extractor_spec
+
+
+def fuse_conv_bn(module: nn.Module):
+    # Fold batch normalisations into the convolutions registered right before them, which is how ResNet blocks and
+    # downsampling layers are defined
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+    children = list(module.named_children())
+    for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and conv.out_channels == bn.num_features:
+            setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+    for child in module.children():
+        fuse_conv_bn(child)
+
+
+def wrap_convs(module: nn.Module, qconfig):
+    # Each convolution quantizes its input and dequantizes its output, so that the rest of the network, including the
+    # features it returns, stays in float32 without changing the code of the network
+    from torch.ao.quantization import QuantWrapper
+
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            wrapped = QuantWrapper(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            wrap_convs(child, qconfig)
+
+
+def quantize_dynamic_linear(model: FeatureExtractionModel) -> FeatureExtractionModel:
+    """Quantize the weights of linear layers to int8, with activations quantized on the fly."""
+    from torch.ao.quantization import quantize_dynamic
+
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def quantize_static_conv(model: FeatureExtractionModel, data_settings: DataSettings) -> FeatureExtractionModel:
+    """Quantize convolutions to int8, with activation scales calibrated on the images of data_settings."""
+    from torch.ao.quantization import convert, get_default_qconfig, prepare
+
+    fuse_conv_bn(model)
+    wrap_convs(model, get_default_qconfig(torch.backends.quantized.engine))
+    prepare(model, inplace=True)
+    device = torch.device(model.extraction_settings.device)
+    with torch.no_grad():
+        for batch in model.get_dataloader(data_settings):
+            model.get_batch_features(batch, device)
+    return convert(model, inplace=True)
+
+
+def measure_activation_ranges(model: FeatureExtractionModel, data_settings: DataSettings) -> dict:
+    """Measure the minimum and maximum activation of each neuron of a model on the images of data_settings."""
+    from ..vdnas.vdna_activation_ranges import VDNAActivationRanges
+
+    extraction_settings = model.extraction_settings
+    model.extraction_settings = replace(
+        extraction_settings,
+        average_feats_spatially=False,
+        accumulate_spatial_feats_in_hist=False,
+        accumulate_sample_feats_in_hist=False,
+        keep_only_min_max=True,
+        keep_quantile_sketch=False,
+        normalise_feats=False,
+        n_sample_images=0,
+        profile=False,
+    )
+    try:
+        features, _, _ = model.get_data_features(data_settings)
+    finally:
+        model.extraction_settings = extraction_settings
+    activation_ranges = VDNAActivationRanges()
+    activation_ranges._fit_distribution(features)
+    return {
+        "mins_per_neuron": {layer: ranges["min"].cpu().numpy() for layer, ranges in activation_ranges.data.items()},
+        "maxs_per_neuron": {layer: ranges["max"].cpu().numpy() for layer, ranges in activation_ranges.data.items()},
+    }
+
+
+def quantized_feat_extractor(base_name: str, mode: str, extraction_settings: ExtractionSettings):
+    assert torch.device(extraction_settings.device).type == "cpu", "Quantized feature extractors only run on CPU"
+    model = get_extractor_spec(base_name).build(extraction_settings).eval()
+
+    activation_ranges = None
+    if mode == "dynamic":
+        # Activations change little as only weights of linear layers are quantized ahead of time, so the ranges of the
+        # float32 network are used unless others are given with activation_ranges_path
+        model = quantize_dynamic_linear(model)
+    elif mode == "static":
+        if not extraction_settings.calibration_source:
+            raise ValueError(
+                f"{base_name}{QUANTIZED_SUFFIX} needs images to calibrate its quantization, give them with calibration_source"
+            )
+        calibration_data_settings = DataSettings(
+            source=extraction_settings.calibration_source,
+            num_images=extraction_settings.calibration_num_images,
+            shuffle_files=True,
+        )
+        model = quantize_static_conv(model, calibration_data_settings)
+        # Activations of the quantized network are measured on the calibration images, as they can differ from those
+        # of the float32 network
+        activation_ranges = measure_activation_ranges(model, calibration_data_settings)
+    else:
+        raise NotImplementedError(f"Quantization mode {mode} not implemented")
+
+    if extraction_settings.activation_ranges_path:
+        logging.info(f"Using activation ranges from {extraction_settings.activation_ranges_path}")
+        activation_ranges = load_activation_ranges(extraction_settings.activation_ranges_path)
+    if activation_ranges is not None:
+        model.norm_means_per_layer, model.norm_stds_per_layer = get_pre_hist_norm_params_from_min_max(
+            activation_ranges, extraction_settings.range_scale_for_norm_params, device=extraction_settings.device
+        )
+    return model
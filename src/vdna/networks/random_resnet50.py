@@ -9,11 +9,11 @@
 
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 
 def make_feature_dict(feature_list, preprend_name):
@@ -176,34 +176,10 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         dont_return_features=False,
         extraction_settings=ExtractionSettings(),
     ):
-        activation_ranges = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename="Random/rand_resnet50/activation_ranges.json"
-        )
-        min_max_act_per_neuron = load_dict(activation_ranges)
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            {
-                "layer1_0": 256,
-                "layer1_1": 256,
-                "layer1_2": 256,
-                "layer2_0": 512,
-                "layer2_1": 512,
-                "layer2_2": 512,
-                "layer2_3": 512,
-                "layer3_0": 1024,
-                "layer3_1": 1024,
-                "layer3_2": 1024,
-                "layer3_3": 1024,
-                "layer3_4": 1024,
-                "layer3_5": 1024,
-                "layer4_0": 2048,
-                "layer4_1": 2048,
-                "layer4_2": 2048,
-            },
-            (224, 224),
-            "rand_resnet50_backbone",
+        min_max_act_per_neuron = load_network_activation_ranges(
+            "hf://Random/rand_resnet50/activation_ranges.json", extraction_settings
         )
+        network_settings = get_network_settings("rand_resnet50")
 
         super(ResNetFeatureExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
         if norm_layer is None:
@@ -403,12 +379,12 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
         for end_idx in idx_crops:
             if self.dont_return_features:
                 _out = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
                 features = {}
             else:
                 _out, features = self.forward_backbone(
-                    torch.cat(inputs[start_idx:end_idx]).cuda(device=inputs[0].device, non_blocking=True),
+                    torch.cat(inputs[start_idx:end_idx]).to(device=inputs[0].device, non_blocking=True),
                 )
             if start_idx == 0:
                 output = _out
@@ -421,8 +397,16 @@ class ResNetFeatureExtractor(FeatureExtractionModel):
 
         return features
 
+    def iter_features(self, batch):
+        # Blocks are run one at a time, yielding their outputs rather than collecting the features of all blocks
+        x = self.maxpool(self.relu(self.bn1(self.conv1(self.padding(batch)))))
+        for layer_name in ["layer1", "layer2", "layer3", "layer4"]:
+            for i, block in enumerate(getattr(self, layer_name)):
+                x, _ = block(x)
+                yield layer_name + "_" + str(i), x
+
     def get_features(self, batch):
-        return self.forward(batch)
+        return dict(self.iter_features(batch))
 
 
 class MultiPrototypes(nn.Module):
@@ -441,7 +425,12 @@ class MultiPrototypes(nn.Module):
 
 def resnet50_feat_extractor(extraction_settings):
     resnet = ResNetFeatureExtractor(Bottleneck, [3, 4, 6, 3], extraction_settings=extraction_settings)
-    weights = hf_hub_download(repo_id=extraction_settings.hub_repo, filename="Random/rand_resnet50/weights.pth")
+    if not extraction_settings.pretrained:
+        return resnet
+    weights = get_artifact(get_extractor_spec("rand_resnet50").weights_source, extraction_settings)
     checkpoint = torch.load(weights)
     resnet.load_state_dict(checkpoint["model_state_dict"])
     return resnet
+
+
+RandomResnet50FeatExtractor = resnet50_feat_extractor
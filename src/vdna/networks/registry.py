@@ -0,0 +1,300 @@
+import logging
+from copy import deepcopy
+from dataclasses import dataclass, field
+from importlib import import_module
+from typing import Callable, Dict, List, Tuple
+
+from ..utils.settings import ExtractionSettings, NetworkSettings
+
+# Entry point group other packages can use to provide feature extractors. Each entry point should point to an
+# ExtractorSpec, a list of ExtractorSpecs, or a function returning either. The module it points to should be cheap to
+# import, and only reference the model code through the spec factory.
+ENTRY_POINT_GROUP = "vdna.feature_extractors"
+
+# Suffix added to the name of a feature extractor to use its int8 quantized variant, e.g. "mugs_vit_base-int8"
+QUANTIZED_SUFFIX = "-int8"
+
+
+@dataclass
+class ExtractorSpec:
+    """
+    Declaration of a feature extractor, which can be listed and inspected without importing or building the model.
+
+    Args:
+        name (str): Name used to select the feature extractor, e.g. in make_vdna.
+        factory (str): Import path of the FeatureExtractionModel class or function building it, as "module:attribute".
+            It is called with args, kwargs and an extraction_settings keyword argument.
+        network_settings (NetworkSettings): Normalisation, neurons per layer and input size expected by the network.
+        weights_source (str): Where the weights are loaded from: a URL, a path in the hub repository prefixed by
+            hf://, or local:// for files provided by the user.
+        args (Tuple): Positional arguments passed to the factory.
+        kwargs (Dict): Keyword arguments passed to the factory.
+    """
+
+    name: str
+    factory: str
+    network_settings: NetworkSettings = field(default_factory=NetworkSettings)
+    weights_source: str = ""
+    args: Tuple = ()
+    kwargs: Dict = field(default_factory=dict)
+
+    @property
+    def layers(self) -> List[str]:
+        return list(self.network_settings.neurons_per_layer.keys())
+
+    def load_factory(self) -> Callable:
+        module_name, attr_name = self.factory.split(":")
+        return getattr(import_module(module_name), attr_name)
+
+    def build(self, extraction_settings: ExtractionSettings):
+        return self.load_factory()(*self.args, **self.kwargs, extraction_settings=extraction_settings)
+
+
+_REGISTRY: Dict[str, ExtractorSpec] = {}
+_loaded_entry_points = False
+
+
+def register_feature_extractor(spec: ExtractorSpec, overwrite: bool = False):
+    if spec.name in _REGISTRY and not overwrite:
+        raise ValueError(f"Feature extractor {spec.name} is already registered")
+    _REGISTRY[spec.name] = spec
+
+
+def _iter_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+
+def _load_entry_points():
+    global _loaded_entry_points
+    if _loaded_entry_points:
+        return
+    _loaded_entry_points = True
+    for entry_point in _iter_entry_points():
+        try:
+            specs = entry_point.load()
+            if callable(specs):
+                specs = specs()
+            if isinstance(specs, ExtractorSpec):
+                specs = [specs]
+            for spec in specs:
+                register_feature_extractor(spec)
+        except Exception as e:
+            logging.warning(f"Could not load feature extractors from entry point {entry_point.name}: {e}")
+
+
+def get_extractor_spec(name: str) -> ExtractorSpec:
+    _load_entry_points()
+    if name not in _REGISTRY:
+        raise NotImplementedError(f"Feature extractor {name} not implemented")
+    return _REGISTRY[name]
+
+
+def list_feature_extractors() -> List[str]:
+    _load_entry_points()
+    return sorted(_REGISTRY.keys())
+
+
+def get_network_settings(name: str) -> NetworkSettings:
+    # Networks are built with a copy of the settings of their spec, so that settings are only defined in the spec
+    return deepcopy(get_extractor_spec(name).network_settings)
+
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+CLIP_MEAN = [0.48145466, 0.4578275, 0.40821073]
+CLIP_STD = [0.26862954, 0.26130258, 0.27577711]
+
+
+def _resnet_neurons_per_layer(blocks_per_layer: List[int]) -> Dict[str, int]:
+    return {
+        f"layer{i + 1}_{j}": 256 * 2**i for i, n_blocks in enumerate(blocks_per_layer) for j in range(n_blocks)
+    }
+
+
+def _vit_neurons_per_layer(depth: int, n_neurons: int) -> Dict[str, int]:
+    neurons_per_layer = {"block_" + str(i): n_neurons for i in range(depth)}
+    neurons_per_layer["last_norm"] = n_neurons
+    return neurons_per_layer
+
+
+_CLIP_RN50_NEURONS_PER_LAYER = {"block_0": 64}
+_CLIP_RN50_NEURONS_PER_LAYER.update({f"block_{i}": 256 for i in range(1, 4)})
+_CLIP_RN50_NEURONS_PER_LAYER.update({f"block_{i}": 512 for i in range(4, 8)})
+_CLIP_RN50_NEURONS_PER_LAYER.update({f"block_{i}": 1024 for i in range(8, 14)})
+_CLIP_RN50_NEURONS_PER_LAYER.update({f"block_{i}": 2048 for i in range(14, 17)})
+_CLIP_RN50_NEURONS_PER_LAYER["last_norm"] = 1024
+
+_CLIP_WEIGHTS = "https://openaipublic.azureedge.net/clip/models/"
+
+_BUILTIN_SPECS = [
+    ExtractorSpec(
+        "inception",
+        "vdna.networks.inception_pytorch:InceptionV3",
+        NetworkSettings(
+            [0.5, 0.5, 0.5],
+            [0.5, 0.5, 0.5],
+            {"block_0": 64, "block_1": 192, "block_2": 768, "block_3": 2048},
+            (299, 299),
+            "inception_v3",
+        ),
+        # Inception weights ported to Pytorch from
+        # http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
+        "https://github.com/mseitzer/pytorch-fid/releases/download/fid_weights/pt_inception-2015-12-05-6726825d.pth",
+        # Input is normalised already
+        kwargs={"output_blocks": [0, 1, 2, 3], "resize_input": False, "normalize_input": False},
+    ),
+    ExtractorSpec(
+        "dino_resnet50",
+        "vdna.networks.dino_resnet50:DINOResnet50FeatExtractor",
+        NetworkSettings(
+            IMAGENET_MEAN, IMAGENET_STD, _resnet_neurons_per_layer([3, 4, 6, 3]), (224, 224), "dino_resnet50_backbone"
+        ),
+        "https://dl.fbaipublicfiles.com/dino/dino_resnet50_pretrain/dino_resnet50_pretrain.pth",
+    ),
+    ExtractorSpec(
+        "dino_vit_base",
+        "vdna.networks.dino_vit:DINOViTFeatExtractor",
+        NetworkSettings(IMAGENET_MEAN, IMAGENET_STD, _vit_neurons_per_layer(12, 768), (224, 224), "dino_vit_base"),
+        "https://dl.fbaipublicfiles.com/dino/dino_vitbase16_pretrain/dino_vitbase16_pretrain.pth",
+        args=("base",),
+    ),
+    ExtractorSpec(
+        "dino_vit_small",
+        "vdna.networks.dino_vit:DINOViTFeatExtractor",
+        NetworkSettings(IMAGENET_MEAN, IMAGENET_STD, _vit_neurons_per_layer(12, 384), (224, 224), "dino_vit_small"),
+        "https://dl.fbaipublicfiles.com/dino/dino_deitsmall16_pretrain/dino_deitsmall16_pretrain.pth",
+        args=("small",),
+    ),
+    ExtractorSpec(
+        "rand_resnet50",
+        "vdna.networks.random_resnet50:RandomResnet50FeatExtractor",
+        NetworkSettings(
+            IMAGENET_MEAN, IMAGENET_STD, _resnet_neurons_per_layer([3, 4, 6, 3]), (224, 224), "rand_resnet50_backbone"
+        ),
+        "hf://Random/rand_resnet50/weights.pth",
+    ),
+    ExtractorSpec(
+        "vgg16",
+        "vdna.networks.vgg16:VGG16FeatExtractor",
+        NetworkSettings(
+            IMAGENET_MEAN,
+            IMAGENET_STD,
+            {
+                "relu_1_1": 64,
+                "relu_1_2": 64,
+                "relu_2_1": 128,
+                "relu_2_2": 128,
+                "relu_3_1": 256,
+                "relu_3_2": 256,
+                "relu_3_3": 256,
+                "relu_4_1": 512,
+                "relu_4_2": 512,
+                "relu_4_3": 512,
+                "relu_5_1": 512,
+                "relu_5_2": 512,
+                "relu_5_3": 512,
+            },
+            (224, 224),
+            "vgg16",
+        ),
+        "https://download.pytorch.org/models/vgg16-397923af.pth",
+    ),
+    ExtractorSpec(
+        "mugs_vit_large",
+        "vdna.networks.mugs_vit:MugsViTFeatExtractor",
+        NetworkSettings(IMAGENET_MEAN, IMAGENET_STD, _vit_neurons_per_layer(24, 1024), (224, 224), "mugs_vit_large"),
+        "hf://Mugs/mugs_vit_large/weights.pth",
+        args=("large",),
+    ),
+    ExtractorSpec(
+        "mugs_vit_base",
+        "vdna.networks.mugs_vit:MugsViTFeatExtractor",
+        NetworkSettings(IMAGENET_MEAN, IMAGENET_STD, _vit_neurons_per_layer(12, 768), (224, 224), "mugs_vit_base"),
+        "hf://Mugs/mugs_vit_base/weights.pth",
+        args=("base",),
+    ),
+    ExtractorSpec(
+        "mugs_vit_small",
+        "vdna.networks.mugs_vit:MugsViTFeatExtractor",
+        NetworkSettings(IMAGENET_MEAN, IMAGENET_STD, _vit_neurons_per_layer(12, 384), (224, 224), "mugs_vit_small"),
+        "hf://Mugs/mugs_vit_small/weights.pth",
+        args=("small",),
+    ),
+    ExtractorSpec(
+        "clip_im_rn50",
+        "vdna.networks.clip:CLIPImEncoder",
+        NetworkSettings(CLIP_MEAN, CLIP_STD, _CLIP_RN50_NEURONS_PER_LAYER, (224, 224), "clip_im_rn50"),
+        _CLIP_WEIGHTS + "afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
+        args=("rn50",),
+    ),
+    ExtractorSpec(
+        "clip_im_vit_b32",
+        "vdna.networks.clip:CLIPImEncoder",
+        NetworkSettings(CLIP_MEAN, CLIP_STD, _vit_neurons_per_layer(12, 768), (224, 224), "clip_im_vit_b32"),
+        _CLIP_WEIGHTS + "40d365715913c9da98579312b702a82c18be219cc2a73407c4526f58eba950af/ViT-B-32.pt",
+        args=("vit_b32",),
+    ),
+    ExtractorSpec(
+        "clip_im_vit_b16",
+        "vdna.networks.clip:CLIPImEncoder",
+        NetworkSettings(CLIP_MEAN, CLIP_STD, _vit_neurons_per_layer(12, 768), (224, 224), "clip_im_vit_b16"),
+        _CLIP_WEIGHTS + "5806e77cd80f8b59890b7e101eabd078d9fb84e6937f9e85e4ecb61988df416f/ViT-B-16.pt",
+        args=("vit_b16",),
+    ),
+    ExtractorSpec(
+        "clip_im_vit_l14",
+        "vdna.networks.clip:CLIPImEncoder",
+        NetworkSettings(CLIP_MEAN, CLIP_STD, _vit_neurons_per_layer(24, 1024), (224, 224), "clip_im_vit_l14"),
+        _CLIP_WEIGHTS + "b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
+        args=("vit_l14",),
+    ),
+    ExtractorSpec(
+        "cityscapes_resnet101",
+        "vdna.networks.cityscapes_resnet101:CityscapesResnet101FeatExtractor",
+        NetworkSettings(
+            IMAGENET_MEAN,
+            IMAGENET_STD,
+            _resnet_neurons_per_layer([3, 4, 23, 3]),
+            (224, 224),
+            "cityscapes_resnet101_backbone",
+        ),
+        "local://best_deeplabv3plus_resnet101_cityscapes_os16.pth",
+    ),
+]
+
+# Quantized variants, named with the "-int8" suffix. Linear layers of vision transformers are quantized dynamically,
+# and convolutions of convolutional networks statically with scales calibrated on a set of images.
+_QUANTIZATION_MODES = {
+    "dino_resnet50": "static",
+    "dino_vit_base": "dynamic",
+    "dino_vit_small": "dynamic",
+    "rand_resnet50": "static",
+    "vgg16": "static",
+    "mugs_vit_large": "dynamic",
+    "mugs_vit_base": "dynamic",
+    "mugs_vit_small": "dynamic",
+    "clip_im_vit_b32": "dynamic",
+    "clip_im_vit_b16": "dynamic",
+    "clip_im_vit_l14": "dynamic",
+    "cityscapes_resnet101": "static",
+}
+
+for _spec in _BUILTIN_SPECS:
+    register_feature_extractor(_spec)
+    if _spec.name in _QUANTIZATION_MODES:
+        register_feature_extractor(
+            ExtractorSpec(
+                _spec.name + QUANTIZED_SUFFIX,
+                "vdna.networks.quantization:quantized_feat_extractor",
+                _spec.network_settings,
+                _spec.weights_source,
+                args=(_spec.name, _QUANTIZATION_MODES[_spec.name]),
+            )
+        )
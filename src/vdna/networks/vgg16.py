@@ -5,14 +5,12 @@ from pathlib import Path
 
 import torch
 import torch.nn as nn
-from huggingface_hub import hf_hub_download
 from torchvision import models
 
-from ..utils.io import load_dict
-from ..utils.settings import ExtractionSettings, NetworkSettings
-from .feature_extraction_model import FeatureExtractionModel
-
-
+from ..utils.cache import get_artifact
+from ..utils.settings import ExtractionSettings
+from .feature_extraction_model import FeatureExtractionModel, load_network_activation_ranges
+from .registry import get_extractor_spec, get_network_settings
 
 class GuidedReLUFunc(torch.autograd.Function):
     @staticmethod
@@ -41,7 +39,7 @@ def norml2(x):
 
 
 class VGG16(torch.nn.Module):
-    def __init__(self, requires_grad=False, padding="replicate", replace_reluguided=False):
+    def __init__(self, requires_grad=False, padding="replicate", replace_reluguided=False, weights_path=None):
         super(VGG16, self).__init__()
 
         self.mean = torch.zeros(1, 3, 1, 1, requires_grad=False)
@@ -54,7 +52,10 @@ class VGG16(torch.nn.Module):
         self.std[0, 1, 0, 0] = 0.224
         self.std[0, 2, 0, 0] = 0.225
 
-        pretrained_vgg = models.vgg16(pretrained=True)
+        # Weights are only loaded from weights_path, which feature extractors get through the artifact cache
+        pretrained_vgg = models.vgg16()
+        if weights_path is not None:
+            pretrained_vgg.load_state_dict(torch.load(weights_path, map_location="cpu"))
         features = pretrained_vgg.features
         classifier = pretrained_vgg.classifier
 
@@ -167,17 +168,19 @@ class VGG16(torch.nn.Module):
     def normalize(self, x):
         return (x - self.mean) / self.std
 
-    def fw_relu(self, x, num_relus, do_normalize=True):
+    def iter_relu(self, x, num_relus, do_normalize=True):
+        # Outputs of each relu, yielded as soon as they are computed
         if do_normalize:
             x = self.normalize(x)
             pass
 
-        out = []
         for i in range(num_relus):
             x = getattr(self, "relu_%d" % i)(x)
-            out.append(x)
+            yield x
             pass
-        return out
+
+    def fw_relu(self, x, num_relus, do_normalize=True):
+        return list(self.iter_relu(x, num_relus, do_normalize))
 
     def fw_fc(self, x, num_fcs, do_normalize=True):
         if do_normalize:
@@ -201,49 +204,24 @@ class VGG16(torch.nn.Module):
 
 class VGG16FeatExtractor(FeatureExtractionModel):
     def __init__(self, extraction_settings=ExtractionSettings()):
-        activation_ranges = hf_hub_download(
-            repo_id=extraction_settings.hub_repo, filename="VGG/vgg16/activation_ranges.json"
-        )
-        min_max_act_per_neuron = load_dict(activation_ranges)
-        network_settings = NetworkSettings(
-            [0.485, 0.456, 0.406],
-            [0.229, 0.224, 0.225],
-            {
-                "relu_1_1": 64,
-                "relu_1_2": 64,
-                "relu_2_1": 128,
-                "relu_2_2": 128,
-                "relu_3_1": 256,
-                "relu_3_2": 256,
-                "relu_3_3": 256,
-                "relu_4_1": 512,
-                "relu_4_2": 512,
-                "relu_4_3": 512,
-                "relu_5_1": 512,
-                "relu_5_2": 512,
-                "relu_5_3": 512,
-            },
-            (224, 224),
-            "vgg16",
+        min_max_act_per_neuron = load_network_activation_ranges(
+            "hf://VGG/vgg16/activation_ranges.json", extraction_settings
         )
+        network_settings = get_network_settings("vgg16")
         super(VGG16FeatExtractor, self).__init__(network_settings, extraction_settings, min_max_act_per_neuron)
-        self.model = VGG16(requires_grad=False, padding="zero", replace_reluguided=False)
+        weights_path = None
+        if extraction_settings.pretrained:
+            weights_path = get_artifact(get_extractor_spec("vgg16").weights_source, extraction_settings)
+        self.model = VGG16(
+            requires_grad=False,
+            padding="zero",
+            replace_reluguided=False,
+            weights_path=weights_path,
+        )
+
+    def iter_features(self, x):
+        layers = list(self.network_settings.neurons_per_layer)
+        yield from zip(layers, self.model.iter_relu(x, num_relus=13, do_normalize=False))
 
     def get_features(self, x):
-        out = self.model.fw_relu(x, num_relus=13, do_normalize=False)
-        out_dict = {
-            "relu_1_1": out[0],
-            "relu_1_2": out[1],
-            "relu_2_1": out[2],
-            "relu_2_2": out[3],
-            "relu_3_1": out[4],
-            "relu_3_2": out[5],
-            "relu_3_3": out[6],
-            "relu_4_1": out[7],
-            "relu_4_2": out[8],
-            "relu_4_3": out[9],
-            "relu_5_1": out[10],
-            "relu_5_2": out[11],
-            "relu_5_3": out[12],
-        }
-        return out_dict
+        return dict(self.iter_features(x))
@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Union
+
+import torch
+
+NeuronsOfLayer = Union[None, Sequence[int], Dict[int, float]]
+
+
+@dataclass
+class CompiledNeuronSelection:
+    """
+    A neuron selection compiled against the layers and numbers of neurons of a feature extractor.
+
+    layers are the layers with selected neurons, in the order of the feature extractor. indices are positions in the
+    concatenation of the neurons of these layers, so that the distributions of all selected neurons are gathered at
+    once, and weights sum to 1. layer_indices are the indices of selected neurons within each layer.
+    """
+
+    layers: List[str]
+    indices: torch.Tensor
+    weights: torch.Tensor
+    layer_indices: Dict[str, torch.Tensor]
+    uniform: bool
+
+    def gather(self, per_layer: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Gather the rows of selected neurons from tensors of each layer with a row per neuron."""
+        if len(self.layers) == 1:
+            return per_layer[self.layers[0]].index_select(0, self.indices)
+        return torch.cat([per_layer[layer] for layer in self.layers]).index_select(0, self.indices)
+
+    def weighted_mean(self, neuron_distances: torch.Tensor) -> torch.Tensor:
+        return torch.sum(neuron_distances * self.weights.to(neuron_distances.dtype))
+
+
+class NeuronSelection:
+    """
+    Neurons of several layers, each with a weight, which distances between VDNAs are averaged over.
+
+    Layers map to None to select all their neurons, to a sequence of neuron indices with equal weights, or to a dict
+    mapping neuron indices to weights. Distances are the weighted mean of the distances of selected neurons, with
+    weights normalised to sum to 1 over all selected neurons. Selections are compiled once for each feature extractor
+    and device they are used with, so that the same selection can be reused cheaply across many comparisons.
+
+    Args:
+        neurons (Dict[str, Union[None, Sequence[int], Dict[int, float]]]): Selected neurons of each layer.
+
+    Example:
+        >>> from vdna import EMD, NeuronSelection
+        >>> selection = NeuronSelection({"block_0": [3, 42], "block_5": {7: 2.0, 12: 0.5}, "block_11": None})
+        >>> EMD(vdna1, vdna2, neuron_selection=selection)
+    """
+
+    def __init__(self, neurons: Dict[str, NeuronsOfLayer]):
+        assert len(neurons) > 0, "At least one layer must be selected"
+        self.neurons = {}
+        for layer, layer_neurons in neurons.items():
+            if layer_neurons is not None and not isinstance(layer_neurons, dict):
+                layer_neurons = {int(idx): 1.0 for idx in layer_neurons}
+            elif layer_neurons is not None:
+                layer_neurons = {int(idx): float(weight) for idx, weight in layer_neurons.items()}
+                assert all(weight >= 0 for weight in layer_neurons.values()), "Neuron weights must not be negative"
+            if layer_neurons is not None:
+                assert len(layer_neurons) > 0, f"No neurons are selected in layer {layer}"
+            self.neurons[layer] = layer_neurons
+        self._compiled = {}
+
+    @classmethod
+    def from_layers(cls, layers: Sequence[str]) -> "NeuronSelection":
+        """Select all neurons of some layers."""
+        return cls({layer: None for layer in layers})
+
+    def compile(
+        self, neurons_list: Dict[str, int], device: Union[str, torch.device] = "cpu"
+    ) -> CompiledNeuronSelection:
+        """
+        Get the indices and weights of selected neurons for a feature extractor with neurons_list neurons per layer.
+
+        Raises:
+            AssertionError: If a layer is not in neurons_list, a neuron index is out of bounds, or all weights are 0.
+        """
+        key = (tuple(neurons_list.items()), str(device))
+        if key in self._compiled:
+            return self._compiled[key]
+
+        for layer, layer_neurons in self.neurons.items():
+            assert layer in neurons_list, f"Layer {layer} not found in VDNA neurons"
+            if layer_neurons is not None:
+                assert all(0 <= idx < neurons_list[layer] for idx in layer_neurons), (
+                    f"Neuron index not found in VDNA neurons for layer {layer} which has {neurons_list[layer]} neurons"
+                )
+        # Layers are concatenated in the order of the feature extractor
+        layers = [layer for layer in neurons_list if layer in self.neurons]
+        indices, weights, layer_indices = [], [], {}
+        offset = 0
+        for layer in layers:
+            layer_neurons = self.neurons[layer]
+            if layer_neurons is None:
+                layer_neurons = {idx: 1.0 for idx in range(neurons_list[layer])}
+            layer_indices[layer] = torch.tensor(list(layer_neurons), dtype=torch.long, device=device)
+            indices.extend(offset + idx for idx in layer_neurons)
+            weights.extend(layer_neurons.values())
+            offset += neurons_list[layer]
+
+        weights = torch.tensor(weights, dtype=torch.double)
+        assert weights.sum() > 0, "Neuron weights must not all be 0"
+        compiled = CompiledNeuronSelection(
+            layers=layers,
+            indices=torch.tensor(indices, dtype=torch.long, device=device),
+            weights=(weights / weights.sum()).to(device),
+            layer_indices=layer_indices,
+            uniform=bool(torch.all(weights == weights[0])),
+        )
+        self._compiled[key] = compiled
+        return compiled
+
+    def __repr__(self) -> str:
+        layers = ", ".join(
+            f"{layer}: {'all' if layer_neurons is None else len(layer_neurons)}"
+            for layer, layer_neurons in self.neurons.items()
+        )
+        return f"NeuronSelection({layers})"
@@ -0,0 +1,506 @@
+"""
+Asynchronous service comparing sets of images to reference VDNAs kept in memory.
+
+The feature extractor and the references stay loaded between requests. Images of concurrent requests are gathered in
+micro-batches going through the network together, and the VDNA of each request is compared to all references at once.
+The service can be used from asyncio code, or through a small HTTP server listening on a TCP port or a Unix socket:
+
+    vdna serve /path/to/reference1 /path/to/reference2 --port 8080 --device cuda:0
+
+    curl -X POST localhost:8080/compare -d '{"images": ["<base64 encoded image file>", ...]}'
+"""
+import asyncio
+import base64
+import copy
+import io
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Union
+
+import numpy as np
+import torch
+
+from .distances import DEFAULT_DISTANCES, DISTANCES
+from .networks.feature_extraction_model import forward_context, iter_in_context
+from .networks.model_cache import unwrap_model
+from .utils.settings import ExtractionSettings
+from .vdnas import VDNA, get_vdna
+
+_HTTP_STATUSES = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+# Largest body of HTTP requests accepted by default, in bytes
+DEFAULT_MAX_BODY_SIZE = 64 * 2**20
+
+
+class _Request:
+    # Images of a request waiting to go through the network, and the statistics accumulated from those which did
+    def __init__(self, images: torch.Tensor, references: List[str], future: asyncio.Future):
+        self.images = images
+        self.references = references
+        self.future = future
+        self.next_image = 0
+        self.n_processed = 0
+        self.acc_feats = {}
+        self.n_values_per_neuron = {}
+
+    @property
+    def n_images(self) -> int:
+        return len(self.images)
+
+
+def decode_image(image: Union[bytes, str, np.ndarray]) -> np.ndarray:
+    """Decode an image given as an encoded file, a base64 string of an encoded file, or an array, to an RGB array."""
+    if isinstance(image, np.ndarray):
+        return image
+    from PIL import Image
+
+    if isinstance(image, str):
+        image = base64.b64decode(image)
+    return np.array(Image.open(io.BytesIO(image)).convert("RGB"))
+
+
+class VDNAComparisonService:
+    """
+    Compares sets of images to reference VDNAs, batching the images of concurrent requests through the network.
+
+    All references must use the same feature extractor and distribution, which is also used for the VDNAs of requests.
+    Requests are answered with the distance of their images to each reference. EMD is used for histograms and
+    quantiles and NFD for Gaussians, unless another distance is given. Distances are computed for all references in
+    one batched operation when the distributions allow it, and with the distance function for each reference otherwise.
+    Histograms with adaptive ranges are not supported, since their ranges are estimated on a first pass over the images.
+
+    Args:
+        references (Dict[str, Union[VDNA, str, Path]]): Reference VDNAs by name, or paths to load them from.
+        device (str): Device to run the feature extractor and compute distances on.
+        batch_size (int): Maximum number of images in each forward pass.
+        max_wait_ms (float): Time to wait for images of other requests before running a batch which is not full.
+        distance (Optional[str]): "EMD", "NFD" or "FD". If None, chosen from the distribution.
+        num_preprocess_workers (int): Number of threads decoding and resizing images of requests.
+        **extraction_kwargs: Other extraction settings, such as precision, memory_format, backend or pretrained.
+
+    Example:
+        service = VDNAComparisonService({"ffhq": "/path/to/ffhq_vdna"}, device="cuda:0")
+        await service.start()
+        result = await service.compare([image_array, ...])
+        print(result["distances"]["ffhq"])
+        await service.close()
+    """
+
+    def __init__(
+        self,
+        references: Dict[str, Union[VDNA, str, Path]],
+        device: str = "cpu",
+        batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+        distance: Optional[str] = None,
+        num_preprocess_workers: int = 4,
+        **extraction_kwargs,
+    ):
+        from .vdna_processor import load_vdna_from_files
+
+        assert len(references) > 0, "At least one reference VDNA is needed"
+        self.references = {
+            name: reference if isinstance(reference, VDNA) else load_vdna_from_files(reference, device=device)
+            for name, reference in references.items()
+        }
+        first = next(iter(self.references.values()))
+        for name, reference in self.references.items():
+            if reference.feature_extractor_name != first.feature_extractor_name or reference.name != first.name:
+                raise ValueError(
+                    f"Reference {name} uses {reference.feature_extractor_name} with {reference.name}, other references "
+                    f"use {first.feature_extractor_name} with {first.name}"
+                )
+        if getattr(first, "adaptive_ranges", False):
+            raise ValueError("References with adaptive histogram ranges are not supported")
+        self.feat_extractor_name = first.feature_extractor_name
+        self.distribution_name = first.name
+        self.distance = distance if distance is not None else DEFAULT_DISTANCES[first.type]
+        assert self.distance in DISTANCES, f"Unknown distance {self.distance}, choose from {list(DISTANCES)}"
+
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.extraction_settings = ExtractionSettings(
+            device=device, batch_size=batch_size, verbose=False, **extraction_kwargs
+        )
+        self.model = None
+        self.stats = {"requests": 0, "images": 0, "batches": 0}
+
+        self._reference_names = list(self.references)
+        self._reference_stats = None
+        self._hist_bin_params = {}
+        self._max_body_size = DEFAULT_MAX_BODY_SIZE
+        self._distribution = None
+        self._norm_params = None
+        self._pending: Deque[_Request] = deque()
+        self._new_images = asyncio.Event()
+        self._batcher = None
+        # Only one thread runs the network, so batches do not compete for the device
+        self._model_executor = ThreadPoolExecutor(max_workers=1)
+        self._preprocess_executor = ThreadPoolExecutor(max_workers=num_preprocess_workers)
+
+    async def start(self):
+        """Build the feature extractor, prepare the references and start batching requests."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._model_executor, self._load)
+        self._new_images = asyncio.Event()
+        self._batcher = asyncio.create_task(self._run_batches())
+
+    def _load(self):
+        # The service has its own feature extractor rather than one shared through the model cache of a processor,
+        # whose extractions would change its settings while batches of the service run
+        from .networks import get_feature_extractor
+
+        feat_extractor = get_feature_extractor(self.feat_extractor_name, self.extraction_settings)
+        self.model = feat_extractor
+        # Features are reduced as for the distribution of the references
+        self._distribution = get_vdna(self.distribution_name)
+        self._distribution._set_extraction_settings(unwrap_model(feat_extractor))
+        self._norm_params = self._distribution._get_norm_params(unwrap_model(feat_extractor))
+        for name, reference in self.references.items():
+            if reference.type == "quantiles" and reference.raw_layers != self._distribution.raw_layers:
+                raise ValueError(
+                    f"Reference {name} was made with other activation ranges than {self.feat_extractor_name} has"
+                )
+        self.extraction_settings = unwrap_model(feat_extractor).extraction_settings
+        self._reference_stats = self._get_batched_stats(list(self.references.values()))
+
+    async def close(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        for request in self._pending:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("The service was closed"))
+        self._pending.clear()
+        self._model_executor.shutdown()
+        self._preprocess_executor.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def compare(
+        self, images: List[Union[bytes, str, np.ndarray]], references: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        Compare a set of images to references.
+
+        Args:
+            images (List[Union[bytes, str, np.ndarray]]): Images as encoded files, base64 strings of encoded files, or
+                HxWx3 arrays.
+            references (Optional[List[str]]): Names of the references to compare to. If None, all references are used.
+
+        Returns:
+            dict: The number of images, the distance used, the distance to each reference, and the mean distance over
+                the neurons of each layer for each reference.
+        """
+        if self._batcher is None:
+            raise RuntimeError("The service is not started, call start() first")
+        if len(images) == 0:
+            raise ValueError("No images to compare")
+        references = list(references) if references is not None else self._reference_names
+        for name in references:
+            if name not in self.references:
+                raise ValueError(f"Unknown reference {name}, choose from {self._reference_names}")
+
+        loop = asyncio.get_running_loop()
+        batch = await loop.run_in_executor(self._preprocess_executor, self._preprocess, images)
+        request = _Request(batch, references, loop.create_future())
+        self._pending.append(request)
+        self._new_images.set()
+        self.stats["requests"] += 1
+        return await request.future
+
+    def _preprocess(self, images: List[Union[bytes, str, np.ndarray]]) -> torch.Tensor:
+        from .utils.im import ResizeDataset
+
+        network_settings = self.model.network_settings
+        dataset = ResizeDataset(
+            images=[decode_image(image) for image in images],
+            size=network_settings.expected_size,
+            norm_mean=network_settings.norm_mean,
+            norm_std=network_settings.norm_std,
+        )
+        return torch.stack([dataset[i] for i in range(len(dataset))])
+
+    async def _next_batch(self) -> List[tuple]:
+        while not self._pending:
+            self._new_images.clear()
+            await self._new_images.wait()
+        # Wait a little for other requests when the batch is not full
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while sum(r.n_images - r.next_image for r in self._pending) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self._new_images.clear()
+            try:
+                await asyncio.wait_for(self._new_images.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+        # Take images from the oldest requests first. Requests with more images than fit are split between batches.
+        chunks = []
+        n_images = 0
+        while self._pending and n_images < self.batch_size:
+            request = self._pending[0]
+            end = min(request.n_images, request.next_image + self.batch_size - n_images)
+            chunks.append((request, request.next_image, end))
+            n_images += end - request.next_image
+            request.next_image = end
+            if end == request.n_images:
+                self._pending.popleft()
+        return chunks
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunks = await self._next_batch()
+            try:
+                results = await loop.run_in_executor(self._model_executor, self._process_batch, chunks)
+            except Exception as e:
+                logging.exception("Failed to process a batch of images")
+                for request, _, _ in chunks:
+                    if request in self._pending:
+                        self._pending.remove(request)
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, result in results:
+                if not request.future.done():
+                    request.future.set_result(result)
+
+    def _process_batch(self, chunks: List[tuple]) -> List[tuple]:
+        model = self.model
+        device = torch.device(self.device)
+        use_bf16 = self.extraction_settings.precision == "bf16"
+        batch = torch.cat([request.images[start:end] for request, start, end in chunks])
+        sizes = [end - start for _, start, end in chunks]
+
+        batch_feats = iter_in_context(
+            model.iter_batch_features(batch, device), lambda: forward_context(device.type, use_bf16)
+        )
+        for layer, feats in batch_feats:
+            # Features of each request are reduced separately, as they would be by make_vdna
+            for (request, _, _), request_feats in zip(chunks, torch.split(feats, sizes)):
+                request.acc_feats = model.accumulate_layer_features(
+                    request.acc_feats,
+                    layer,
+                    request_feats,
+                    self._hist_bin_params,
+                    self._norm_params,
+                    n_values_per_neuron=request.n_values_per_neuron,
+                )
+            del feats
+        self.stats["batches"] += 1
+        self.stats["images"] += len(batch)
+
+        results = []
+        for request, start, end in chunks:
+            request.n_processed += end - start
+            if request.n_processed == request.n_images:
+                results.append((request, self._answer(request)))
+        return results
+
+    def _answer(self, request: _Request) -> Dict:
+        vdna = copy.copy(self._distribution)
+        vdna._fit_distribution(self.model.finalize_features(request.acc_feats))
+        request.acc_feats = {}
+        vdna.feature_extractor_name = self.feat_extractor_name
+        vdna.neurons_list = self.model.network_settings.neurons_per_layer
+        vdna.extraction_settings_used = self.extraction_settings
+        vdna.num_images = request.n_images
+        vdna.device = str(self.device)
+
+        distances, layer_distances = self.get_distances(vdna, request.references)
+        return {
+            "num_images": request.n_images,
+            "distance": self.distance,
+            "distances": distances,
+            "layer_distances": layer_distances,
+        }
+
+    def _get_batched_stats(self, vdnas: List[VDNA]) -> Optional[Dict[str, tuple]]:
+        # Statistics of the distributions of each layer, stacked along a first dimension of VDNAs, which distances
+        # are computed from in one operation. None if distances have to be computed for each VDNA separately.
+        vdna_type = vdnas[0].type
+        if self.distance == "EMD" and vdna_type == "histogram":
+            # The EMD between histograms is the L1 distance between their cumulative distributions
+            return {
+                layer: (torch.stack([self._get_cdf(vdna.data[layer]) for vdna in vdnas]),) for layer in vdnas[0].data
+            }
+        if self.distance == "EMD" and vdna_type == "quantiles":
+            if len({vdna.n_quantiles for vdna in vdnas}) > 1:
+                return None
+            return {layer: (torch.stack([vdna.data[layer].double() for vdna in vdnas]),) for layer in vdnas[0].data}
+        if self.distance == "NFD" and vdna_type == "gaussian":
+            return {
+                layer: tuple(torch.stack([vdna.data[layer][key] for vdna in vdnas]) for key in ["mu", "var"])
+                for layer in vdnas[0].data
+            }
+        return None
+
+    @staticmethod
+    def _get_cdf(hists: torch.Tensor) -> torch.Tensor:
+        hists = hists / torch.sum(hists, dim=1, dtype=torch.double, keepdim=True)
+        return torch.cumsum(hists, dim=1)
+
+    def get_distances(self, vdna: VDNA, references: Optional[List[str]] = None) -> tuple:
+        """Get the distance of a VDNA to references, and the mean distance over the neurons of each layer."""
+        references = references if references is not None else self._reference_names
+        if self._reference_stats is None:
+            return self._get_distances_per_reference(vdna, references)
+
+        indices = torch.tensor([self._reference_names.index(name) for name in references])
+        query_stats = self._get_batched_stats([vdna])
+        sums = 0
+        n_neurons = 0
+        layer_distances = {name: {} for name in references}
+        for layer, reference_stats in self._reference_stats.items():
+            reference_stats = [stats[indices.to(stats.device)] for stats in reference_stats]
+            # Distances of each neuron of the layer, for each reference, as (references, neurons)
+            neuron_distances = self._get_neuron_distances(query_stats[layer], reference_stats)
+            sums = sums + neuron_distances.sum(dim=1)
+            n_neurons += neuron_distances.shape[1]
+            for name, layer_distance in zip(references, neuron_distances.mean(dim=1).tolist()):
+                layer_distances[name][layer] = layer_distance
+        distances = dict(zip(references, (sums / n_neurons).tolist()))
+        return distances, layer_distances
+
+    def _get_neuron_distances(self, query_stats: tuple, reference_stats: List[torch.Tensor]) -> torch.Tensor:
+        if self.distance == "NFD":
+            mu1, var1 = query_stats
+            mu2, var2 = reference_stats
+            return torch.square(mu1 - mu2) + var1 + var2 - 2 * torch.sqrt(var1 * var2)
+        if self.references[self._reference_names[0]].type == "histogram":
+            return torch.sum(torch.abs(query_stats[0] - reference_stats[0]), dim=2)
+        return torch.mean(torch.abs(query_stats[0] - reference_stats[0]), dim=2)
+
+    def _get_distances_per_reference(self, vdna: VDNA, references: List[str]) -> tuple:
+        distance_fn = DISTANCES[self.distance]
+        distances = {}
+        layer_distances = {}
+        for name in references:
+            distances[name] = float(distance_fn(vdna, self.references[name]))
+            layer_distances[name] = {
+                layer: float(distance_fn(vdna, self.references[name], use_neurons_from_layer=layer))
+                for layer in vdna.neurons_list
+            }
+        return distances, layer_distances
+
+    def get_info(self) -> Dict:
+        return {
+            "feat_extractor": self.feat_extractor_name,
+            "distribution": self.distribution_name,
+            "distance": self.distance,
+            "references": self._reference_names,
+            "batch_size": self.batch_size,
+            "stats": dict(self.stats),
+        }
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        unix_socket: Optional[str] = None,
+        max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+    ):
+        """
+        Start an HTTP server for the service, on a TCP port or a Unix socket, and return the asyncio server.
+
+        Requests with bodies larger than max_body_size bytes are refused with status 413 without being read.
+
+        Routes are:
+            GET /info: the feature extractor, distribution, distance, references and counts of requests and batches.
+            POST /compare: takes a JSON object with "images", a list of base64 encoded image files, and optionally
+                "references", a list of reference names. Answers with the result of compare as JSON.
+        """
+        self._max_body_size = max_body_size
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self._handle_http, path=unix_socket)
+        return await asyncio.start_server(self._handle_http, host, port)
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            content_length = int(headers.get("content-length", 0))
+            if content_length > self._max_body_size:
+                status, payload = 413, {"error": f"Request bodies are limited to {self._max_body_size} bytes"}
+            else:
+                body = await reader.readexactly(content_length)
+                status, payload = await self._route(*request_line[:2], body)
+        except Exception as e:
+            status, payload = 400, {"error": str(e)}
+
+        content = json.dumps(payload).encode()
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {_HTTP_STATUSES[status]}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\nConnection: close\r\n\r\n"
+            ).encode()
+            + content
+        )
+        await writer.drain()
+        writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple:
+        if method == "GET" and path == "/info":
+            return 200, self.get_info()
+        if method == "POST" and path == "/compare":
+            try:
+                data = json.loads(body)
+                return 200, await self.compare(data["images"], data.get("references"))
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": str(e)}
+            except Exception as e:
+                logging.exception("Failed to answer a request")
+                return 500, {"error": str(e)}
+        return 404, {"error": f"No route for {method} {path}"}
+
+
+def run_service(
+    references: Dict[str, Union[VDNA, str, Path]],
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    unix_socket: Optional[str] = None,
+    max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+    **service_kwargs,
+):
+    """Run a VDNAComparisonService with an HTTP server until interrupted."""
+
+    async def main():
+        async with VDNAComparisonService(references, **service_kwargs) as service:
+            server = await service.serve(host, port, unix_socket, max_body_size)
+            address = unix_socket if unix_socket is not None else f"http://{host}:{port}"
+            print(f"Comparing images to {len(references)} references with {service.feat_extractor_name}, on {address}")
+            async with server:
+                await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Union
+
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where updates of the manifest by concurrent processes are not locked
+    fcntl = None
+
+
+def get_cache_dir() -> Path:
+    """Get the directory used to cache files, set by the VDNA_CACHE_DIR environment variable or ~/.cache/vdna."""
+    cache_dir = Path(os.environ.get("VDNA_CACHE_DIR", Path.home() / ".cache" / "vdna")).expanduser()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_file_cache_key(path: Union[str, Path]) -> str:
+    """Get a key identifying a file from its path, size and modification time, to cache data derived from it."""
+    path = Path(path).resolve()
+    stat = path.stat()
+    return hashlib.sha256(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+
+def load_state_dict_file(path: Union[str, Path], mmap: bool = True) -> dict:
+    """Load a state dict saved with torch.save on the CPU, memory-mapping it when supported by torch."""
+    try:
+        return torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    except TypeError:
+        # torch < 2.1 does not support mmap
+        return torch.load(path, map_location="cpu")
+
+
+def save_state_dict_file(state_dict: dict, path: Union[str, Path]):
+    """Save a state dict atomically, so that concurrent readers never see a partially written file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Artifacts (weights, activation ranges) are downloaded once into the cache directory, and listed in a manifest with
+# their checksums. Once listed, they are read without any network access.
+MANIFEST_NAME = "manifest.json"
+OFFLINE_ENV_VAR = "VDNA_OFFLINE"
+
+
+def is_offline(extraction_settings=None) -> bool:
+    # The environment variable is used unless offline mode is explicitly set
+    if extraction_settings is not None and extraction_settings.offline is not None:
+        return extraction_settings.offline
+    return os.environ.get(OFFLINE_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+def get_artifact_key(source: str, hub_repo: str) -> str:
+    # Files from the hub repository are given as hf://<path in the repository>
+    if source.startswith("hf://"):
+        return f"hf://{hub_repo}/{source[len('hf://'):]}"
+    return source
+
+
+def get_manifest_path() -> Path:
+    return get_cache_dir() / MANIFEST_NAME
+
+
+def load_manifest() -> dict:
+    manifest_path = get_manifest_path()
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest: dict):
+    manifest_path = get_manifest_path()
+    tmp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(path: Union[str, Path]) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@contextmanager
+def _manifest_lock():
+    # Processes sharing the cache directory, such as jobs of a cluster array, update the manifest one at a time so
+    # that none of them drops the entries added by the others
+    if fcntl is None:
+        yield
+        return
+    with open(get_manifest_path().with_name(f"{MANIFEST_NAME}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def register_artifact(key: str, path: Union[str, Path]):
+    path = Path(path).resolve()
+    entry = {"path": str(path), "size": path.stat().st_size, "sha256": file_sha256(path)}
+    with _manifest_lock():
+        manifest = load_manifest()
+        manifest[key] = entry
+        _save_manifest(manifest)
+
+
+def _download_artifact(key: str) -> Path:
+    artifacts_dir = get_cache_dir() / "artifacts"
+    if key.startswith("hf://"):
+        from huggingface_hub import hf_hub_download
+
+        parts = key[len("hf://") :].split("/")
+        repo_id, filename = "/".join(parts[:2]), "/".join(parts[2:])
+        return Path(hf_hub_download(repo_id=repo_id, filename=filename, local_dir=artifacts_dir / "hf" / repo_id))
+
+    dest = artifacts_dir / "url" / hashlib.sha256(key.encode()).hexdigest()[:16] / key.split("/")[-1]
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+    torch.hub.download_url_to_file(key, str(tmp_path), progress=True)
+    os.replace(tmp_path, dest)
+    return dest
+
+
+def get_artifact(source: str, extraction_settings) -> Path:
+    """
+    Get the local path of a file needed by a feature extractor, downloading it on first use.
+
+    Args:
+        source (str): URL of the file, or hf://<path> for a file in the hub repository of the extraction settings.
+        extraction_settings (ExtractionSettings): Settings giving the hub repository and whether to work offline.
+
+    Returns:
+        Path: Local path of the file.
+
+    Raises:
+        FileNotFoundError: If the file is not cached and offline mode is enabled.
+    """
+    key = get_artifact_key(source, extraction_settings.hub_repo)
+    entry = load_manifest().get(key)
+    if entry is not None:
+        path = Path(entry["path"])
+        if path.is_file() and path.stat().st_size == entry["size"]:
+            return path
+
+    if is_offline(extraction_settings):
+        raise FileNotFoundError(
+            f"{key} is not in the cache at {get_cache_dir()} and offline mode is enabled. "
+            "Run `vdna prefetch <feature extractor>` with network access first."
+        )
+    path = _download_artifact(key)
+    register_artifact(key, path)
+    return path
+
+
+def verify_artifacts() -> List[str]:
+    """Check the checksums of all cached artifacts, returning the keys of missing or corrupted ones."""
+    invalid_keys = []
+    for key, entry in load_manifest().items():
+        path = Path(entry["path"])
+        if not path.is_file() or file_sha256(path) != entry["sha256"]:
+            invalid_keys.append(key)
+    return invalid_keys
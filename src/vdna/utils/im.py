@@ -1,3 +1,4 @@
+import random
 from pathlib import Path
 from typing import List, Tuple, Union
 
@@ -5,7 +6,6 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from PIL import Image
-from torchvision.transforms import Compose, Normalize, ToTensor
 
 
 def build_resizer(mode, size):
@@ -135,13 +135,36 @@ def _make_np_img_square(img_np, crop_to_square_pre_resize):
         raise ValueError("invalid crop_to_square_pre_resize")
 
 
+def _to_rgb_array(img_np: np.ndarray) -> np.ndarray:
+    """
+    Bring an image array to the HxWx3 layout with values in [0,255] expected by the resizers.
+    uint8 arrays are returned as they are (no copy), other integer types are scaled from their full range
+    and floating point arrays are assumed to already be in [0,255].
+    """
+    if img_np.ndim == 2:
+        img_np = np.repeat(img_np[:, :, None], 3, axis=2)
+    elif img_np.shape[2] == 1:
+        img_np = np.repeat(img_np, 3, axis=2)
+    elif img_np.shape[2] == 4:
+        img_np = img_np[:, :, :3]
+
+    if img_np.dtype == np.uint8:
+        return img_np
+    if img_np.dtype == np.bool_:
+        return img_np.astype(np.float32) * 255
+    if np.issubdtype(img_np.dtype, np.integer):
+        scale = 255.0 / np.iinfo(img_np.dtype).max
+        return np.clip(img_np, 0, None).astype(np.float32) * scale
+    return img_np.astype(np.float32, copy=False)
+
+
 # Adapted from clean-fid https://github.com/GaParmar/clean-fid
 class ResizeDataset(torch.utils.data.Dataset):
     """
     A placeholder Dataset that enables parallelizing the resize operation
     using multiple CPU cores
 
-    file_paths: List of all file paths in the folder
+    file_paths: List of all file paths in the folder. .npy files are memory-mapped instead of decoded with PIL
     images: List of all images
     fn_resize: function that takes an np_array as input [0,255]
     crop_to_square_pre_resize: if "center" use center crop to make square first.
@@ -150,6 +173,10 @@ class ResizeDataset(torch.utils.data.Dataset):
     size: size to resize to
     norm_mean: mean to normalize to
     norm_std: std to normalize to
+
+    Arrays (provided or loaded from .npy files) are expected as HxW or HxWxC. uint8 arrays are used as they are,
+    other integer types (e.g. uint16) are scaled from their full range to [0,255] and floating point arrays are
+    expected in [0,255]. Images only go through PIL when decoding image files or when a custom PIL transform is set.
     """
 
     def __init__(
@@ -174,13 +201,16 @@ class ResizeDataset(torch.utils.data.Dataset):
         else:
             raise ValueError("ResizeDataset needs either file paths or images")
 
+        # torchvision is slow to import, and only needed when loading images
+        from torchvision.transforms import Normalize, ToTensor
+
         self.crop_to_square_pre_resize = crop_to_square_pre_resize
         self.tf_to_tensor = ToTensor()
         self.tf_norm = Normalize(mean=norm_mean, std=norm_std)
         self.size = size
         self.fn_resize = build_resizer(resize_mode, size=size)
         self.custom_np_image_tranform = lambda x: x
-        self.custom_pil_image_tranform = lambda x: x
+        self.custom_pil_image_tranform = None
         self.threw_warning_about_resizing = False
 
     def __len__(self):
@@ -189,10 +219,36 @@ class ResizeDataset(torch.utils.data.Dataset):
         return len(self.images)
 
     def _get_image(self, idx):
+        # Returns a PIL image when decoding an image file, and a np array otherwise
         if self.data_mode == "file_paths":
-            path = str(self.file_paths[idx])
-            return Image.open(path).convert("RGB")
-        return Image.fromarray(np.uint8(self.images[idx]))
+            # Paths can be given directly instead of indices, see FilePathBatchSampler
+            path = str(idx) if isinstance(idx, (str, Path)) else str(self.file_paths[idx])
+            if path.split(".")[-1] == "npy":
+                return np.load(path, mmap_mode="r")
+            img_pil = Image.open(path)
+            # Keep the bit depth of 16-bit and floating point images instead of truncating them to 8 bits
+            if img_pil.mode in ("I;16", "I;16B", "I;16L"):
+                return np.array(img_pil).astype(np.uint16)
+            if img_pil.mode == "I":
+                return np.clip(np.array(img_pil), 0, 65535).astype(np.uint16)
+            if img_pil.mode == "F":
+                return np.array(img_pil)
+            return img_pil.convert("RGB")
+        return self.images[idx]
+
+    def _get_image_np(self, idx):
+        img = self._get_image(idx)
+
+        # apply a custom PIL image transform before resizing the image
+        if self.custom_pil_image_tranform is not None:
+            if isinstance(img, np.ndarray):
+                # PIL transforms work on 8-bit RGB images, scaled from the range of the array's dtype
+                img = Image.fromarray(np.rint(np.clip(_to_rgb_array(img), 0, 255)).astype(np.uint8))
+            img = self.custom_pil_image_tranform(img)
+
+        if isinstance(img, np.ndarray):
+            return _to_rgb_array(img)
+        return _to_rgb_array(np.array(img))
 
     def _check_no_cropping(self, img_np):
         if self.crop_to_square_pre_resize == "none" and not self.threw_warning_about_resizing:
@@ -205,12 +261,7 @@ class ResizeDataset(torch.utils.data.Dataset):
                 self.threw_warning_about_resizing = True
 
     def __getitem__(self, i):
-        img_pil = self._get_image(i)
-
-        # apply a custom PIL image transform before resizing the image
-        img_pil = self.custom_pil_image_tranform(img_pil)
-
-        img_np = np.array(img_pil)
+        img_np = self._get_image_np(i)
 
         # apply a custom np image transform before resizing the image
         img_np = self.custom_np_image_tranform(img_np)
@@ -225,14 +276,228 @@ class ResizeDataset(torch.utils.data.Dataset):
         # ToTensor() converts to [0,1] only if input in uint8
         if img_resized.dtype == "uint8":
             img_t = self.tf_to_tensor(np.array(img_resized))
-        elif img_resized.dtype == "float32":
-            img_t = self.tf_to_tensor(img_resized) / 255
+        else:
+            img_t = self.tf_to_tensor(np.array(img_resized, dtype=np.float32)) / 255
 
         img_t = self.tf_norm(img_t)
         return img_t
 
 
+def _make_tensor_batch_square(batch: torch.Tensor, crop_to_square_pre_resize: str) -> torch.Tensor:
+    # Batch is of shape (B,C,H,W). Crops are views of the batch, except for random crops which are stacked.
+    h, w = batch.shape[2:]
+    if crop_to_square_pre_resize == "none" or h == w:
+        return batch
+    size = min(h, w)
+    if crop_to_square_pre_resize == "center":
+        return batch[:, :, (h - size) // 2 : (h + size) // 2, (w - size) // 2 : (w + size) // 2]
+    elif crop_to_square_pre_resize == "random":
+        crops = []
+        for img in batch:
+            if h > w:
+                offset_h = np.random.randint(0, h - size)
+                offset_w = 0
+            else:
+                offset_h = 0
+                offset_w = np.random.randint(0, w - size)
+            crops.append(img[:, offset_h : offset_h + size, offset_w : offset_w + size])
+        return torch.stack(crops)
+    else:
+        raise ValueError("invalid crop_to_square_pre_resize")
+
+
+def _tensor_to_float_255(batch: torch.Tensor) -> torch.Tensor:
+    # Same dtype-aware scaling as _to_rgb_array, for tensors
+    if batch.dtype == torch.uint8:
+        return batch.float()
+    if batch.dtype == torch.bool:
+        return batch.float() * 255
+    if not batch.is_floating_point():
+        return batch.float().clamp_(min=0) * (255.0 / torch.iinfo(batch.dtype).max)
+    return batch.float()
+
+
+class ArrayBatchDataset:
+    """
+    Dataset of images stacked in a single (N,H,W,3) NumPy array or torch tensor.
+
+    Images are never copied or converted to PIL images. Instead, cropping, resizing and normalisation are applied
+    to whole batches with tensor operations, which makes worker processes unnecessary.
+
+    images: stacked images. uint8 values are expected in [0,255], other integer types are scaled from their full range
+            and floating point values are expected in [0,255]
+    resize_mode: "clean" uses antialiased bicubic resizing, close to the PIL resizing of ResizeDataset.
+                 "legacy_pytorch" uses bilinear resizing as ResizeDataset does.
+                 "legacy_tensorflow" does not resize.
+    crop_to_square_pre_resize: "center", "random" or "none", as in ResizeDataset
+    size: size to resize to
+    norm_mean: mean to normalize to
+    norm_std: std to normalize to
+    """
+
+    def __init__(
+        self,
+        images: Union[np.ndarray, torch.Tensor],
+        resize_mode: str = "clean",
+        crop_to_square_pre_resize: str = "none",
+        size: Tuple[int, int] = (299, 299),
+        norm_mean: List[float] = [0.0, 0.0, 0.0],
+        norm_std: List[float] = [1.0, 1.0, 1.0],
+    ):
+        if isinstance(images, np.ndarray):
+            images = torch.from_numpy(images)
+        if images.dim() != 4 or images.shape[-1] != 3:
+            raise ValueError(f"Expected stacked images of shape (N,H,W,3), got {tuple(images.shape)}")
+        if resize_mode not in ["clean", "legacy_pytorch", "legacy_tensorflow"]:
+            raise ValueError(f"Invalid mode {resize_mode} specified")
+
+        self.images = images
+        self.resize_mode = resize_mode
+        self.crop_to_square_pre_resize = crop_to_square_pre_resize
+        self.size = tuple(size)
+        self.norm_mean = torch.tensor(norm_mean, dtype=torch.float32, device=images.device).reshape(1, -1, 1, 1)
+        self.norm_std = torch.tensor(norm_std, dtype=torch.float32, device=images.device).reshape(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def get_batch(self, start: int, end: int) -> torch.Tensor:
+        batch = self.images[start:end].permute(0, 3, 1, 2)
+        batch = _make_tensor_batch_square(batch, self.crop_to_square_pre_resize)
+        batch = _tensor_to_float_255(batch)
+        if self.resize_mode == "clean":
+            batch = F.interpolate(batch, size=self.size, mode="bicubic", align_corners=False, antialias=True)
+        elif self.resize_mode == "legacy_pytorch":
+            batch = F.interpolate(batch, size=self.size, mode="bilinear", align_corners=False)
+        batch = batch.clamp_(0, 255) / 255
+        return (batch - self.norm_mean) / self.norm_std
+
+    def __getitem__(self, i):
+        return self.get_batch(i, i + 1)[0]
+
+
+class ArrayBatchLoader:
+    """
+    Iterates over an ArrayBatchDataset in the main process, yielding preprocessed batches.
+    """
+
+    def __init__(self, dataset: ArrayBatchDataset, batch_size: int):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield self.dataset.get_batch(start, start + self.batch_size)
+
+
+class FilePathBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler yielding batches of file paths rather than indices, so that the files to load can be changed
+    between iterations without recreating the DataLoader workers, which hold their own copy of the dataset.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.file_paths = []
+
+    def __len__(self):
+        return (len(self.file_paths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.file_paths), self.batch_size):
+            yield [str(path) for path in self.file_paths[start : start + self.batch_size]]
+
+
+class PooledDataLoader:
+    """
+    View of a pooled DataLoader iterating over the files of a given dataset.
+    """
+
+    def __init__(self, dataloader: torch.utils.data.DataLoader, dataset: ResizeDataset):
+        self.dataloader = dataloader
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        return iter(self.dataloader)
+
+
+class DataLoaderPool:
+    """
+    Keeps the worker processes of a DataLoader alive between extractions from image files sharing the same
+    preprocessing. Only the list of files sent to the workers changes from one extraction to the next.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.dataloader = None
+        self.batch_sampler = None
+
+    def get_dataloader(
+        self,
+        dataset: ResizeDataset,
+        key: Tuple,
+        batch_size: int,
+        num_workers: int,
+        pin_memory: bool = False,
+        prefetch_factor: int = 2,
+    ) -> PooledDataLoader:
+        key = key + (batch_size, num_workers, pin_memory, prefetch_factor)
+        if key != self.key:
+            self.close()
+            self.batch_sampler = FilePathBatchSampler(batch_size)
+            self.dataloader = torch.utils.data.DataLoader(
+                dataset,
+                batch_sampler=self.batch_sampler,
+                num_workers=num_workers,
+                pin_memory=pin_memory,
+                prefetch_factor=prefetch_factor,
+                persistent_workers=True,
+            )
+            self.key = key
+        self.batch_sampler.file_paths = dataset.file_paths
+        return PooledDataLoader(self.dataloader, dataset)
+
+    def close(self):
+        # Workers are shut down when the DataLoader and its iterator are garbage collected
+        self.key = None
+        self.dataloader = None
+        self.batch_sampler = None
+
+
+class ImageReservoir:
+    """
+    Keeps a uniform random sample of the images seen in a stream of batches, using reservoir sampling.
+    Only sampled images are copied, and nothing is kept if the size is 0.
+    """
+
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.images = []
+        self.n_seen = 0
+        self.rng = random.Random(seed)
+
+    def add_batch(self, batch: torch.Tensor):
+        if self.size <= 0:
+            return
+        for image in batch:
+            self.n_seen += 1
+            if len(self.images) < self.size:
+                self.images.append(image.to("cpu", copy=True))
+            else:
+                idx = self.rng.randrange(self.n_seen)
+                if idx < self.size:
+                    self.images[idx] = image.to("cpu", copy=True)
+
+
 def denormalise_tensors(tensors, mean, std):
+    from torchvision.transforms import Compose, Normalize
+
     tf_denormalise = Compose(
         [
             Normalize(mean=[0.0, 0.0, 0.0], std=[1 / s for s in std]),
@@ -1,14 +1,17 @@
 import datetime
 import json
 import pathlib
+import os
 import pickle
 
-from torchvision.utils import save_image
+import numpy as np
 
 from ..version import __version__
 
 
 def save_images(dir, images):
+    from torchvision.utils import save_image
+
     save_dir = pathlib.Path(dir)
     save_dir.mkdir(parents=True, exist_ok=True)
     for i, image in enumerate(images):
@@ -31,3 +34,60 @@ def load_dict(path):
         with open(path, "rb") as f:
             data = pickle.load(f)
     return data
+
+
+# Activation ranges are stored as {"mins_per_neuron": {layer: values}, "maxs_per_neuron": {layer: values}}.
+# In json files, values are dicts mapping neuron indices to floats. In npz files, they are float32 arrays stored as
+# "min-<layer>" and "max-<layer>", as saved by activation-ranges VDNAs.
+def activation_ranges_to_arrays(activation_ranges: dict) -> dict:
+    arrays = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+    for key in arrays:
+        for layer, values in activation_ranges[key].items():
+            if isinstance(values, dict):
+                values = list(values.values())
+            arrays[key][layer] = np.asarray(values, dtype=np.float32)
+    return arrays
+
+
+def save_activation_ranges(path, activation_ranges: dict):
+    arrays = activation_ranges_to_arrays(activation_ranges)
+    data = {}
+    for layer in arrays["mins_per_neuron"]:
+        data["min-" + layer] = arrays["mins_per_neuron"][layer]
+        data["max-" + layer] = arrays["maxs_per_neuron"][layer]
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    # Not compressed, as loading speed matters more than size for these files
+    np.savez(tmp_path, **data)
+    os.replace(tmp_path, path)
+
+
+def load_activation_ranges(path) -> dict:
+    """
+    Load activation ranges from a json or npz file, as float32 arrays per layer.
+
+    Json files are converted once, and the arrays are cached in the cache directory to speed up later loads.
+    """
+    from .cache import get_cache_dir, get_file_cache_key
+
+    path = pathlib.Path(path)
+    if path.suffix == ".json":
+        cache_path = get_cache_dir() / "activation_ranges" / f"{path.stem}_{get_file_cache_key(path)}.npz"
+        if not cache_path.is_file():
+            save_activation_ranges(cache_path, load_dict(path))
+        path = cache_path
+
+    activation_ranges = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+    with np.load(path) as data:
+        for name in data.files:
+            key = "mins_per_neuron" if name.startswith("min-") else "maxs_per_neuron"
+            activation_ranges[key][name[len("min-") :]] = data[name]
+    return activation_ranges
+
+
+def convert_activation_ranges(json_path, npz_path=None) -> pathlib.Path:
+    """Convert activation ranges from a json file to an npz file, saved next to it by default."""
+    npz_path = pathlib.Path(json_path).with_suffix(".npz") if npz_path is None else pathlib.Path(npz_path)
+    save_activation_ranges(npz_path, load_dict(json_path))
+    return npz_path
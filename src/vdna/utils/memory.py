@@ -0,0 +1,152 @@
+import ctypes
+import gc
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+
+_PROC_STATUS = "/proc/self/status"
+_PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def _read_proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open(_PROC_STATUS) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_rss_mb() -> float:
+    """Get the resident memory of the current process, in MB."""
+    rss = _read_proc_status_mb("VmRSS")
+    if rss is not None:
+        return rss
+    try:
+        import psutil
+    except ImportError:
+        # Without /proc or psutil, only the peak resident memory is available
+        return get_peak_rss_mb()
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def get_peak_rss_mb() -> float:
+    """Get the peak resident memory of the current process since it started or since reset_peak_rss, in MB."""
+    peak = _read_proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    import resource
+
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the current process to its current value. Only supported on Linux."""
+    try:
+        with open(_PROC_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def release_free_memory(device="cpu"):
+    """Return memory freed by Python and torch to the system, so that later measurements of resident memory start low."""
+    gc.collect()
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
+    elif sys.platform.startswith("linux"):
+        # glibc keeps freed memory in the process unless asked to release it
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class PeakMemoryMonitor:
+    """
+    Measures the peak memory used by stages of a computation, above the memory used when the monitor is created.
+
+    On CPUs, the peak resident memory of the process is reset at the start of each stage on Linux. On other systems,
+    the resident memory is sampled by a background thread, which can miss short peaks. On CUDA devices, the peak memory
+    allocated by torch is used.
+
+    Args:
+        device (str or torch.device): Device whose memory is measured.
+        sampling_interval_s (float): Interval between samples of the resident memory, when it cannot be reset.
+
+    Example:
+        monitor = PeakMemoryMonitor("cpu")
+        with monitor.stage("forward"):
+            ...
+        print(monitor.peak_mb["forward"], monitor.max_peak_mb)
+    """
+
+    def __init__(self, device="cpu", sampling_interval_s: float = 0.001):
+        self.device = torch.device(device)
+        self.sampling_interval_s = sampling_interval_s
+        self.peak_mb: Dict[str, float] = {}
+        self.baseline_mb = self._get_current_mb()
+
+    @property
+    def max_peak_mb(self) -> float:
+        return max(self.peak_mb.values(), default=0.0)
+
+    def _get_current_mb(self) -> float:
+        if self.device.type == "cuda":
+            return torch.cuda.memory_allocated(self.device) / 2**20
+        return get_rss_mb()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            yield
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device) / 2**20
+        elif reset_peak_rss():
+            yield
+            peak = get_peak_rss_mb()
+        else:
+            self._start_sampling()
+            try:
+                yield
+            finally:
+                peak = self._stop_sampling()
+        self.peak_mb[name] = max(self.peak_mb.get(name, 0.0), peak - self.baseline_mb)
+
+    def _start_sampling(self):
+        self._sampled_peak = get_rss_mb()
+        self._stop_event = threading.Event()
+
+        def sample():
+            while not self._stop_event.wait(self.sampling_interval_s):
+                self._sampled_peak = max(self._sampled_peak, get_rss_mb())
+
+        self._sampler = threading.Thread(target=sample, daemon=True)
+        self._sampler.start()
+
+    def _stop_sampling(self) -> float:
+        self._stop_event.set()
+        self._sampler.join()
+        return max(self._sampled_peak, get_rss_mb())
+
+
+def get_total_memory_mb(device="cpu") -> Optional[float]:
+    """Get the total memory of a device, in MB, or None if it cannot be found."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory / 2**20
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+    except (ValueError, OSError, AttributeError):
+        return None
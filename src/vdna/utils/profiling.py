@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import torch
+
+from .memory import get_peak_rss_mb, get_rss_mb, reset_peak_rss
+
+# Stages of feature extraction, in the order they happen for each batch
+PROFILE_STAGES = (
+    "data_loading",
+    "host_to_device",
+    "forward",
+    "reduction",
+    "normalisation",
+    "histogram",
+    "accumulation",
+)
+
+
+def tensors_nbytes(obj) -> int:
+    """Get the number of bytes of the tensors in a tensor, a list or dict of tensors, or an object holding tensors."""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensors_nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensors_nbytes(value) for value in obj)
+    if hasattr(obj, "__dict__"):
+        return sum(tensors_nbytes(value) for value in vars(obj).values() if isinstance(value, torch.Tensor))
+    return 0
+
+
+class ExtractionProfiler:
+    """
+    Records the time spent in each stage of feature extraction, per batch and per layer, along with peak memory.
+
+    Stages are "data_loading" (waiting for the dataloader to decode and resize images), "host_to_device" (copying
+    batches to the device), "forward" (running the network up to each layer), "reduction" (converting and averaging
+    features), "normalisation", "histogram" (binning features, normalisation included) and "accumulation" (adding
+    statistics of a batch to those of the dataset).
+
+    On CUDA devices, the device is synchronised at the end of each stage so that times are attributed to the stage
+    running them. This removes the overlap between host-to-device copies and computations, so profiled extractions can
+    be slower than unprofiled ones. Stages are also labelled in torch.profiler traces.
+
+    A disabled profiler records nothing, so that extraction code can use it unconditionally.
+
+    Args:
+        device (str or torch.device): Device features are extracted on.
+        enabled (bool): Whether to record anything.
+
+    Example:
+        profiler = ExtractionProfiler("cpu")
+        profiler.start()
+        for batch in profiler.iterate(dataloader, "data_loading"):
+            profiler.next_batch(len(batch))
+            with profiler.stage("forward", layer="block1"):
+                ...
+        profiler.stop()
+        print(format_profile_report(profiler.report()))
+    """
+
+    def __init__(self, device="cpu", enabled: bool = True):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        # Spans of (stage, layer, batch index, start ns, end ns)
+        self.events: List[tuple] = []
+        self.batch_sizes: List[int] = []
+        self.max_layer_feats_bytes: Dict[str, int] = {}
+        self.accumulated_bytes = 0
+        self._start_ns = self._end_ns = 0
+        self._baseline_rss_mb = self._peak_rss_mb = 0.0
+        self._peak_device_mb = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._baseline_rss_mb = get_rss_mb()
+        if not reset_peak_rss():
+            # The peak resident memory cannot be reset, so it is only measured if it grows above the current one
+            self._baseline_rss_mb = max(self._baseline_rss_mb, get_peak_rss_mb())
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._start_ns = time.perf_counter_ns()
+
+    def stop(self, acc_feats=None):
+        if not self.enabled:
+            return
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self._peak_device_mb = torch.cuda.max_memory_allocated(self.device) / 2**20
+        self._end_ns = time.perf_counter_ns()
+        self._peak_rss_mb = get_peak_rss_mb()
+        if acc_feats is not None:
+            self.accumulated_bytes = tensors_nbytes(acc_feats)
+
+    def next_batch(self, n_images: int):
+        if self.enabled:
+            self.batch_sizes.append(n_images)
+
+    @property
+    def batch_idx(self) -> int:
+        return len(self.batch_sizes) - 1
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def stage(self, name: str, layer: Optional[str] = None):
+        if not self.enabled:
+            yield
+            return
+        label = f"vdna::{name}" if layer is None else f"vdna::{name}::{layer}"
+        with torch.profiler.record_function(label):
+            start = time.perf_counter_ns()
+            yield
+            self._synchronize()
+        self.events.append((name, layer, self.batch_idx, start, time.perf_counter_ns()))
+
+    def iterate(self, iterable: Iterable, name: str, get_layer=None) -> Iterator:
+        """Iterate over iterable, recording the time taken to get each item as a stage, optionally for the layer given
+        by get_layer(item)."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter_ns()
+            with torch.profiler.record_function(f"vdna::{name}"):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self._synchronize()
+            layer = get_layer(item) if get_layer is not None else None
+            # Items are only counted in the batch they belong to once they are received
+            batch_idx = self.batch_idx + 1 if name == "data_loading" else self.batch_idx
+            self.events.append((name, layer, batch_idx, start, time.perf_counter_ns()))
+            yield item
+
+    def record_layer_features(self, layer: str, feats: torch.Tensor):
+        if self.enabled:
+            self.max_layer_feats_bytes[layer] = max(self.max_layer_feats_bytes.get(layer, 0), tensors_nbytes(feats))
+
+    def report(self) -> Dict:
+        """
+        Summarise recorded stages.
+
+        Returns:
+            dict: Number of images and batches, total time and throughput, time per stage in total and per batch, time
+                per stage and layer, time per stage of each batch, and memory in MB: peak resident memory above the one
+                at the start, peak memory allocated on CUDA devices, largest features of a batch for each layer, and
+                statistics accumulated at the end.
+        """
+        total_s = (self._end_ns - self._start_ns) / 1e9
+        num_batches = len(self.batch_sizes)
+        stage_s = defaultdict(float)
+        layer_stage_s = defaultdict(lambda: defaultdict(float))
+        batch_stage_s = [defaultdict(float) for _ in range(num_batches)]
+        for name, layer, batch_idx, start, end in self.events:
+            duration = (end - start) / 1e9
+            stage_s[name] += duration
+            if layer is not None:
+                layer_stage_s[layer][name] += duration
+            if 0 <= batch_idx < num_batches:
+                batch_stage_s[batch_idx][name] += duration
+        stages = [stage for stage in PROFILE_STAGES if stage in stage_s]
+        num_images = sum(self.batch_sizes)
+        return {
+            "device": str(self.device),
+            "num_images": num_images,
+            "num_batches": num_batches,
+            "total_s": total_s,
+            "images_per_s": num_images / total_s if total_s > 0 else 0.0,
+            "stages": {
+                stage: {
+                    "total_s": stage_s[stage],
+                    "ms_per_batch": 1000 * stage_s[stage] / max(num_batches, 1),
+                    "fraction": stage_s[stage] / total_s if total_s > 0 else 0.0,
+                }
+                for stage in stages
+            },
+            "other_s": total_s - sum(stage_s.values()),
+            "layers": {layer: dict(layer_stage_s[layer]) for layer in layer_stage_s},
+            "batches": [
+                dict({"num_images": n_images}, **batch_stage_s[batch_idx])
+                for batch_idx, n_images in enumerate(self.batch_sizes)
+            ],
+            "memory_mb": {
+                "peak_rss": max(self._peak_rss_mb - self._baseline_rss_mb, 0.0),
+                "peak_device_allocated": self._peak_device_mb,
+                "max_layer_features": {
+                    layer: nbytes / 2**20 for layer, nbytes in self.max_layer_feats_bytes.items()
+                },
+                "accumulated_features": self.accumulated_bytes / 2**20,
+            },
+        }
+
+    def get_chrome_trace(self) -> Dict:
+        """Get recorded stages as a Chrome trace, which can be opened in chrome://tracing or https://ui.perfetto.dev."""
+        trace_events = []
+        for name, layer, batch_idx, start, end in self.events:
+            args = {"batch": batch_idx}
+            if layer is not None:
+                args["layer"] = layer
+            trace_events.append(
+                {
+                    "name": name if layer is None else f"{name} {layer}",
+                    "cat": name,
+                    "ph": "X",
+                    "ts": (start - self._start_ns) / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": 0,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": self.report()}
+
+    def save_chrome_trace(self, path: Union[str, Path]):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.get_chrome_trace(), f)
+
+
+def format_profile_report(report: Dict) -> str:
+    lines = [
+        f"Extracted features of {report['num_images']} images in {report['num_batches']} batches on "
+        f"{report['device']} in {report['total_s']:.2f} s ({report['images_per_s']:.1f} images/s)"
+    ]
+    for stage, stage_report in report["stages"].items():
+        lines.append(
+            f"  {stage:<15} {stage_report['total_s']:8.3f} s  {stage_report['ms_per_batch']:8.1f} ms/batch  "
+            f"{100 * stage_report['fraction']:5.1f}%"
+        )
+    lines.append(f"  {'other':<15} {report['other_s']:8.3f} s")
+    memory = report["memory_mb"]
+    memory_line = f"  peak RSS +{memory['peak_rss']:.0f} MB"
+    if memory["peak_device_allocated"] is not None:
+        memory_line += f", peak device allocated {memory['peak_device_allocated']:.0f} MB"
+    max_layer_feats = max(memory["max_layer_features"].values(), default=0.0)
+    memory_line += f", largest layer features {max_layer_feats:.1f} MB"
+    memory_line += f", accumulated {memory['accumulated_features']:.1f} MB"
+    lines.append(memory_line)
+    return "\n".join(lines)
@@ -1,12 +1,13 @@
 from dataclasses import dataclass, field
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 
 
 @dataclass
 class DataSettings:
-    source: Union[str, List[str], List[np.ndarray]] = "NotFilled"
+    source: Union[str, List[str], List[np.ndarray], np.ndarray, torch.Tensor] = "NotFilled"
     crop_to_square_pre_resize: str = "none"
     resize_mode: str = "clean"
     custom_fn_resize: Union[None, Callable] = None
@@ -31,17 +32,38 @@ class ExtractionSettings:
     accumulate_spatial_feats_in_hist: bool = False
     accumulate_sample_feats_in_hist: bool = False
     keep_only_min_max: bool = False
+    keep_quantile_sketch: bool = False
+    quantile_sketch_levels: int = 513
     normalise_feats: bool = False
     range_scale_for_norm_params: float = 1.2
     hist_range: List[float] = field(default_factory=lambda: [-1.0, 1.0])
     hist_nb_bins: int = 0
     hist_channel_batch_size: int = 10
+    hist_accumulation_dtype: str = "int64"
+    hist_chunk_size: int = 0
+    adaptive_range_num_images: int = 500
     num_workers: int = 12
+    pin_memory: bool = False
+    prefetch_factor: int = 2
+    persistent_workers: bool = False
     batch_size: int = 64
     device: str = "cuda:0"
+    precision: str = "fp32"
+    memory_format: str = "contiguous"
+    backend: str = "eager"
+    num_threads: int = 0
+    num_interop_threads: int = 0
     description: str = ""
     verbose: bool = True
+    profile: bool = False
+    profile_trace_path: str = ""
     n_sample_images: int = 10
     sample_images_folder: str = "sample_images"
     seed: int = 0
+    pretrained: bool = True
     hub_repo: str = "bramtoula/visual-dna-models"
+    weights_path: str = ""
+    activation_ranges_path: str = ""
+    offline: Optional[bool] = None
+    calibration_source: str = ""
+    calibration_num_images: int = 64
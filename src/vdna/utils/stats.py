@@ -1,36 +1,56 @@
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import torch
-from scipy.linalg import sqrtm
+
+
+def get_hist_bin_params(
+    norm_mean: torch.Tensor, norm_std: torch.Tensor, hist_nb_bins: int, hist_range: List[float], dtype: torch.dtype
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Normalising activations with (x - mean) / std and finding their bin in hist_range is a single affine map,
+    # bin = floor(x * scale + offset). Parameters are computed in float64 once, then cast to the activation dtype.
+    # Half precision cannot represent bin indices exactly, so float32 is used for those.
+    bin_width = (hist_range[1] - hist_range[0]) / hist_nb_bins
+    norm_mean = norm_mean.double()
+    norm_std = norm_std.double()
+    scale = 1 / (norm_std * bin_width)
+    offset = -(norm_mean / norm_std + hist_range[0]) / bin_width
+    dtype = torch.promote_types(dtype, torch.float32)
+    return scale.to(dtype), offset.to(dtype)
+
+
+def histogram_per_channel_from_bin_params(
+    data: torch.Tensor, scale: torch.Tensor, offset: torch.Tensor, hist_nb_bins: int, chunk_size: int = 0
+) -> torch.Tensor:
+    # Takes array of size (B,C,H,W) and per channel scale and offset of size (1,C,1,1) mapping values to bins.
+    # Returns histogram counts of shape (C,hist_nb_bins), where values outside of the range are counted in the first or
+    # last bin, and NaN values are ignored. Two intermediate tensors of the size of the data are created, the bins and
+    # their integer indices, besides a mask of NaN values, and indices are counted in one pass.
+    # If chunk_size > 0, samples are binned chunk_size at a time, so that intermediate tensors are smaller.
+    if 0 < chunk_size < data.shape[0]:
+        return sum(
+            histogram_per_channel_from_bin_params(chunk, scale, offset, hist_nb_bins)
+            for chunk in torch.split(data, chunk_size)
+        )
+    n_channels = data.shape[1]
+    n_bins = n_channels * hist_nb_bins
+    bins = torch.addcmul(offset, data, scale)
+    # NaN values are kept by clamping, so they are counted in an extra bin past all others which is then dropped
+    nan_mask = torch.isnan(bins)
+    # Values are positive after clamping, so truncating to integers gives the floor
+    bins.clamp_(0, hist_nb_bins - 1)
+    index_dtype = torch.int32 if n_bins < 2**31 - 1 else torch.long
+    channel_offsets = torch.arange(n_channels, device=data.device, dtype=index_dtype) * hist_nb_bins
+    idx = bins.to(index_dtype).add_(channel_offsets.reshape(1, -1, *([1] * (data.dim() - 2))))
+    idx.masked_fill_(nan_mask, n_bins)
+    return torch.bincount(idx.flatten(), minlength=n_bins + 1)[:n_bins].reshape(n_channels, hist_nb_bins)
 
 
 def histogram_per_channel(data: torch.Tensor, hist_nb_bins: int, hist_range: List[float]) -> torch.Tensor:
     # Takes array of size (B,C,H,W) and returns histogram counts of values in specified dims. out shape is (C,bin_number)
-    # For a single element in the batch, we can afford to handle all channels simultaneously. Memory explodes if we have more elements.
-
-    # Make sure values are in range
-    data = torch.clamp(data, hist_range[0], hist_range[1])
-
-    # For small number of activations, we can afford to do it all at once, but otherwise memory explodes
-    if data.shape[0] * data.shape[1] * data.shape[2] * data.shape[3] * hist_nb_bins < 2e6:
-        bin_edges = torch.linspace(hist_range[0], hist_range[1], steps=hist_nb_bins + 1).to(data.device)
-        bin_edges_left = bin_edges[:-1]
-        bin_edges_right = bin_edges[1:]
-        data_expanded = data.unsqueeze(-1)
-        out = torch.logical_and(data_expanded >= bin_edges_left, data_expanded <= bin_edges_right).sum((0, 2, 3))
-
-    # For more activations, we just do it channel by channel
-    else:
-        out = torch.zeros((data.shape[1], hist_nb_bins), dtype=torch.long).to(data.device)
-        for c in range(data.shape[1]):
-            out[c] = torch.histc(
-                data[:, c, :, :].flatten(),
-                bins=hist_nb_bins,
-                min=hist_range[0],
-                max=hist_range[1],
-            )
-    return out
+    ones = torch.ones((1, data.shape[1]) + (1,) * (data.dim() - 2), device=data.device)
+    scale, offset = get_hist_bin_params(0 * ones, ones, hist_nb_bins, hist_range, data.dtype)
+    return histogram_per_channel_from_bin_params(data, scale, offset, hist_nb_bins)
 
 
 def earth_movers_distance(hist1: torch.Tensor, hist2: torch.Tensor) -> torch.Tensor:
@@ -43,6 +63,76 @@ def earth_movers_distance(hist1: torch.Tensor, hist2: torch.Tensor) -> torch.Ten
     return torch.sum(torch.abs(y), dim=1)
 
 
+def resample_histograms(
+    hists: torch.Tensor,
+    bin_ranges: torch.Tensor,
+    new_bin_ranges: torch.Tensor,
+    new_nb_bins: int,
+    clamp_to_range: bool = False,
+) -> torch.Tensor:
+    # Each row of hists has uniform bins spanning the lower and upper edges in the same row of bin_ranges (rows, 2).
+    # Counts are moved to new_nb_bins uniform bins spanning new_bin_ranges, by interpolating the cumulative counts,
+    # which assumes values are spread uniformly within each bin. Returns float64 counts of shape (rows, new_nb_bins).
+    # Counts outside of new_bin_ranges are dropped, or moved to the first and last bins with clamp_to_range, as
+    # activations outside of the range of a histogram are when it is built.
+    device = hists.device
+    bin_ranges = bin_ranges.to(device).double()
+    new_bin_ranges = new_bin_ranges.to(device).double()
+    steps = torch.linspace(0, 1, hists.shape[1] + 1, dtype=torch.double, device=device)
+    new_steps = torch.linspace(0, 1, new_nb_bins + 1, dtype=torch.double, device=device)
+    edges = bin_ranges[:, :1] + (bin_ranges[:, 1:] - bin_ranges[:, :1]) * steps
+    new_edges = new_bin_ranges[:, :1] + (new_bin_ranges[:, 1:] - new_bin_ranges[:, :1]) * new_steps
+    cumulative_counts = torch.nn.functional.pad(torch.cumsum(hists.double(), dim=1), (1, 0))
+    new_cumulative_counts = interp_per_row(new_edges, edges, cumulative_counts)
+    if clamp_to_range:
+        new_cumulative_counts[:, 0] = 0
+        new_cumulative_counts[:, -1] = cumulative_counts[:, -1]
+    return torch.diff(new_cumulative_counts, dim=1)
+
+
+def quantile_levels(n_quantiles: int) -> torch.Tensor:
+    # Midpoints of n_quantiles intervals of equal probability mass
+    return (torch.arange(n_quantiles, dtype=torch.double) + 0.5) / n_quantiles
+
+
+def earth_movers_distance_quantiles(quantiles1: torch.Tensor, quantiles2: torch.Tensor) -> torch.Tensor:
+    # Each row holds values at the levels given by quantile_levels, which define a piecewise constant quantile function.
+    # The EMD is the integral of the absolute difference between quantile functions, computed exactly over the
+    # intervals where both are constant. The number of quantiles can differ between the two inputs.
+    n1, n2 = quantiles1.shape[1], quantiles2.shape[1]
+    if n1 == n2:
+        return torch.mean(torch.abs(quantiles1.double() - quantiles2.double()), dim=1)
+    device = quantiles1.device
+    edges = torch.unique(
+        torch.cat((torch.arange(n1 + 1, dtype=torch.double) / n1, torch.arange(n2 + 1, dtype=torch.double) / n2))
+    ).to(device)
+    widths = edges[1:] - edges[:-1]
+    mids = (edges[1:] + edges[:-1]) / 2
+    idx1 = (mids * n1).long()
+    idx2 = (mids * n2).long()
+    return torch.sum(torch.abs(quantiles1[:, idx1].double() - quantiles2[:, idx2].double()) * widths, dim=1)
+
+
+def merge_quantiles(quantiles: List[torch.Tensor], weights: List[float], n_quantiles: int) -> torch.Tensor:
+    # Each (rows, n) tensor of quantiles is a distribution putting equal mass on its n values. The mixture of these
+    # distributions, weighted by weights such as numbers of images, is summarised again by its values at n_quantiles
+    # levels given by quantile_levels.
+    total_weight = float(sum(weights))
+    assert total_weight > 0, "Weights must sum to a positive value"
+    values = torch.cat([q.double() for q in quantiles], dim=1)
+    masses = torch.cat(
+        [
+            torch.full((q.shape[1],), weight / (total_weight * q.shape[1]), dtype=torch.double)
+            for q, weight in zip(quantiles, weights)
+        ]
+    ).to(values.device)
+    values, order = torch.sort(values, dim=1)
+    cumulative_masses = torch.cumsum(masses[order], dim=1)
+    levels = quantile_levels(n_quantiles).to(values.device).expand(len(values), -1).contiguous()
+    idx = torch.searchsorted(cumulative_masses, levels).clamp(max=values.shape[1] - 1)
+    return torch.gather(values, 1, idx)
+
+
 # Adapted from https://github.com/bioinf-jku/TTUR/blob/master/fid.py
 # Stable version by Dougal J. Sutherland
 def frechet_distance_multidim(
@@ -64,8 +154,11 @@ def frechet_distance_multidim(
 
     diff = mu1 - mu2
 
-    # Product might be almost singular
-    covmean, _ = sqrtm(sigma1.dot(sigma2), disp=False)
+    # scipy is slow to import and only needed here
+    from scipy.linalg import sqrtm
+
+    # Product might be almost singular. sqrtm only returns the square root without disp, which recent scipy removed.
+    covmean = sqrtm(sigma1.dot(sigma2))
     if not np.isfinite(covmean).all():
         msg = ("fid calculation produces singular product; " "adding %s to diagonal of cov estimates") % eps
         print(msg)
@@ -87,3 +180,80 @@ def frechet_distance_multidim(
 def frechet_distance_1d(mu1: torch.Tensor, var1: torch.Tensor, mu2: torch.Tensor, var2: torch.Tensor) -> torch.Tensor:
     # Expects mus and sigmas to be numpy arrays where each row will lead to a frechet distance
     return torch.square(mu1 - mu2) + var1 + var2 - 2 * torch.sqrt(var1 * var2)
+
+
+def interp_per_row(x: torch.Tensor, xp: torch.Tensor, fp: torch.Tensor) -> torch.Tensor:
+    # Linear interpolation of each row of x, using the sorted points xp (rows, K) and values fp (rows, K) or (K,).
+    # Values outside of the range of xp take the first or last value of fp.
+    fp = fp.expand(xp.shape)
+    idx = torch.searchsorted(xp.contiguous(), x.contiguous()).clamp(1, xp.shape[1] - 1)
+    x_lo, x_hi = torch.gather(xp, 1, idx - 1), torch.gather(xp, 1, idx)
+    f_lo, f_hi = torch.gather(fp, 1, idx - 1), torch.gather(fp, 1, idx)
+    denom = x_hi - x_lo
+    w = torch.where(denom > 0, (x - x_lo) / torch.where(denom > 0, denom, torch.ones_like(denom)), torch.zeros_like(x))
+    return f_lo + w.clamp(0, 1) * (f_hi - f_lo)
+
+
+class StreamingQuantiles:
+    """
+    Streaming estimate of quantiles for each channel, which keeps a fixed-size summary instead of all values.
+
+    The summary holds the values of each channel at fixed quantile levels, denser towards both ends of the
+    distribution. New values are merged by combining the cumulative distributions of the summary and of the new
+    values, weighted by their counts, and reading the result back at the summary levels. Minimums and maximums are
+    exact.
+
+    Args:
+        n_levels (int): Number of quantile levels kept for each channel.
+        tail_mass (float): Probability mass at each end of the distribution covered by a quarter of the levels.
+    """
+
+    def __init__(self, n_levels: int = 513, tail_mass: float = 0.01):
+        n_tail = n_levels // 4
+        self.levels = torch.cat(
+            (
+                torch.linspace(0, tail_mass, n_tail + 1, dtype=torch.double)[:-1],
+                torch.linspace(tail_mass, 1 - tail_mass, n_levels - 2 * n_tail, dtype=torch.double),
+                torch.linspace(1 - tail_mass, 1, n_tail + 1, dtype=torch.double)[1:],
+            )
+        )
+        self.values = None
+        self.count = 0
+
+    def update(self, feats: torch.Tensor):
+        """Add values of shape (B,C,...), where quantiles are computed over all dimensions except C."""
+        feats = feats.detach().transpose(0, 1).reshape(feats.shape[1], -1)
+        n = feats.shape[1]
+        levels = self.levels.to(feats.device)
+
+        # Quantiles of the new values at the summary levels, interpolating between sorted values. The k-th sorted value
+        # is taken at level (k + 0.5) / n, which keeps small batches from biasing tails when they are merged
+        feats_sorted = torch.sort(feats, dim=1).values.double()
+        pos = (levels * n - 0.5).clamp(0, n - 1)
+        lo = pos.floor().long()
+        hi = pos.ceil().long()
+        w = pos - lo
+        batch_values = feats_sorted[:, lo] * (1 - w) + feats_sorted[:, hi] * w
+
+        if self.values is None:
+            self.values = batch_values
+            self.count = n
+            return
+
+        candidates = torch.sort(torch.cat((self.values, batch_values), dim=1), dim=1).values
+        cdf = self.count * interp_per_row(candidates, self.values, levels) + n * interp_per_row(
+            candidates, batch_values, levels
+        )
+        cdf /= self.count + n
+        self.values = interp_per_row(levels.expand(candidates.shape[0], -1), cdf, candidates)
+        self.count += n
+
+    def quantile(self, q: float) -> torch.Tensor:
+        """Get the estimated quantile q, between 0 and 1, for each channel."""
+        return self.quantiles(torch.tensor([q]))[:, 0]
+
+    def quantiles(self, qs: torch.Tensor) -> torch.Tensor:
+        """Get the estimated quantiles at each level of qs, between 0 and 1, as a (C, len(qs)) tensor."""
+        n_channels = self.values.shape[0]
+        qs = qs.to(dtype=self.values.dtype, device=self.values.device).expand(n_channels, -1)
+        return interp_per_row(qs, self.levels.to(self.values.device).expand(n_channels, -1), self.values)
@@ -1,12 +1,14 @@
 import json
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Sequence, Union
 
 import numpy as np
 import torch
-from huggingface_hub import hf_hub_download
 
-from .networks import FeatureExtractionModel, get_feature_extractor
+from .networks import FeatureExtractionModel, ModelCache, get_feature_extractor
+from .networks.autotune import DEFAULT_BATCH_SIZES, autotune_extraction, format_autotune_report
+from .networks.model_cache import unwrap_model
+from .utils.im import DataLoaderPool
 from .utils.io import save_images
 from .utils.settings import DataSettings, ExtractionSettings
 from .vdnas import VDNA, get_vdna
@@ -46,6 +48,8 @@ def load_vdna_from_hub(repo_id: str, file_path: str, device: str = "cpu", repo_t
         VDNA: A VDNA object.
 
     """
+    from huggingface_hub import hf_hub_download
+
     metadata_file_path = hf_hub_download(repo_id=repo_id, filename=file_path + ".json", repo_type=repo_type)
     hf_hub_download(repo_id=repo_id, filename=file_path + ".npz", repo_type=repo_type)
     common_file_path = metadata_file_path[:-5]
@@ -57,14 +61,134 @@ def load_vdna_from_hub(repo_id: str, file_path: str, device: str = "cpu", repo_t
 
 
 class VDNAProcessor:
-    def __init__(self):
+    def __init__(self, max_cached_models: Optional[int] = 2, max_cache_memory_mb: Optional[float] = None):
+        """
+        Creates VDNAs, keeping the feature extractors it builds in a least recently used cache to reuse them in later calls.
+
+        Args:
+            max_cached_models (Optional[int]): The maximum number of feature extractors kept in the cache. If None, the number is not limited. Defaults to 2.
+            max_cache_memory_mb (Optional[float]): The maximum memory used by the parameters of cached feature extractors, in MB. If None, memory is not limited. Defaults to None.
+        """
         self.last_extraction_settings_used = ExtractionSettings()
+        self.last_profile_report = None
         self.data_settings = DataSettings()
         self.feat_extractor = FeatureExtractionModel()
+        self.dataloader_pool = DataLoaderPool()
+        self.model_cache = ModelCache(max_models=max_cached_models, max_memory_mb=max_cache_memory_mb)
+
+    def _get_feat_extractor(self, feat_extractor_name: str, extraction_settings: ExtractionSettings):
+        feat_extractor = self.model_cache.get(feat_extractor_name, extraction_settings)
+        if feat_extractor is None:
+            feat_extractor = get_feature_extractor(feat_extractor_name, extraction_settings)
+            self.model_cache.add(feat_extractor_name, extraction_settings, feat_extractor)
+
+        # Settings which do not affect the network can differ between calls, and are updated for each extraction
+        unwrap_model(feat_extractor).extraction_settings = extraction_settings
+        return feat_extractor
+
+    def warmup(
+        self,
+        feat_extractor_name: str = "mugs_vit_base",
+        device: str = "cuda:0",
+        weights_path: str = "",
+        activation_ranges_path: str = "",
+        memory_format: str = "contiguous",
+        calibration_source: Union[str, Path] = "",
+        backend: str = "eager",
+        pretrained: bool = True,
+    ):
+        """
+        Builds a feature extractor and keeps it in the cache, so that the next calls to make_vdna using it start right away.
+
+        Args:
+            feat_extractor_name (str): The name of the feature extractor to build. Defaults to "mugs_vit_base".
+            device (str): The device to put the feature extractor on. Defaults to "cuda:0".
+            weights_path (str): Path to the weights of feature extractors loading them from local files. Defaults to "".
+            activation_ranges_path (str): Path to the activation ranges of feature extractors loading them from local files. Defaults to "".
+            memory_format (str): The memory format of the feature extractor, "contiguous" or "channels_last". Defaults to "contiguous".
+            calibration_source (Union[str, Path]): The images used to calibrate the quantization of int8 convolutional feature extractors. Defaults to "".
+            backend (str): How the feature extractor is run, "eager", "compile", "torchscript", "export" or "onnxruntime". Defaults to "eager".
+            pretrained (bool): Whether to load the pretrained weights of the feature extractor, or to initialise it randomly. Defaults to True.
+        """
+        extraction_settings = ExtractionSettings(
+            device=device,
+            weights_path=str(weights_path),
+            activation_ranges_path=str(activation_ranges_path),
+            memory_format=memory_format,
+            calibration_source=str(calibration_source),
+            backend=backend,
+            pretrained=pretrained,
+        )
+        self._get_feat_extractor(feat_extractor_name, extraction_settings)
+
+    def autotune(
+        self,
+        memory_budget_mb: float,
+        feat_extractor_name: str = "mugs_vit_base",
+        distribution_name: str = "histogram-1000",
+        device: str = "cuda:0",
+        precision: str = "fp32",
+        memory_format: str = "contiguous",
+        backend: str = "eager",
+        num_threads: int = 0,
+        batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+        use_cache: bool = True,
+        **extraction_kwargs,
+    ) -> Dict:
+        """
+        Finds the batch size and histogram chunk size making a VDNA the fastest within a memory budget, by probing the feature extractor with batches of random images of increasing sizes. Results are cached per feature extractor, host and settings.
+
+        Args:
+            memory_budget_mb (float): Maximum peak memory used by extraction on the device, above the memory used by the feature extractor, in MB.
+            feat_extractor_name (str): The name of the feature extractor to tune. Defaults to "mugs_vit_base".
+            distribution_name (str): The name of the distribution the VDNA will use, which sets how features are reduced. Defaults to "histogram-1000".
+            device (str): The device to tune extraction on. Defaults to "cuda:0".
+            precision (str): The precision the feature extractor runs in, "fp32" or "bf16". Defaults to "fp32".
+            memory_format (str): The memory format of the feature extractor, "contiguous" or "channels_last". Defaults to "contiguous".
+            backend (str): How the feature extractor is run, as in make_vdna. Defaults to "eager".
+            num_threads (int): The number of threads torch uses within operations. If 0, the current setting is kept. Defaults to 0.
+            batch_sizes (Sequence[int]): The batch sizes to probe, in increasing order. Defaults to powers of 2 from 1 to 512.
+            use_cache (bool): Whether to reuse a configuration already tuned on this host. Defaults to True.
+            **extraction_kwargs: Other settings used to build the feature extractor, such as weights_path or calibration_source.
+
+        Returns:
+            dict: The chosen batch_size and hist_chunk_size, with their throughput in images per second, peak memory in MB, time and peak memory per stage, and all probed configurations.
+        """
+        extraction_settings = ExtractionSettings(
+            device=device,
+            precision=precision,
+            memory_format=memory_format,
+            backend=backend,
+            num_threads=num_threads,
+            verbose=False,
+            **extraction_kwargs,
+        )
+        feat_extractor = self._get_feat_extractor(feat_extractor_name, extraction_settings)
+        # Features are reduced as for the distribution, without changing the settings kept by the cached model
+        get_vdna(distribution_name)._set_extraction_settings(unwrap_model(feat_extractor))
+        return autotune_extraction(
+            unwrap_model(feat_extractor), memory_budget_mb, batch_sizes=batch_sizes, use_cache=use_cache
+        )
+
+    def evict(self, feat_extractor_name: Optional[str] = None, device: Optional[str] = None) -> int:
+        """
+        Removes feature extractors from the cache.
+
+        Args:
+            feat_extractor_name (Optional[str]): The name of the feature extractors to remove. If None, all feature extractors are removed. Defaults to None.
+            device (Optional[str]): Only remove feature extractors on this device. If None, feature extractors on all devices are removed. Defaults to None.
+
+        Returns:
+            int: The number of feature extractors removed.
+        """
+        n_evicted = self.model_cache.evict(feat_extractor_name, device)
+        if self.model_cache.get(self.feat_extractor.name, self.last_extraction_settings_used) is None:
+            self.feat_extractor = FeatureExtractionModel()
+        return n_evicted
 
     def make_vdna(
         self,
-        source: Union[str, List[str], List[np.ndarray]],
+        source: Union[str, List[str], List[np.ndarray], np.ndarray, torch.Tensor],
         num_images: int = -1,  # Use all images
         shuffle_files: bool = False,
         feat_extractor_name: str = "mugs_vit_base",
@@ -74,15 +198,34 @@ class VDNAProcessor:
         device: str = "cuda:0",
         verbose: bool = True,
         num_workers: int = 12,
+        pin_memory: bool = False,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = False,
         save_sample_images: Optional[Union[str, Path]] = None,
         n_sample_images: int = 5,
         crop_to_square_pre_resize: str = "none",
+        weights_path: str = "",
+        activation_ranges_path: str = "",
+        offline: Optional[bool] = None,
+        hist_accumulation_dtype: str = "int64",
+        adaptive_range_num_images: int = 500,
+        precision: str = "fp32",
+        memory_format: str = "contiguous",
+        num_threads: int = 0,
+        num_interop_threads: int = 0,
+        calibration_source: Union[str, Path] = "",
+        backend: str = "eager",
+        hist_chunk_size: int = 0,
+        memory_budget_mb: Optional[float] = None,
+        profile: bool = False,
+        profile_trace_path: Optional[Union[str, Path]] = None,
+        pretrained: bool = True,
     ) -> VDNA:
         """
         Generates a VDNA (Visual DNA) for a given set of images or path to a directory containing images.
 
         Args:
-            source (Union[str, List[str], List[np.ndarray]]): The source of images to process. Can be a list of image numpy arrays, a path to an image or to a directory which will be recursively searched, a list of image paths, or a .txt file with each image path in a line.
+            source (Union[str, List[str], List[np.ndarray], np.ndarray, torch.Tensor]): The source of images to process. Can be a list of image numpy arrays, a path to an image or to a directory which will be recursively searched, a list of image paths, or a .txt file with each image path in a line. Images already in memory can also be given as a single (N,H,W,3) numpy array or torch tensor, which is preprocessed in batches in the main process without workers.
             num_images (int): The maximum number of images to process. If -1, all files will be processed. Defaults to -1.
             shuffle_files (bool): Whether or not to shuffle the files before processing. Defaults to False.
             feat_extractor_name (str): The name of the feature extractor to use. Defaults to "mugs_vit_base".
@@ -92,13 +235,52 @@ class VDNAProcessor:
             device (str): The device to use for processing. Defaults to "cuda:0".
             verbose (bool): Whether or not to print progress messages during processing. Defaults to True.
             num_workers (int): The number of worker processes to use for processing. Defaults to 12.
+            pin_memory (bool): Whether to load batches in pinned memory, which lets host-to-device copies of the next batch overlap with inference on CUDA devices. Defaults to False.
+            prefetch_factor (int): The number of batches loaded in advance by each worker. Defaults to 2.
+            persistent_workers (bool): Whether to keep worker processes alive after processing, to reuse them in the next calls of make_vdna using image files with the same preprocessing. Defaults to False.
             save_sample_images (Optional[Union[str, Path]]): The path to save sample images after processing. If None, no images will be saved. Defaults to None.
             n_sample_images (int): The number of sample images to save. Defaults to 5.
             crop_to_square_pre_resize (str): Whether or not to crop the images to a square before resizing. Possible values are "none", "center" and "random". Defaults to "none".
+            weights_path (str): Path to the weights of feature extractors loading them from local files, such as cityscapes_resnet101. If empty, an environment variable or default location is used. Defaults to "".
+            activation_ranges_path (str): Path to the activation ranges of feature extractors loading them from local files, such as cityscapes_resnet101. If empty, an environment variable or default location is used. Defaults to "".
+            offline (Optional[bool]): Whether to only use weights and activation ranges already in the local cache, failing if they are missing instead of downloading them. If None, offline mode is enabled by setting the VDNA_OFFLINE environment variable to 1. Defaults to None.
+            hist_accumulation_dtype (str): The integer type used to accumulate histogram counts over batches, "int32" or "int64". Counts accumulated in int32 use half the memory and are promoted to int64 if they would overflow. Defaults to "int64".
+            adaptive_range_num_images (int): The number of images used to estimate the activation range of each neuron before building histograms with adaptive ranges, e.g. "histogram-1000-adaptive". Defaults to 500.
+            precision (str): The precision the feature extractor runs in, "fp32" or "bf16" to use bfloat16 autocast. Activations are converted back to float32 before fitting distributions. Defaults to "fp32".
+            memory_format (str): The memory format of the feature extractor and input batches, "contiguous" or "channels_last", which is usually faster for convolutional networks (ResNets, VGG, Inception) on CPU. Defaults to "contiguous".
+            num_threads (int): The number of threads torch uses within operations. If 0, the current setting is kept. Defaults to 0.
+            num_interop_threads (int): The number of threads torch uses between operations. It can only be set before torch runs any parallel work in the process. If 0, the current setting is kept. Defaults to 0.
+            calibration_source (Union[str, Path]): The images used to calibrate the quantization of int8 convolutional feature extractors, such as "vgg16-int8", as a path to a directory, an image or a .txt file. Defaults to "".
+            backend (str): How the feature extractor is run. "eager" runs the PyTorch modules as they are. "compile" uses torch.compile in the current process. "torchscript", "export" (torch.export) and "onnxruntime" (CPU only, needs the onnx extra) export a graph of the network for the input size and batch size used, which is saved in the cache directory and reloaded instantly by later processes. Defaults to "eager".
+            hist_chunk_size (int): The number of images binned at a time when building histograms, which lowers peak memory. If 0, whole batches are binned at once. Defaults to 0.
+            memory_budget_mb (Optional[float]): If given, batch_size and hist_chunk_size are replaced by the ones making the VDNA the fastest while using at most this much memory on the device, in MB, found with autotune. Defaults to None.
+            profile (bool): Whether to measure the time spent loading batches, copying them to the device, running the network and computing statistics of each layer, along with peak memory. The report is kept in the profile_report attribute of the returned VDNA and in last_profile_report, and printed if verbose. On CUDA devices, profiling synchronises the device after each stage, which slows extraction down. Defaults to False.
+            profile_trace_path (Optional[Union[str, Path]]): If given, profiling is enabled and its stages are saved to this path as a Chrome trace in JSON, which can be opened in chrome://tracing or Perfetto. Defaults to None.
+            pretrained (bool): Whether to load the pretrained weights and activation ranges of the feature extractor. If False, the network is initialised randomly with a fixed seed and histograms use placeholder activation ranges of [-1, 1], without downloading any file. VDNAs made this way are only meaningful for benchmarks and tests. Defaults to True.
 
         Returns:
             VDNA: A VDNA (Visual DNA) object that represents the processed images.
         """
+        if memory_budget_mb is not None:
+            tuned = self.autotune(
+                memory_budget_mb,
+                feat_extractor_name=feat_extractor_name,
+                distribution_name=distribution_name,
+                device=device,
+                precision=precision,
+                memory_format=memory_format,
+                backend=backend,
+                num_threads=num_threads,
+                weights_path=str(weights_path),
+                activation_ranges_path=str(activation_ranges_path),
+                offline=offline,
+                calibration_source=str(calibration_source),
+                pretrained=pretrained,
+            )
+            batch_size, hist_chunk_size = tuned["batch_size"], tuned["hist_chunk_size"]
+            if verbose:
+                print(format_autotune_report(tuned))
+
         data_settings = DataSettings(
             source=source,
             num_images=num_images,
@@ -109,23 +291,47 @@ class VDNAProcessor:
             device=device,
             batch_size=batch_size,
             seed=seed,
-            n_sample_images=n_sample_images,
+            # Sample images are only captured when they will be saved
+            n_sample_images=n_sample_images if save_sample_images is not None else 0,
             verbose=verbose,
             num_workers=num_workers,
+            pin_memory=pin_memory,
+            prefetch_factor=prefetch_factor,
+            persistent_workers=persistent_workers,
+            weights_path=str(weights_path),
+            activation_ranges_path=str(activation_ranges_path),
+            offline=offline,
+            hist_accumulation_dtype=hist_accumulation_dtype,
+            adaptive_range_num_images=adaptive_range_num_images,
+            precision=precision,
+            memory_format=memory_format,
+            num_threads=num_threads,
+            num_interop_threads=num_interop_threads,
+            calibration_source=str(calibration_source),
+            backend=backend,
+            hist_chunk_size=hist_chunk_size,
+            profile=profile or profile_trace_path is not None,
+            profile_trace_path=str(profile_trace_path) if profile_trace_path is not None else "",
+            pretrained=pretrained,
         )
-        if feat_extractor_name != self.feat_extractor.name or extraction_settings != self.last_extraction_settings_used:
-            self.feat_extractor = get_feature_extractor(feat_extractor_name, extraction_settings)
-
-            # Compile if we have torch version >= 2.0
-            if torch.__version__ >= "2.0":
-                self.feat_extractor = torch.compile(self.feat_extractor)
-
+        self.feat_extractor = self._get_feat_extractor(feat_extractor_name, extraction_settings)
         self.last_extraction_settings_used = extraction_settings
 
         vdna = get_vdna(distribution_name)
-        sample_images = vdna.fill_vdna(feature_extractor=self.feat_extractor, data_settings=data_settings)
+        sample_images = vdna.fill_vdna(
+            feature_extractor=self.feat_extractor,
+            data_settings=data_settings,
+            dataloader_pool=self.dataloader_pool,
+        )
+        self.last_profile_report = vdna.profile_report
 
         if save_sample_images is not None:
             save_images(save_sample_images, sample_images)
 
         return vdna
+
+    def close(self):
+        """
+        Shut down worker processes kept alive with persistent_workers.
+        """
+        self.dataloader_pool.close()
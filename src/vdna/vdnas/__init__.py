@@ -1,8 +1,13 @@
+import copy
+from dataclasses import replace
+from typing import List
+
 from .vdna_activation_ranges import VDNAActivationRanges
 from .vdna_base import VDNA
 from .vdna_gauss import VDNAGauss
 from .vdna_hist import VDNAHist
 from .vdna_layer_gauss import VDNALayerGauss
+from .vdna_quantiles import VDNAQuantiles
 
 
 def get_vdna(dist_name):
@@ -13,8 +18,54 @@ def get_vdna(dist_name):
     elif "histogram" in dist_name:
         n_bins = int(dist_name.split("-")[1])
         assert n_bins
-        return VDNAHist(hist_nb_bins=n_bins)
+        return VDNAHist(hist_nb_bins=n_bins, adaptive_ranges=dist_name.endswith("-adaptive"))
+    elif dist_name.startswith("quantiles-"):
+        n_quantiles = int(dist_name.split("-")[1])
+        assert n_quantiles
+        return VDNAQuantiles(n_quantiles=n_quantiles)
     elif dist_name == "activation-ranges":
         return VDNAActivationRanges()
+    elif dist_name.startswith("activation-ranges-q"):
+        return VDNAActivationRanges(quantile_percent=float(dist_name[len("activation-ranges-q") :]))
     else:
         raise NotImplementedError("VDNA {} not implemented!".format(dist_name))
+
+
+def merge_vdnas(vdnas: List[VDNA]) -> VDNA:
+    """
+    Merge VDNAs made from different sets of images into the VDNA of all images, such as VDNAs of shards of a dataset.
+
+    VDNAs must use the same feature extractor and distribution. Histograms are summed, after being resampled to common
+    bins if their bins differ, e.g. with adaptive ranges. Gaussians are pooled exactly. Quantiles are taken from the
+    mixture of the quantiles of each VDNA, weighted by their number of images, which is approximate. Activation ranges
+    keep the lowest minimum and the highest maximum.
+
+    Args:
+        vdnas (List[VDNA]): The VDNAs to merge, on the same device.
+
+    Returns:
+        VDNA: A new VDNA for all images, with the settings of the first VDNA.
+    """
+    assert len(vdnas) > 0, "At least one VDNA is needed"
+    first = vdnas[0]
+    for vdna in vdnas[1:]:
+        assert vdna.feature_extractor_name == first.feature_extractor_name, "Feature extractors must be the same"
+        assert vdna.name == first.name, f"Distributions must be the same, got {vdna.name} and {first.name}"
+        assert vdna.neurons_list == first.neurons_list, "Neurons of VDNAs must be the same"
+        assert vdna.device == first.device, "VDNAs must be on the same device"
+
+    merged = get_vdna(first.name)
+    merged.feature_extractor_name = first.feature_extractor_name
+    merged.neurons_list = dict(first.neurons_list)
+    merged.extraction_settings_used = copy.copy(first.extraction_settings_used)
+    sources = [
+        vdna.loaded_from_path if vdna.loaded_from_path != "NotLoaded" else vdna.data_settings_used.source
+        for vdna in vdnas
+    ]
+    if not all(isinstance(source, str) for source in sources):
+        sources = "Merged VDNAs"
+    merged.data_settings_used = replace(first.data_settings_used, source=sources)
+    merged.num_images = sum(vdna.num_images for vdna in vdnas)
+    merged.device = first.device
+    merged._merge_distributions(vdnas)
+    return merged
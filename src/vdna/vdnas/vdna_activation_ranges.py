@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Union
 
 import numpy as np
 import torch
@@ -8,18 +8,33 @@ from .vdna_base import VDNA
 
 
 class VDNAActivationRanges(VDNA):
-    def __init__(self):
+    def __init__(self, quantile_percent: float = 0.0):
         super().__init__()
+        assert 0.0 <= quantile_percent < 50.0, "Quantile should be a percentage in [0, 50)"
         self.type = "activation-ranges"
-        self.name = "activation-ranges"
+        # Raw minimums and maximums are sensitive to outliers. With a quantile, ranges go from the given percentile to
+        # its opposite, e.g. 0.1 keeps ranges between the 0.1th and 99.9th percentiles
+        self.quantile_percent = quantile_percent
+        self.name = "activation-ranges" if quantile_percent == 0 else f"activation-ranges-q{quantile_percent:g}"
         self.data = {}
 
     def _set_extraction_settings(self, feat_extractor):
-        feat_extractor.extraction_settings.keep_only_min_max = True
+        if self.quantile_percent > 0:
+            feat_extractor.extraction_settings.keep_quantile_sketch = True
+        else:
+            feat_extractor.extraction_settings.keep_only_min_max = True
         return feat_extractor
 
     def _fit_distribution(self, features_dict):
         self.data = {}
+        if self.quantile_percent > 0:
+            for layer in features_dict:
+                self.data[layer] = {
+                    "min": features_dict[layer].quantile(self.quantile_percent / 100).float(),
+                    "max": features_dict[layer].quantile(1 - self.quantile_percent / 100).float(),
+                }
+            return
+
         for layer in features_dict:
             self.data[layer] = {}
             # Get minimum over spatial dimensions which are dims 2 and 3. Minimum is stored in the first channel of the last dimension
@@ -31,9 +46,17 @@ class VDNAActivationRanges(VDNA):
                 features_dict[layer][..., 1].reshape(1, features_dict[layer].shape[1], -1), dim=2
             ).values.squeeze()
 
+    def _merge_distributions(self, vdnas: List[VDNA]):
+        # Exact for minimums and maximums. With quantiles, the widest range of all sets of images is kept.
+        self.data = {}
+        for layer in vdnas[0].data:
+            self.data[layer] = {
+                "min": torch.stack([vdna.data[layer]["min"] for vdna in vdnas]).min(dim=0).values,
+                "max": torch.stack([vdna.data[layer]["max"] for vdna in vdnas]).max(dim=0).values,
+            }
 
     def _get_vdna_metadata(self) -> dict:
-        return {}
+        return {"quantile_percent": self.quantile_percent}
 
     def _save_dist_data(self, file_path: Union[str, Path]):
         file_path = Path(file_path).with_suffix(".npz")
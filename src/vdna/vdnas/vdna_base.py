@@ -1,13 +1,17 @@
 import json
 from pathlib import Path
-from typing import Dict, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 
-from ..networks import FeatureExtractionModel
 from ..utils.io import get_saving_metadata
 from ..utils.settings import DataSettings, ExtractionSettings
 
+if TYPE_CHECKING:
+    from ..networks import FeatureExtractionModel
+    from ..utils.im import DataLoaderPool
+
 
 class VDNA:
     def __init__(self):
@@ -21,13 +25,32 @@ class VDNA:
         self.loaded_from_path = "NotLoaded"
         self.neurons_list = {"NotFilled": 0}
         self.device = "cpu"
+        # Report of the stages of extraction, when the VDNA was made with profiling enabled. It is not saved.
+        self.profile_report = None
 
-    def _set_extraction_settings(self, feat_extractor: FeatureExtractionModel):
+    def _set_extraction_settings(self, feat_extractor: "FeatureExtractionModel"):
         raise NotImplementedError
 
     def _fit_distribution(self, features_dict: Dict):
         raise NotImplementedError
 
+    def _merge_distributions(self, vdnas: List["VDNA"]):
+        raise NotImplementedError
+
+    def _get_norm_params(self, feat_extractor: "FeatureExtractionModel") -> Optional[Tuple[Dict, Dict]]:
+        # Normalisation parameters replacing those of the activation ranges of the feature extractor, if any
+        return None
+
+    def _get_data_features(
+        self,
+        feat_extractor: "FeatureExtractionModel",
+        data_settings: DataSettings,
+        dataloader_pool: Optional["DataLoaderPool"] = None,
+    ):
+        return feat_extractor.get_data_features(
+            data_settings, dataloader_pool, norm_params=self._get_norm_params(feat_extractor)
+        )
+
     def _get_vdna_metadata(self) -> dict:
         raise NotImplementedError
 
@@ -43,6 +66,10 @@ class VDNA:
             metadata["data_settings"]["source"][0], np.ndarray
         ):
             metadata["data_settings"]["source"] = "Provided NumPy Arrays - not saved in metadata"
+        elif isinstance(metadata["data_settings"]["source"], np.ndarray):
+            metadata["data_settings"]["source"] = "Provided stacked NumPy array - not saved in metadata"
+        elif isinstance(metadata["data_settings"]["source"], torch.Tensor):
+            metadata["data_settings"]["source"] = "Provided stacked tensor - not saved in metadata"
         metadata["extraction_settings"] = self.extraction_settings_used.__dict__
         metadata["num_images"] = self.num_images
         metadata["feature_extractor_name"] = self.feature_extractor_name
@@ -69,14 +96,22 @@ class VDNA:
     def _load_dist_data(self, dist_metadata: Dict, file_path: Union[str, Path], device: str):
         raise NotImplementedError
 
-    def fill_vdna(self, feature_extractor: FeatureExtractionModel, data_settings: DataSettings):
+    def fill_vdna(
+        self,
+        feature_extractor: "FeatureExtractionModel",
+        data_settings: DataSettings,
+        dataloader_pool: Optional["DataLoaderPool"] = None,
+    ):
         feat_extractor = self._set_extraction_settings(feature_extractor)
         self.device = str(feature_extractor.extraction_settings.device)
         self.extraction_settings_used = feat_extractor.extraction_settings
         self.data_settings_used = data_settings
         self.feature_extractor_name = feat_extractor.name
         self.neurons_list = feat_extractor.network_settings.neurons_per_layer
-        features_dict, self.num_images, sample_images = feat_extractor.get_data_features(data_settings)
+        features_dict, self.num_images, sample_images = self._get_data_features(
+            feat_extractor, data_settings, dataloader_pool
+        )
+        self.profile_report = feat_extractor.last_profile_report
 
         self._fit_distribution(features_dict)
         return sample_images
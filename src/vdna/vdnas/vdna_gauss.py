@@ -1,12 +1,14 @@
 from pathlib import Path
-from typing import Dict, Union
+from typing import TYPE_CHECKING, Dict, List, Union
 
 import numpy as np
 import torch
 
-from ..networks import FeatureExtractionModel
 from .vdna_base import VDNA
 
+if TYPE_CHECKING:
+    from ..networks import FeatureExtractionModel
+
 
 def _get_gaussian_params(features: torch.Tensor) -> Dict[str, torch.Tensor]:
     features = features.view(features.shape[0], -1)
@@ -26,7 +28,7 @@ class VDNAGauss(VDNA):
         self.name = "gaussian"
         self.data = {}
 
-    def _set_extraction_settings(self, feat_extractor: FeatureExtractionModel) -> FeatureExtractionModel:
+    def _set_extraction_settings(self, feat_extractor: "FeatureExtractionModel") -> "FeatureExtractionModel":
         feat_extractor.extraction_settings.average_feats_spatially = True
         return feat_extractor
 
@@ -35,6 +37,20 @@ class VDNAGauss(VDNA):
         for layer in features_dict:
             self.data[layer] = _get_gaussian_params(features_dict[layer])
 
+    def _merge_distributions(self, vdnas: List[VDNA]):
+        # Pooled mean and unbiased variance of all images, from the mean and variance of each set of images
+        num_images = sum(vdna.num_images for vdna in vdnas)
+        self.data = {}
+        for layer in vdnas[0].data:
+            mus = torch.stack([vdna.data[layer]["mu"].double() for vdna in vdnas])
+            variances = torch.stack([vdna.data[layer]["var"].double() for vdna in vdnas])
+            counts = torch.tensor([vdna.num_images for vdna in vdnas], dtype=torch.double, device=mus.device)[:, None]
+            mu = torch.sum(counts * mus, dim=0) / num_images
+            sum_squares = torch.sum((counts - 1) * variances + counts * torch.square(mus - mu), dim=0)
+            var = sum_squares / (num_images - 1) if num_images > 1 else torch.zeros_like(mu)
+            dtype = vdnas[0].data[layer]["mu"].dtype
+            self.data[layer] = {"mu": mu.to(dtype), "var": var.to(dtype)}
+
     def _get_vdna_metadata(self) -> dict:
         return {}
 
@@ -1,49 +1,234 @@
+import copy
+from dataclasses import replace
 from pathlib import Path
-from typing import Dict, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 
-from ..networks import FeatureExtractionModel
+from ..utils.settings import DataSettings
+from ..utils.stats import resample_histograms
+from .vdna_activation_ranges import VDNAActivationRanges
 from .vdna_base import VDNA
 
+if TYPE_CHECKING:
+    from ..networks import FeatureExtractionModel
+    from ..utils.im import DataLoaderPool
+
+
+# Types histogram counts can be saved with. "auto" picks the smallest integer type holding all counts, and "float16"
+# saves normalised histograms with the total count of each neuron, which is approximate.
+HIST_STORAGE_DTYPES = ["auto", "uint16", "uint32", "int32", "int64", "float16"]
+
+# Type used to save the position of each non-zero bin in sparse storage, as the gap from the previous one so that
+# positions compress well
+SPARSE_INDEX_DTYPE = np.uint32
+
+
+def compact_counts(counts: torch.Tensor) -> torch.Tensor:
+    # Keep counts in int32 in memory unless they do not fit
+    if counts.numel() > 0 and counts.max() > torch.iinfo(torch.int32).max:
+        return counts.to(torch.int64)
+    return counts.to(torch.int32)
+
 
 class VDNAHist(VDNA):
-    def __init__(self, hist_nb_bins: int = 2000):
+    def __init__(
+        self,
+        hist_nb_bins: int = 2000,
+        storage_dtype: str = "auto",
+        sparse_storage: Optional[bool] = None,
+        adaptive_ranges: bool = False,
+    ):
         super().__init__()
+        assert storage_dtype in HIST_STORAGE_DTYPES, f"Storage dtype must be one of {HIST_STORAGE_DTYPES}"
         self.type = "histogram"
-        self.name = "histogram-" + str(hist_nb_bins)
+        self.name = "histogram-" + str(hist_nb_bins) + ("-adaptive" if adaptive_ranges else "")
         self.hist_nb_bins = hist_nb_bins
+        # How histograms are saved. If sparse_storage is None, sparse storage is used when it is smaller.
+        self.storage_dtype = storage_dtype
+        self.sparse_storage = sparse_storage
+        # With adaptive ranges, the range of each neuron is estimated on a subset of images before building histograms,
+        # instead of using the activation ranges of the feature extractor
+        self.adaptive_ranges = adaptive_ranges
         self.data = {}
+        # Lower and upper edges of the bins of each neuron in activation units, as (neurons, 2) tensors per layer
+        self.bin_ranges = {}
 
-    def _set_extraction_settings(self, feat_extractor: FeatureExtractionModel) -> FeatureExtractionModel:
+    def _set_extraction_settings(self, feat_extractor: "FeatureExtractionModel") -> "FeatureExtractionModel":
         feat_extractor.extraction_settings.accumulate_spatial_feats_in_hist = True
         feat_extractor.extraction_settings.accumulate_sample_feats_in_hist = True
         feat_extractor.extraction_settings.hist_nb_bins = self.hist_nb_bins
         feat_extractor.extraction_settings.normalise_feats = True
         return feat_extractor
 
+    def _get_data_features(
+        self,
+        feat_extractor: "FeatureExtractionModel",
+        data_settings: DataSettings,
+        dataloader_pool: Optional["DataLoaderPool"] = None,
+    ):
+        norm_params = None
+        if self.adaptive_ranges:
+            norm_params = self._get_adaptive_norm_params(feat_extractor, data_settings, dataloader_pool)
+        self.bin_ranges = feat_extractor.get_hist_bin_ranges(norm_params)
+        return feat_extractor.get_data_features(data_settings, dataloader_pool, norm_params=norm_params)
+
+    def _get_adaptive_norm_params(
+        self,
+        feat_extractor: "FeatureExtractionModel",
+        data_settings: DataSettings,
+        dataloader_pool: Optional["DataLoaderPool"] = None,
+    ) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        from ..networks.feature_extraction_model import get_pre_hist_norm_params_from_min_max
+
+        extraction_settings = feat_extractor.extraction_settings
+        num_images = extraction_settings.adaptive_range_num_images
+        source = data_settings.source
+        if isinstance(source, (np.ndarray, torch.Tensor)) or (
+            isinstance(source, list) and len(source) > 0 and isinstance(source[0], np.ndarray)
+        ):
+            pre_pass_data_settings = replace(data_settings, source=source[:num_images])
+        else:
+            if data_settings.num_images > 0:
+                num_images = min(num_images, data_settings.num_images)
+            pre_pass_data_settings = replace(data_settings, num_images=num_images, shuffle_files=True)
+
+        # Pre-pass keeping minimum and maximum activations, with the feature extractor set up as for activation ranges
+        feat_extractor.extraction_settings = replace(
+            extraction_settings,
+            accumulate_spatial_feats_in_hist=False,
+            accumulate_sample_feats_in_hist=False,
+            normalise_feats=False,
+            keep_only_min_max=True,
+            keep_quantile_sketch=False,
+            n_sample_images=0,
+            description=(extraction_settings.description + " (range pre-pass)").strip(),
+        )
+        try:
+            features_dict, _, _ = feat_extractor.get_data_features(pre_pass_data_settings, dataloader_pool)
+        finally:
+            feat_extractor.extraction_settings = extraction_settings
+        ranges = VDNAActivationRanges()
+        ranges._fit_distribution(features_dict)
+
+        # Ranges are widened around their centre, as images outside of the pre-pass can go beyond them
+        min_max_per_neuron = {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+        for layer, layer_ranges in ranges.data.items():
+            mins = layer_ranges["min"].reshape(-1).double().cpu().numpy()
+            maxs = layer_ranges["max"].reshape(-1).double().cpu().numpy()
+            centres = (mins + maxs) / 2
+            half_widths = (maxs - mins) / 2 * extraction_settings.range_scale_for_norm_params
+            min_max_per_neuron["mins_per_neuron"][layer] = centres - half_widths
+            min_max_per_neuron["maxs_per_neuron"][layer] = centres + half_widths
+        return get_pre_hist_norm_params_from_min_max(min_max_per_neuron, 1.0, device=extraction_settings.device)
+
     def _fit_distribution(self, features_dict: Dict[str, torch.Tensor]):
         # Already put in histograms during processing thanks to the extraction_settings
-        self.data = features_dict
+        self.data = {layer: compact_counts(hist) for layer, hist in features_dict.items()}
+
+    def _merge_distributions(self, vdnas: List[VDNA]):
+        # Histograms with different bins, such as histograms with adaptive ranges, are resampled to common bins first,
+        # which rounds the counts of resampled bins
+        merged = vdnas[0]
+        for vdna in vdnas[1:]:
+            merged, vdna = resample_to_common_bins(merged, vdna)
+            data = {layer: merged.data[layer].double() + vdna.data[layer].double() for layer in merged.data}
+            merged = copy.copy(merged)
+            merged.data = data
+        self.data = {layer: compact_counts(torch.round(hist.double())) for layer, hist in merged.data.items()}
+        self.bin_ranges = dict(merged.bin_ranges)
+        self.hist_nb_bins = merged.hist_nb_bins
+        self.storage_dtype = vdnas[0].storage_dtype
+        self.sparse_storage = vdnas[0].sparse_storage
+
+    def get_storage_format(self) -> Tuple[str, bool]:
+        """Get the dtype and whether sparse storage is used to save the histograms."""
+        max_count = max((int(hist.max()) for hist in self.data.values() if hist.numel() > 0), default=0)
+        storage_dtype = self.storage_dtype
+        if storage_dtype == "auto":
+            storage_dtype = next(
+                dtype for dtype in ["uint16", "uint32", "int64"] if max_count <= np.iinfo(dtype).max
+            )
+        elif storage_dtype != "float16" and max_count > np.iinfo(storage_dtype).max:
+            raise ValueError(f"Histogram counts up to {max_count} do not fit in {storage_dtype}")
+
+        sparse_storage = self.sparse_storage
+        if sparse_storage is None:
+            n_bins = sum(hist.numel() for hist in self.data.values())
+            n_non_zero = sum(int(torch.count_nonzero(hist)) for hist in self.data.values())
+            itemsize = np.dtype(storage_dtype).itemsize
+            sparse_storage = n_non_zero * (itemsize + np.dtype(SPARSE_INDEX_DTYPE).itemsize) < n_bins * itemsize
+        return storage_dtype, sparse_storage
 
     def _get_vdna_metadata(self) -> dict:
-        return {"hist_nb_bins": self.hist_nb_bins}
+        storage_dtype, sparse_storage = self.get_storage_format()
+        return {
+            "hist_nb_bins": self.hist_nb_bins,
+            "storage_dtype": storage_dtype,
+            "sparse_storage": sparse_storage,
+            "adaptive_ranges": self.adaptive_ranges,
+        }
 
     def _save_dist_data(self, file_path: Union[str, Path]):
         file_path = Path(file_path).with_suffix(".npz")
+        storage_dtype, sparse_storage = self.get_storage_format()
         data = {}
         for layer in self.data:
-            data[layer] = self.data[layer].cpu().numpy().astype(np.int32)
+            counts = self.data[layer].cpu().numpy()
+            if storage_dtype == "float16":
+                totals = counts.sum(axis=1, dtype=np.int64)
+                values = (counts / np.maximum(totals, 1)[:, None]).astype(np.float16)
+                data["totals-" + layer] = totals
+            else:
+                values = counts.astype(storage_dtype)
+
+            if sparse_storage:
+                values = values.reshape(-1)
+                indices = np.flatnonzero(values)
+                data["index_gaps-" + layer] = np.diff(indices, prepend=0).astype(SPARSE_INDEX_DTYPE)
+                data["values-" + layer] = values[indices]
+            else:
+                data["hist-" + layer] = values
+
+            if layer in self.bin_ranges:
+                data["bin_range-" + layer] = self.bin_ranges[layer].cpu().numpy().astype(np.float32)
         np.savez_compressed(file_path, **data)
 
     def _load_dist_data(self, dist_metadata: Dict, file_path: Union[str, Path], device: str):
         file_path = Path(file_path).with_suffix(".npz")
         self.hist_nb_bins = dist_metadata["hist_nb_bins"]
+        self.adaptive_ranges = dist_metadata.get("adaptive_ranges", False)
         loaded_data = np.load(file_path)
         self.data = {}
-        for layer in loaded_data:
-            self.data[layer] = torch.from_numpy(loaded_data[layer]).to(device)
+        self.bin_ranges = {}
+        if "storage_dtype" not in dist_metadata:
+            # Histograms saved before storage options were added are dense int32 arrays named after their layer
+            for layer in loaded_data:
+                self.data[layer] = torch.from_numpy(loaded_data[layer]).to(device)
+            return
+
+        sparse_storage = dist_metadata["sparse_storage"]
+        value_prefix = "values-" if sparse_storage else "hist-"
+        for key in loaded_data.files:
+            if not key.startswith(value_prefix):
+                continue
+            layer = key[len(value_prefix) :]
+            values = loaded_data[key]
+            if sparse_storage:
+                dense = np.zeros(self.neurons_list[layer] * self.hist_nb_bins, dtype=values.dtype)
+                dense[np.cumsum(loaded_data["index_gaps-" + layer], dtype=np.int64)] = values
+                values = dense.reshape(self.neurons_list[layer], self.hist_nb_bins)
+
+            if dist_metadata["storage_dtype"] == "float16":
+                totals = loaded_data["totals-" + layer]
+                counts = torch.round(torch.from_numpy(values).double() * torch.from_numpy(totals)[:, None])
+            else:
+                # Unsigned types are widened as torch has limited support for them
+                counts = torch.from_numpy(values.astype(np.int64))
+            self.data[layer] = compact_counts(counts).to(device)
+            if "bin_range-" + layer in loaded_data.files:
+                self.bin_ranges[layer] = torch.from_numpy(loaded_data["bin_range-" + layer]).to(device)
 
     def get_neuron_dist(self, layer_name: str, neuron_idx: int) -> torch.Tensor:
         return self.data[layer_name][neuron_idx].reshape(1, -1)
@@ -56,3 +241,86 @@ class VDNAHist(VDNA):
         for layer in self.data:
             histograms.append(self.get_all_neurons_in_layer_dist(layer))
         return torch.cat(histograms)
+
+
+def _has_bin_ranges(vdna: VDNAHist) -> bool:
+    return all(layer in vdna.bin_ranges for layer in vdna.data)
+
+
+def _share_bins(vdna1: VDNAHist, vdna2: VDNAHist) -> bool:
+    # Whether histograms of two VDNAs can be compared bin by bin, raising if it cannot be known
+    if (vdna1.adaptive_ranges or vdna2.adaptive_ranges) and not (_has_bin_ranges(vdna1) and _has_bin_ranges(vdna2)):
+        # Each VDNA with adaptive ranges has its own ranges, which are needed to compare it to any other VDNA
+        raise ValueError("Histograms with adaptive ranges can only be compared or merged if both VDNAs have bin ranges")
+    if not vdna1.bin_ranges or not vdna2.bin_ranges:
+        # Histograms saved without bin ranges use the activation ranges of the feature extractor, as they did before
+        # ranges were saved
+        if vdna1.hist_nb_bins != vdna2.hist_nb_bins:
+            raise ValueError("Histograms with different bins can only be compared if both VDNAs have bin ranges")
+        return True
+    return (
+        vdna1.hist_nb_bins == vdna2.hist_nb_bins
+        and vdna1.bin_ranges.keys() == vdna2.bin_ranges.keys()
+        and all(torch.equal(vdna1.bin_ranges[layer], vdna2.bin_ranges[layer]) for layer in vdna1.bin_ranges)
+    )
+
+
+def _resample_vdna(vdna: VDNAHist, bin_ranges: Dict, hist_nb_bins: int, clamp_to_range: bool) -> VDNAHist:
+    vdna = copy.copy(vdna)
+    vdna.data = {
+        layer: resample_histograms(hists, vdna.bin_ranges[layer], bin_ranges[layer], hist_nb_bins, clamp_to_range)
+        for layer, hists in vdna.data.items()
+    }
+    vdna.bin_ranges = bin_ranges
+    vdna.hist_nb_bins = hist_nb_bins
+    return vdna
+
+
+def resample_to_bins_of(vdna1: VDNAHist, vdna2: VDNAHist) -> Tuple[VDNAHist, VDNAHist]:
+    """
+    Get vdna1 and a copy of vdna2 whose histograms are resampled to the bins of vdna1, so that they can be compared.
+
+    Distances are then measured in bins of vdna1 whatever the second VDNA is, so distances of several VDNAs to the
+    same first VDNA can be ranked. Counts of vdna2 outside of the range of a neuron in vdna1 are moved to its first or
+    last bin, as activations outside of the range are when histograms are built. Activations are assumed to be spread
+    uniformly within each bin. VDNAs which already share their bins are returned unchanged.
+
+    Raises:
+        ValueError: If the bins of either VDNA are unknown, e.g. histograms with adaptive ranges or different numbers of
+            bins saved without bin ranges.
+    """
+    if _share_bins(vdna1, vdna2):
+        return vdna1, vdna2
+    return vdna1, _resample_vdna(vdna2, vdna1.bin_ranges, vdna1.hist_nb_bins, clamp_to_range=True)
+
+
+def resample_to_common_bins(vdna1: VDNAHist, vdna2: VDNAHist) -> Tuple[VDNAHist, VDNAHist]:
+    """
+    Get copies of two histogram VDNAs with the same bins for each neuron, so that they can be merged.
+
+    Histograms built with different bin ranges or numbers of bins are resampled to bins spanning both ranges, with the
+    largest number of bins, assuming activations are spread uniformly within each bin. VDNAs which already share their
+    bins are returned unchanged.
+
+    Raises:
+        ValueError: If the bins of either VDNA are unknown, e.g. histograms with adaptive ranges or different numbers of
+            bins saved without bin ranges.
+    """
+    if _share_bins(vdna1, vdna2):
+        return vdna1, vdna2
+
+    hist_nb_bins = max(vdna1.hist_nb_bins, vdna2.hist_nb_bins)
+    common_bin_ranges = {
+        layer: torch.stack(
+            (
+                torch.minimum(vdna1.bin_ranges[layer][:, 0], vdna2.bin_ranges[layer][:, 0]),
+                torch.maximum(vdna1.bin_ranges[layer][:, 1], vdna2.bin_ranges[layer][:, 1]),
+            ),
+            dim=1,
+        )
+        for layer in vdna1.data
+    }
+    return (
+        _resample_vdna(vdna1, common_bin_ranges, hist_nb_bins, clamp_to_range=False),
+        _resample_vdna(vdna2, common_bin_ranges, hist_nb_bins, clamp_to_range=False),
+    )
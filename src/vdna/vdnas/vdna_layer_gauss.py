@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Union
 
 import numpy as np
 import torch
@@ -54,6 +54,20 @@ class VDNALayerGauss(VDNA):
         for layer in features_dict:
             self.data[layer] = _get_gaussian_params(features_dict[layer])
 
+    def _merge_distributions(self, vdnas: List[VDNA]):
+        # Pooled mean and unbiased covariance of all images, from the mean and covariance of each set of images
+        num_images = sum(vdna.num_images for vdna in vdnas)
+        self.data = {}
+        for layer in vdnas[0].data:
+            mu = sum(vdna.num_images * vdna.data[layer]["mu"].double() for vdna in vdnas) / num_images
+            sum_squares = 0
+            for vdna in vdnas:
+                diff = vdna.data[layer]["mu"].double() - mu
+                sum_squares = sum_squares + (vdna.num_images - 1) * vdna.data[layer]["sigma"].double()
+                sum_squares = sum_squares + vdna.num_images * torch.outer(diff, diff)
+            sigma = sum_squares / (num_images - 1) if num_images > 1 else torch.zeros_like(sum_squares)
+            self.data[layer] = {"mu": mu, "sigma": sigma}
+
     def get_neuron_dist(self, layer_name: str, neuron_idx: int):
         return {
             "mu": self.data[layer_name]["mu"][neuron_idx],
@@ -0,0 +1,92 @@
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from ..utils.stats import merge_quantiles, quantile_levels
+from .vdna_base import VDNA
+
+if TYPE_CHECKING:
+    from ..networks import FeatureExtractionModel
+
+
+class VDNAQuantiles(VDNA):
+    def __init__(self, n_quantiles: int = 256):
+        super().__init__()
+        self.type = "quantiles"
+        self.name = "quantiles-" + str(n_quantiles)
+        # Each neuron keeps the values of its normalised activations at n_quantiles levels of equal probability mass,
+        # which are estimated with a streaming sketch during extraction
+        self.n_quantiles = n_quantiles
+        # Quantiles need no bins, so layers without activation ranges in the feature extractor keep raw activations
+        self.raw_layers = []
+        self.data = {}
+
+    def _set_extraction_settings(self, feat_extractor: "FeatureExtractionModel") -> "FeatureExtractionModel":
+        feat_extractor.extraction_settings.keep_quantile_sketch = True
+        feat_extractor.extraction_settings.quantile_sketch_levels = max(
+            feat_extractor.extraction_settings.quantile_sketch_levels, 2 * self.n_quantiles + 1
+        )
+        feat_extractor.extraction_settings.normalise_feats = True
+        self.raw_layers = [
+            layer
+            for layer in feat_extractor.network_settings.neurons_per_layer
+            if layer not in feat_extractor.norm_means_per_layer
+        ]
+        return feat_extractor
+
+    def _get_norm_params(self, feat_extractor: "FeatureExtractionModel") -> Optional[Tuple[Dict, Dict]]:
+        if not self.raw_layers:
+            return None
+        norm_means_per_layer = dict(feat_extractor.norm_means_per_layer)
+        norm_stds_per_layer = dict(feat_extractor.norm_stds_per_layer)
+        device = feat_extractor.extraction_settings.device
+        for layer in self.raw_layers:
+            norm_means_per_layer[layer] = torch.zeros(1, 1, 1, 1, dtype=torch.double, device=device)
+            norm_stds_per_layer[layer] = torch.ones(1, 1, 1, 1, dtype=torch.double, device=device)
+        return norm_means_per_layer, norm_stds_per_layer
+
+    def _fit_distribution(self, features_dict: Dict):
+        levels = quantile_levels(self.n_quantiles)
+        self.data = {layer: features_dict[layer].quantiles(levels).float() for layer in features_dict}
+
+    def _merge_distributions(self, vdnas: List[VDNA]):
+        assert all(vdna.raw_layers == vdnas[0].raw_layers for vdna in vdnas), "Quantiles must be normalised alike"
+        self.raw_layers = list(vdnas[0].raw_layers)
+        weights = [vdna.num_images for vdna in vdnas]
+        self.data = {
+            layer: merge_quantiles([vdna.data[layer] for vdna in vdnas], weights, self.n_quantiles).float()
+            for layer in vdnas[0].data
+        }
+
+    def _get_vdna_metadata(self) -> dict:
+        return {"n_quantiles": self.n_quantiles, "raw_layers": self.raw_layers}
+
+    def _save_dist_data(self, file_path: Union[str, Path]):
+        file_path = Path(file_path).with_suffix(".npz")
+        data = {}
+        for layer in self.data:
+            data[layer] = self.data[layer].cpu().numpy().astype(np.float32)
+        np.savez_compressed(file_path, **data)
+
+    def _load_dist_data(self, dist_metadata: Dict, file_path: Union[str, Path], device: str):
+        file_path = Path(file_path).with_suffix(".npz")
+        self.n_quantiles = dist_metadata["n_quantiles"]
+        self.raw_layers = dist_metadata.get("raw_layers", [])
+        loaded_data = np.load(file_path)
+        self.data = {}
+        for layer in loaded_data:
+            self.data[layer] = torch.from_numpy(loaded_data[layer]).to(device)
+
+    def get_neuron_dist(self, layer_name: str, neuron_idx: int) -> torch.Tensor:
+        return self.data[layer_name][neuron_idx].reshape(1, -1)
+
+    def get_all_neurons_in_layer_dist(self, layer_name: str) -> torch.Tensor:
+        return self.data[layer_name]
+
+    def get_all_neurons_dists(self) -> torch.Tensor:
+        quantiles = []
+        for layer in self.data:
+            quantiles.append(self.get_all_neurons_in_layer_dist(layer))
+        return torch.cat(quantiles)
@@ -6,7 +6,7 @@ import pytest
 
 from vdna import NFD, VDNAProcessor
 
-from utils import get_test_vdnas, check_save_load, compare_vdnas
+from utils import ConvFeatExtractor, get_test_vdnas, check_save_load, compare_vdnas
 
 
 @pytest.mark.parametrize(
@@ -202,6 +202,769 @@ class TestVDNAs:
         )
 
 
+def test_import_is_lazy():
+    from vdna.benchmarks.import_time import measure_import
+
+    assert measure_import()["imported"] == []
+
+
+def test_list_feature_extractors():
+    from vdna.benchmarks.import_time import measure_import
+    from vdna.networks import get_extractor_spec, list_feature_extractors
+
+    assert "mugs_vit_base" in list_feature_extractors()
+    assert get_extractor_spec("mugs_vit_base").network_settings.neurons_per_layer["last_norm"] == 768
+    assert get_extractor_spec("vgg16-int8").layers == get_extractor_spec("vgg16").layers
+    # Listing extractors and their layers should not import any model
+    statement = "from vdna.networks import get_extractor_spec, list_feature_extractors; "
+    statement += "[get_extractor_spec(name).layers for name in list_feature_extractors()]"
+    assert measure_import(statement)["imported"] == []
+
+
+def test_network_settings_from_spec(tmp_path, monkeypatch):
+    import vdna.networks
+    from vdna.networks import dino_vit, get_extractor_spec, get_feature_extractor
+    from vdna.utils.settings import ExtractionSettings
+
+    extraction_settings = ExtractionSettings(device="cpu", pretrained=False, offline=True)
+    for name in ["rand_resnet50", "dino_vit_small", "clip_im_rn50"]:
+        model = get_feature_extractor(name, extraction_settings)
+        # Networks are built with a copy of the settings of their spec
+        assert model.network_settings == get_extractor_spec(name).network_settings
+        assert model.network_settings is not get_extractor_spec(name).network_settings
+    assert "CityscapesResnet101FeatExtractor" in dir(vdna.networks)
+    assert vdna.networks.DINOResnet50FeatExtractor.__module__ == "vdna.networks.dino_resnet50"
+
+    # Weights are loaded from the source declared in the spec
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        dino_vit, "load_network_activation_ranges", lambda *args: {"mins_per_neuron": {}, "maxs_per_neuron": {}}
+    )
+    with pytest.raises(FileNotFoundError, match=get_extractor_spec("dino_vit_base").weights_source):
+        get_feature_extractor("dino_vit_base", ExtractionSettings(device="cpu", offline=True))
+
+
+def test_model_cache(monkeypatch):
+    from vdna import VDNAProcessor, vdna_processor
+    from vdna.networks import ModelCache
+    from vdna.networks.model_cache import get_model_memory_size
+    from vdna.utils.settings import ExtractionSettings
+
+    built = []
+
+    def get_feature_extractor(name, extraction_settings):
+        built.append(name)
+        return ConvFeatExtractor(extraction_settings, out_channels=2, kernel_size=1, name=name)
+
+    monkeypatch.setattr(vdna_processor, "get_feature_extractor", get_feature_extractor)
+    processor = VDNAProcessor(max_cached_models=2)
+
+    # Models are reused, and the least recently used one is evicted first
+    for name in ["a", "a", "b", "a", "c"]:
+        processor.warmup(name, device="cpu")
+    assert built == ["a", "b", "c"]
+    assert [key[0] for key in processor.model_cache.models] == ["a", "c"]
+    processor.warmup("b", device="cpu")
+    assert built == ["a", "b", "c", "b"]
+    assert [key[0] for key in processor.model_cache.models] == ["c", "b"]
+
+    assert processor.evict("b", device="cuda:0") == 0
+    assert processor.evict("b", device="cpu") == 1
+    assert processor.evict() == 1 and len(processor.model_cache) == 0
+
+    # The most recent model is kept even if it alone exceeds the memory limit
+    settings = ExtractionSettings(device="cpu")
+    model = get_feature_extractor("a", settings)
+    cache = ModelCache(max_memory_mb=1.5 * get_model_memory_size(model) / 2**20)
+    cache.add("a", settings, model)
+    cache.add("b", settings, get_feature_extractor("b", settings))
+    assert cache.get("a", settings) is None and cache.get("b", settings) is not None
+    cache = ModelCache(max_memory_mb=0)
+    cache.add("a", settings, model)
+    assert cache.get("a", settings) is model
+
+
+def test_artifact_cache(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from vdna.networks import inception_pytorch
+    from vdna.utils import cache
+    from vdna.utils.settings import ExtractionSettings
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path))
+
+    def download(key):
+        raise AssertionError(f"{key} should not be downloaded")
+
+    monkeypatch.setattr(cache, "_download_artifact", download)
+    settings = ExtractionSettings(hub_repo="user/repo", offline=True)
+    with pytest.raises(FileNotFoundError):
+        cache.get_artifact("hf://weights.pth", settings)
+
+    # Cached artifacts are read without network access
+    path = tmp_path / "weights.pth"
+    path.write_bytes(b"weights")
+    cache.register_artifact("hf://user/repo/weights.pth", path)
+    assert cache.get_artifact("hf://weights.pth", settings) == path.resolve()
+
+    # Concurrent registrations keep the entries of each other
+    keys = [f"hf://user/repo/{i}.pth" for i in range(32)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda key: cache.register_artifact(key, path), keys))
+    assert set(keys) <= set(cache.load_manifest()) and cache.verify_artifacts() == []
+
+    # Public constructors of networks load their weights through the cache too
+    monkeypatch.setattr(
+        inception_pytorch,
+        "load_network_activation_ranges",
+        lambda *args: {"mins_per_neuron": {}, "maxs_per_neuron": {}},
+    )
+    with pytest.raises(FileNotFoundError, match="inception_v3_google"):
+        inception_pytorch.InceptionV3(use_fid_inception=False, extraction_settings=settings)
+
+
+def test_activation_ranges_formats(tmp_path, monkeypatch):
+    import json
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path / "cache"))
+
+    from vdna.networks.feature_extraction_model import get_pre_hist_norm_params_from_min_max
+    from vdna.utils.io import convert_activation_ranges, load_activation_ranges
+
+    ranges = {
+        "mins_per_neuron": {"block_0": {"0": -1.0, "1": 0.5}, "block_1": {"0": -2.0}},
+        "maxs_per_neuron": {"block_0": {"0": 1.0, "1": 2.5}, "block_1": {"0": 3.0}},
+    }
+    json_path = tmp_path / "activation_ranges.json"
+    json_path.write_text(json.dumps(ranges))
+    npz_path = convert_activation_ranges(json_path)
+
+    means, stds = get_pre_hist_norm_params_from_min_max(ranges, 1.2)
+    for loaded in [load_activation_ranges(json_path), load_activation_ranges(npz_path)]:
+        loaded_means, loaded_stds = get_pre_hist_norm_params_from_min_max(loaded, 1.2)
+        for layer in means:
+            assert np.allclose(means[layer].numpy(), loaded_means[layer].numpy())
+            assert np.allclose(stds[layer].numpy(), loaded_stds[layer].numpy())
+
+
+def test_resize_dataset_arrays(tmp_path):
+    import torch
+
+    from vdna.utils.im import ResizeDataset
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    kwargs = dict(resize_mode="clean", size=(16, 16))
+    expected = ResizeDataset(images=[img], **kwargs)[0]
+
+    # uint16 arrays are scaled from their full range, and float arrays are expected in [0,255]
+    for array in [img.astype(np.uint16) * 257, img.astype(np.float32)]:
+        assert torch.allclose(ResizeDataset(images=[array], **kwargs)[0], expected, atol=1e-4)
+    # .npy files are memory-mapped instead of decoded with PIL
+    np.save(tmp_path / "img.npy", img.astype(np.uint16) * 257)
+    assert torch.allclose(ResizeDataset(file_paths=[tmp_path / "img.npy"], **kwargs)[0], expected, atol=1e-4)
+
+    # Arrays going through custom PIL transforms keep their scale instead of wrapping around
+    dataset = ResizeDataset(images=[img.astype(np.uint16) * 256], **kwargs)
+    dataset.custom_pil_image_tranform = lambda x: x
+    assert torch.allclose(dataset[0], expected, atol=1.5 / 255)
+
+
+def test_array_batch_dataset():
+    import torch
+
+    from vdna.utils.im import ArrayBatchDataset, ArrayBatchLoader, ResizeDataset
+
+    images = np.random.default_rng(0).integers(0, 256, (5, 40, 48, 3), dtype=np.uint8)
+    for resize_mode in ["clean", "legacy_pytorch"]:
+        kwargs = dict(
+            resize_mode=resize_mode,
+            crop_to_square_pre_resize="center",
+            size=(24, 24),
+            norm_mean=[0.5, 0.5, 0.5],
+            norm_std=[0.25, 0.25, 0.25],
+        )
+        # Batches of stacked images are preprocessed as ResizeDataset preprocesses each image
+        dataset = ResizeDataset(images=list(images), **kwargs)
+        expected = torch.stack([dataset[i] for i in range(len(dataset))])
+        batches = list(ArrayBatchLoader(ArrayBatchDataset(images, **kwargs), batch_size=2))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert torch.allclose(torch.cat(batches), expected, atol=1e-4)
+
+
+def test_dataloader_pool(tmp_path):
+    import torch
+    from PIL import Image
+
+    from vdna.utils.im import DataLoaderPool, ResizeDataset
+
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(5):
+        paths.append(tmp_path / f"{i}.png")
+        Image.fromarray(rng.integers(0, 256, (20, 20, 3), dtype=np.uint8)).save(paths[-1])
+
+    pool = DataLoaderPool()
+    try:
+        key = ("clean", "none", (16, 16))
+        outputs = []
+        for files in [paths[:3], paths[3:]]:
+            dataset = ResizeDataset(file_paths=files, size=(16, 16))
+            dataloader = pool.get_dataloader(dataset, key, batch_size=2, num_workers=1)
+            outputs.append(torch.cat(list(dataloader)))
+            assert torch.allclose(outputs[-1], torch.stack([dataset[i] for i in range(len(files))]))
+            if len(outputs) == 1:
+                workers = dataloader.dataloader._iterator
+            # Workers of the first extraction load the files of the next one with the same preprocessing
+            assert dataloader.dataloader._iterator is workers
+        assert [len(output) for output in outputs] == [3, 2]
+
+        dataloader = pool.get_dataloader(dataset, ("legacy_pytorch", "none", (16, 16)), batch_size=2, num_workers=1)
+        assert dataloader.dataloader._iterator is None
+    finally:
+        pool.close()
+
+
+def test_image_reservoir():
+    import torch
+
+    from vdna.utils.im import ImageReservoir
+
+    images = torch.arange(20.0).reshape(20, 1)
+
+    def sample(seed, batch_size):
+        reservoir = ImageReservoir(5, seed=seed)
+        for batch in torch.split(images, batch_size):
+            reservoir.add_batch(batch)
+        return sorted(int(image) for image in reservoir.images)
+
+    # Samples only depend on the seed, not on how images are split in batches
+    assert sample(0, 3) == sample(0, 7) and len(sample(0, 3)) == 5
+    empty_reservoir = ImageReservoir(0)
+    empty_reservoir.add_batch(images)
+    assert empty_reservoir.images == []
+
+    # Every image is sampled with the same probability
+    counts = torch.zeros(20)
+    for seed in range(2000):
+        counts[sample(seed, 3)] += 1
+    assert torch.allclose(counts / 2000, torch.full((20,), 0.25), atol=0.04)
+
+
+def test_streaming_quantiles():
+    import torch
+
+    from vdna.utils.stats import StreamingQuantiles
+
+    torch.manual_seed(0)
+    batches = [torch.randn(16, 4, 8, 8) ** 3 for _ in range(20)]
+    sketch = StreamingQuantiles()
+    for batch in batches:
+        sketch.update(batch)
+
+    all_values = torch.cat(batches).transpose(0, 1).reshape(4, -1).double()
+    for q in [0.0, 0.001, 0.5, 0.999, 1.0]:
+        assert torch.allclose(sketch.quantile(q), torch.quantile(all_values, q, dim=1), rtol=0.05, atol=1e-2)
+
+
+def test_histogram_per_channel():
+    import torch
+
+    from vdna.utils.stats import get_hist_bin_params, histogram_per_channel, histogram_per_channel_from_bin_params
+
+    torch.manual_seed(0)
+    feats = torch.randn(8, 3, 16, 16) * 0.5
+    hist = histogram_per_channel(feats, hist_nb_bins=50, hist_range=[-1, 1])
+    assert hist.shape == (3, 50)
+    # Every activation falls in exactly one bin, values out of range are clamped to the edge bins
+    assert torch.all(hist.sum(dim=1) == 8 * 16 * 16)
+    for c in range(3):
+        expected = torch.histc(feats[:, c].double().clamp(-1, 1), bins=50, min=-1, max=1)
+        assert (hist[c] - expected).abs().sum() <= 2
+
+    # Binning chunks of samples gives the same counts
+    scale, offset = get_hist_bin_params(torch.zeros(1, 3, 1, 1), torch.ones(1, 3, 1, 1), 50, [-1, 1], feats.dtype)
+    assert torch.equal(histogram_per_channel_from_bin_params(feats, scale, offset, 50, chunk_size=3), hist)
+
+    # NaN activations are ignored, as by torch.histc
+    feats[0, 1, 0, :4] = float("nan")
+    nan_hist = histogram_per_channel(feats, hist_nb_bins=50, hist_range=[-1, 1])
+    assert torch.equal(nan_hist.sum(dim=1), torch.tensor([8 * 16 * 16, 8 * 16 * 16 - 4, 8 * 16 * 16]))
+    assert torch.equal(nan_hist[[0, 2]], hist[[0, 2]])
+
+
+def test_accumulate_histograms():
+    import torch
+
+    from vdna.networks.feature_extraction_model import accumulate_histograms
+
+    hist = torch.full((2, 4), 1000)
+    acc_hist = accumulate_histograms(None, hist, "int32")
+    acc_hist = accumulate_histograms(acc_hist, hist, "int32", n_values_per_neuron=8000)
+    assert acc_hist.dtype == torch.int32 and torch.all(acc_hist == 2000)
+
+    # int32 counts are promoted once the number of values per neuron could overflow them
+    acc_hist = accumulate_histograms(acc_hist, hist, "int32", n_values_per_neuron=2**31)
+    assert acc_hist.dtype == torch.int64 and torch.all(acc_hist == 3000)
+    acc_hist = torch.full((2, 4), 2**31 - 10, dtype=torch.int32)
+    assert accumulate_histograms(acc_hist, hist, "int32").dtype == torch.int64
+    assert accumulate_histograms(None, hist, "int64").dtype == torch.int64
+
+
+def test_hist_storage_formats(tmp_path):
+    import torch
+
+    from vdna import load_vdna_from_files
+    from vdna.vdnas import VDNAHist
+
+    torch.manual_seed(0)
+    vdna = VDNAHist(hist_nb_bins=100)
+    vdna.neurons_list = {"block_0": 3, "block_1": 5}
+    vdna.data = {layer: torch.randint(0, 5, (n, 100)) ** 6 for layer, n in vdna.neurons_list.items()}
+    vdna.data["block_1"][0, 0] = 2**20
+
+    for storage_dtype in ["auto", "uint32", "int64", "float16"]:
+        for sparse_storage in [True, False]:
+            vdna.storage_dtype = storage_dtype
+            vdna.sparse_storage = sparse_storage
+            vdna.save(tmp_path / "vdna")
+            loaded = load_vdna_from_files(tmp_path / "vdna")
+            for layer in vdna.data:
+                if storage_dtype == "float16":
+                    assert torch.allclose(loaded.data[layer].double(), vdna.data[layer].double(), rtol=1e-3, atol=1)
+                else:
+                    assert torch.equal(loaded.data[layer].long(), vdna.data[layer].long())
+
+    vdna.storage_dtype = "uint16"
+    with pytest.raises(ValueError):
+        vdna.save(tmp_path / "vdna")
+
+
+def test_quantiles_emd():
+    import torch
+
+    from vdna.utils.stats import earth_movers_distance, earth_movers_distance_quantiles
+
+    torch.manual_seed(0)
+    samples1 = torch.randn(4, 256)
+    samples2 = torch.randn(4, 128) * 2 + 0.5
+    quantiles1 = torch.sort(samples1, dim=1).values
+    quantiles2 = torch.sort(samples2, dim=1).values
+
+    # Quantiles at all sorted samples give the exact EMD, which fine histograms approximate in bins
+    hists1 = torch.histc(samples1[0].repeat_interleave(128), bins=10000, min=-10, max=10)
+    hists2 = torch.histc(samples2[0].repeat_interleave(256), bins=10000, min=-10, max=10)
+    emd_quantiles = earth_movers_distance_quantiles(quantiles1[:1], quantiles2[:1])
+    emd_hists = earth_movers_distance(hists1.reshape(1, -1), hists2.reshape(1, -1)) * 20 / 10000
+    assert torch.allclose(emd_quantiles, emd_hists, atol=1e-2)
+
+    # Same numbers of quantiles reduce to the mean absolute difference
+    assert torch.allclose(
+        earth_movers_distance_quantiles(quantiles1, quantiles1 + 0.5), torch.full((4,), 0.5, dtype=torch.double)
+    )
+
+
+def test_quantiles_without_activation_ranges(tmp_path):
+    import torch
+
+    from vdna import EMD, load_vdna_from_files
+    from vdna.networks import get_feature_extractor
+    from vdna.utils.settings import DataSettings, ExtractionSettings
+    from vdna.vdnas import get_vdna
+
+    images = np.random.default_rng(0).integers(0, 255, (4, 32, 32, 3), dtype=np.uint8)
+    settings = ExtractionSettings(device="cpu", pretrained=False, num_workers=0, batch_size=2, verbose=False)
+    model = get_feature_extractor("dino_vit_small", settings)
+    vdna = get_vdna("quantiles-16")
+    vdna.fill_vdna(model, DataSettings(source=images))
+
+    # Layers without activation ranges keep quantiles of raw activations
+    layer = next(iter(model.network_settings.neurons_per_layer))
+    del model.norm_means_per_layer[layer], model.norm_stds_per_layer[layer]
+    raw_vdna = get_vdna("quantiles-16")
+    raw_vdna.fill_vdna(model, DataSettings(source=images))
+    assert raw_vdna.raw_layers == [layer]
+    assert not torch.allclose(raw_vdna.data[layer], vdna.data[layer])
+
+    # VDNAs normalised differently refuse to be compared, also once saved and loaded
+    raw_vdna.save(tmp_path / "raw")
+    raw_vdna = load_vdna_from_files(tmp_path / "raw")
+    assert raw_vdna.raw_layers == [layer]
+    with pytest.raises(AssertionError):
+        EMD(vdna, raw_vdna)
+    assert EMD(raw_vdna, raw_vdna) == 0
+
+
+def test_resample_histograms():
+    import torch
+
+    from vdna.utils.stats import histogram_per_channel, resample_histograms
+
+    torch.manual_seed(0)
+    feats = torch.rand(64, 2, 8, 8) - 0.5
+    hists = histogram_per_channel(feats, hist_nb_bins=100, hist_range=[-1, 1])
+    bin_ranges = torch.tensor([[-1.0, 1.0], [-1.0, 1.0]])
+
+    resampled = resample_histograms(hists, bin_ranges, bin_ranges, 100)
+    assert torch.allclose(resampled, hists.double())
+
+    # Resampling to narrower bins matches histograms built directly with them
+    new_bin_ranges = torch.tensor([[-0.5, 0.5], [-0.5, 0.5]])
+    resampled = resample_histograms(hists, bin_ranges, new_bin_ranges, 50)
+    direct = histogram_per_channel(feats, hist_nb_bins=50, hist_range=[-0.5, 0.5])
+    assert torch.allclose(resampled.sum(dim=1), direct.sum(dim=1).double())
+    assert torch.allclose(resampled, direct.double(), atol=2)
+
+
+def test_emd_histograms_with_different_bins():
+    import copy
+
+    import torch
+
+    from vdna import EMD, merge_vdnas
+    from vdna.benchmarks.suite import make_synthetic_vdna
+    from vdna.utils.stats import resample_histograms
+
+    vdna1 = make_synthetic_vdna("histogram-100", "vgg16", num_samples=16, seed=0)
+    vdna2 = make_synthetic_vdna("histogram-100", "vgg16", num_samples=16, seed=1)
+    distance = EMD(vdna1, vdna2)
+
+    # Histograms with adaptive ranges cannot be compared to histograms saved without bin ranges
+    adaptive = copy.copy(vdna2)
+    adaptive.adaptive_ranges = True
+    with pytest.raises(ValueError):
+        EMD(vdna1, adaptive)
+    with pytest.raises(ValueError):
+        merge_vdnas([vdna1, adaptive])
+
+    # Histograms are resampled to the bins of the first VDNA, so distances stay in its units
+    vdna1.bin_ranges = {layer: torch.tensor([[-3.0, 3.0]] * len(hists)) for layer, hists in vdna1.data.items()}
+    adaptive.bin_ranges = {layer: torch.tensor([[-6.0, 6.0]] * len(hists)) for layer, hists in vdna2.data.items()}
+    adaptive.hist_nb_bins = 200
+    adaptive.data = {
+        layer: resample_histograms(hists, vdna1.bin_ranges[layer], adaptive.bin_ranges[layer], 200)
+        for layer, hists in vdna2.data.items()
+    }
+    assert abs(EMD(vdna1, adaptive) - distance) < 1e-6 * distance
+
+
+def test_static_int8_extractor(tmp_path):
+    import torch
+    from PIL import Image
+
+    from vdna.networks import get_feature_extractor
+    from vdna.utils.settings import DataSettings, ExtractionSettings
+
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)).save(tmp_path / f"{i}.png")
+    settings = ExtractionSettings(
+        device="cpu", pretrained=False, num_workers=0, batch_size=2, verbose=False, calibration_source=str(tmp_path)
+    )
+    model = get_feature_extractor("rand_resnet50", settings)
+    quantized = get_feature_extractor("rand_resnet50-int8", settings)
+
+    # Activation ranges are measured on the calibration images instead of reusing those of the float32 network
+    layer = next(iter(quantized.network_settings.neurons_per_layer))
+    assert not torch.equal(quantized.norm_means_per_layer[layer], model.norm_means_per_layer[layer])
+
+    batch = next(iter(model.get_dataloader(DataSettings(source=str(tmp_path)))))
+    with torch.no_grad():
+        feats, quantized_feats = model.get_features(batch), quantized.get_features(batch)
+    assert feats.keys() == quantized_feats.keys()
+    for layer in feats:
+        relative_error = torch.linalg.norm(quantized_feats[layer] - feats[layer]) / torch.linalg.norm(feats[layer])
+        assert relative_error < 0.1
+
+
+def test_iter_features():
+    import torch
+
+    from vdna.networks import get_feature_extractor
+    from vdna.utils.settings import ExtractionSettings
+
+    settings = ExtractionSettings(device="cpu", pretrained=False)
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 224, 224)
+
+    # Features given layer by layer are those the networks gave as a dict of all layers, computed here as they were
+    model = get_feature_extractor("dino_vit_small", settings)
+    with torch.no_grad():
+        tokens = model.model.prepare_tokens(x)
+        expected = {}
+        for i, block in enumerate(model.model.blocks):
+            tokens = block(tokens)
+            expected["block_" + str(i)] = tokens.permute(0, 2, 1).unsqueeze(3)
+        expected["last_norm"] = model.model.norm(tokens).permute(0, 2, 1).unsqueeze(3)
+        feats = dict(model.iter_features(x))
+    assert list(feats) == list(expected) == list(model.network_settings.neurons_per_layer)
+    assert all(torch.equal(feats[layer], expected[layer]) for layer in expected)
+
+    model = get_feature_extractor("vgg16", settings)
+    with torch.no_grad():
+        out = [x]
+        for i in range(13):
+            out.append(getattr(model.model, "relu_%d" % i)(out[-1]))
+        out = out[1:]
+        feats = dict(model.iter_features(x))
+    assert list(feats) == list(model.network_settings.neurons_per_layer)
+    assert all(torch.equal(feats[layer], expected_feats) for layer, expected_feats in zip(feats, out))
+
+
+def test_exported_backends(tmp_path, monkeypatch):
+    import torch
+
+    from vdna.networks.export import BackendForward, get_exported_path
+    from vdna.utils.settings import ExtractionSettings
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path))
+
+    torch.manual_seed(0)
+    model = ConvFeatExtractor(ExtractionSettings(device="cpu", batch_size=8), with_relu=True).eval()
+    batch = torch.randn(5, 3, 16, 16)
+    with torch.inference_mode():
+        expected = model.get_features(batch)
+        for backend in ["torchscript", "export"]:
+            # Smaller batches are padded to the exported batch size, and later instances reload the cached graph
+            for _ in range(2):
+                feats = BackendForward(model, backend)(batch)
+                assert all(torch.allclose(feats[layer], expected[layer], atol=1e-5) for layer in expected)
+            assert len(list((tmp_path / "exported").glob(f"conv-{backend}-*"))) == 1
+
+    # Graphs of networks calibrated on a directory of images are exported again when the images change
+    calibration_dir = tmp_path / "calibration"
+    calibration_dir.mkdir()
+    (calibration_dir / "0.png").write_bytes(b"0")
+    model.extraction_settings = ExtractionSettings(device="cpu", calibration_source=str(calibration_dir))
+    path = get_exported_path(model, "export", tuple(batch.shape))
+    (calibration_dir / "1.png").write_bytes(b"1")
+    assert get_exported_path(model, "export", tuple(batch.shape)) != path
+
+
+def test_autotune_extraction(tmp_path, monkeypatch):
+    from vdna.networks.autotune import autotune_extraction
+    from vdna.utils.settings import ExtractionSettings
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path))
+
+    extraction_settings = ExtractionSettings(
+        device="cpu", accumulate_spatial_feats_in_hist=True, accumulate_sample_feats_in_hist=True, hist_nb_bins=50
+    )
+    model = ConvFeatExtractor(extraction_settings).eval()
+    result = autotune_extraction(model, memory_budget_mb=1000, batch_sizes=[1, 4, 16])
+    assert not result["cached"] and result["batch_size"] in [1, 4, 16]
+    assert result["peak_mb"] <= 1000 and set(result["stages"]) == {"input", "forward", "statistics"}
+    assert autotune_extraction(model, memory_budget_mb=1000, batch_sizes=[1, 4, 16])["cached"]
+    with pytest.raises(ValueError):
+        autotune_extraction(model, memory_budget_mb=-1, batch_sizes=[1, 4, 16])
+
+
+def test_profile_report(tmp_path):
+    import json
+
+    from vdna.utils.settings import DataSettings, ExtractionSettings
+
+    extraction_settings = ExtractionSettings(
+        device="cpu",
+        batch_size=4,
+        num_workers=0,
+        verbose=False,
+        average_feats_spatially=True,
+        profile=True,
+        profile_trace_path=str(tmp_path / "trace.json"),
+    )
+    model = ConvFeatExtractor(extraction_settings).eval()
+    images = np.random.randint(0, 255, (10, 16, 16, 3), dtype=np.uint8)
+    model.get_data_features(DataSettings(source=images))
+    report = model.last_profile_report
+    assert report["num_images"] == 10 and report["num_batches"] == 3
+    assert {"data_loading", "host_to_device", "forward", "accumulation"} <= set(report["stages"])
+    assert [batch["num_images"] for batch in report["batches"]] == [4, 4, 2]
+    assert set(report["layers"]) == {"conv"}
+    trace = json.load(open(tmp_path / "trace.json"))
+    assert all(event["ph"] == "X" for event in trace["traceEvents"])
+
+
+def test_random_init_extractor_and_benchmarks(tmp_path, monkeypatch):
+    import torch
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("VDNA_OFFLINE", "1")
+
+    from vdna import VDNAProcessor
+    from vdna.benchmarks.suite import run_suite
+    from vdna.networks import get_feature_extractor
+    from vdna.utils.settings import ExtractionSettings
+
+    # Randomly initialised networks are built without any file, and with the same weights every time
+    settings = ExtractionSettings(device="cpu", pretrained=False)
+    model1 = get_feature_extractor("dino_vit_small", settings)
+    model2 = get_feature_extractor("dino_vit_small", settings)
+    for param1, param2 in zip(model1.parameters(), model2.parameters()):
+        assert torch.equal(param1, param2)
+
+    images = np.random.randint(0, 255, (4, 64, 64, 3), dtype=np.uint8)
+    vdna = VDNAProcessor().make_vdna(
+        images, feat_extractor_name="dino_vit_small", device="cpu", pretrained=False, verbose=False, num_workers=0
+    )
+    assert vdna.num_images == 4 and set(vdna.data) == set(model1.network_settings.neurons_per_layer)
+
+    report = run_suite(
+        sections=["histogram", "distances", "io"],
+        hist_shapes=["8,4,4"],
+        distance_feat_extractor="dino_vit_small",
+        batch_size=2,
+        repeats=1,
+    )
+    assert set(report) == {"environment", "histogram", "distances", "io"}
+    assert all(result["file_bytes"] > 0 for result in report["io"])
+
+
+def test_comparison_service(tmp_path, monkeypatch):
+    import asyncio
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("VDNA_OFFLINE", "1")
+
+    from vdna import EMD, VDNAProcessor
+    from vdna.service import VDNAComparisonService
+
+    processor = VDNAProcessor()
+    rng = np.random.default_rng(0)
+    images = list(rng.integers(0, 255, (8, 64, 64, 3), dtype=np.uint8))
+    kwargs = dict(
+        feat_extractor_name="dino_vit_small",
+        distribution_name="histogram-100",
+        device="cpu",
+        pretrained=False,
+        verbose=False,
+        num_workers=0,
+    )
+    references = {
+        "first": processor.make_vdna(images[:4], **kwargs),
+        "second": processor.make_vdna(images[4:], **kwargs),
+    }
+
+    async def post(unix_socket, body):
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+        writer.write(f"POST /compare HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def compare_concurrently():
+        async with VDNAComparisonService(references, batch_size=3, pretrained=False) as service:
+            results = await asyncio.gather(service.compare(images[1:6]), service.compare(images[6:], ["second"]))
+            # Request bodies larger than the limit of the server are refused
+            unix_socket = str(tmp_path / "service.sock")
+            async with await service.serve(unix_socket=unix_socket, max_body_size=1000):
+                response = await post(unix_socket, b"{" + b" " * 2000 + b"}")
+            assert response.startswith(b"HTTP/1.1 413")
+            return results, service.stats
+
+    # Requests are split between batches shared with other requests, without changing their histograms
+    (result1, result2), stats = asyncio.run(compare_concurrently())
+    assert stats["batches"] == 3 and stats["images"] == 7
+    assert set(result2["distances"]) == {"second"}
+    for result, request_images in [(result1, images[1:6]), (result2, images[6:])]:
+        vdna = processor.make_vdna(request_images, **kwargs)
+        for name, distance in result["distances"].items():
+            assert np.isclose(distance, EMD(vdna, references[name]))
+
+
+def test_cli_make_merge_compare(tmp_path, monkeypatch, capsys):
+    import json
+
+    from PIL import Image
+
+    monkeypatch.setenv("VDNA_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("VDNA_OFFLINE", "1")
+
+    from vdna import load_vdna_from_files
+    from vdna.cli import main
+
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        Image.fromarray(rng.integers(0, 255, (48, 48, 3), dtype=np.uint8)).save(image_dir / f"{i}.png")
+
+    def run(*argv):
+        assert main([str(arg) for arg in argv]) == 0
+        return json.loads(capsys.readouterr().out)
+
+    make_args = ["--feat-extractor", "dino_vit_small", "--distribution", "gaussian", "--device", "cpu"]
+    make_args += ["--num-workers", "0", "--batch-size", "2", "--random-init"]
+    run("make", image_dir, tmp_path / "full", *make_args)
+    result = run("make", image_dir, tmp_path / "sharded", *make_args, "--shard-size", "2")
+    assert [shard["status"] for shard in result["shards"]] == ["made"] * 3 and result["num_images"] == 5
+    # Shards already made are skipped when making the VDNA again
+    result = run("make", image_dir, tmp_path / "sharded", *make_args, "--shard-size", "2")
+    assert [shard["status"] for shard in result["shards"]] == ["skipped"] * 3
+
+    # Gaussians merged from shards are those of all images
+    full, sharded = load_vdna_from_files(tmp_path / "full"), load_vdna_from_files(tmp_path / "sharded")
+    for layer in full.data:
+        assert np.allclose(full.data[layer]["mu"], sharded.data[layer]["mu"], atol=1e-5)
+        assert np.allclose(full.data[layer]["var"], sharded.data[layer]["var"], atol=1e-5)
+
+    shards = [shard["path"] for shard in result["shards"]]
+    assert run("merge", *shards[:2], "--output", tmp_path / "merged")["num_images"] == 4
+    layer = next(iter(full.neurons_list))
+    result = run("compare", tmp_path / "full", tmp_path / "merged", "--against", *shards, "--layer", layer)
+    assert result["distance"] == "NFD" and np.array(result["matrix"]).shape == (2, 3)
+    info = run("inspect", tmp_path / "sharded", "--settings")[0]
+    assert info["num_images"] == 5 and info["layers"] == full.neurons_list
+
+    # Every shard of an array of jobs has images when there are at least as many images as shards
+    result = run("make", image_dir, tmp_path / "shard-3", *make_args, "--num-shards", "4", "--shard-index", "3")
+    assert result["num_images"] == 2
+
+    # Shards made from other images are not reused
+    Image.fromarray(rng.integers(0, 255, (48, 48, 3), dtype=np.uint8)).save(image_dir / "5.png")
+    with pytest.raises(ValueError):
+        main([str(arg) for arg in ["make", image_dir, tmp_path / "sharded", *make_args, "--shard-size", "2"]])
+
+
+def test_neuron_selection():
+    import torch
+
+    from vdna import EMD, FD, NFD, NeuronSelection
+    from vdna.benchmarks.suite import make_synthetic_vdna
+
+    for distance_fn, distribution_name in [(EMD, "histogram-100"), (EMD, "quantiles-32"), (NFD, "gaussian")]:
+        vdna1 = make_synthetic_vdna(distribution_name, "vgg16", num_samples=16, seed=0)
+        vdna2 = make_synthetic_vdna(distribution_name, "vgg16", num_samples=16, seed=1)
+        layers = list(vdna1.neurons_list)
+
+        # Selecting all neurons or all neurons of a layer gives the usual distances
+        everything = NeuronSelection.from_layers(layers)
+        assert torch.isclose(distance_fn(vdna1, vdna2, neuron_selection=everything), distance_fn(vdna1, vdna2))
+        assert torch.isclose(
+            distance_fn(vdna1, vdna2, neuron_selection=NeuronSelection.from_layers([layers[2]])),
+            distance_fn(vdna1, vdna2, use_neurons_from_layer=layers[2]),
+        )
+
+        selection = NeuronSelection({layers[0]: {1: 2.0, 3: 1.0}, layers[-1]: [0, 5]})
+        neuron_wise = distance_fn(vdna1, vdna2, return_neuron_wise=True)
+        first, last = neuron_wise[layers[0]], neuron_wise[layers[-1]]
+        expected = (2 * first[1] + first[3] + last[0] + last[5]) / 5
+        assert torch.isclose(distance_fn(vdna1, vdna2, neuron_selection=selection).double(), expected.double())
+        with pytest.raises(ValueError):
+            distance_fn(vdna1, vdna2, neuron_selection=selection, return_neuron_wise=True)
+
+    vdna1 = make_synthetic_vdna("layer-gaussian", "vgg16", num_samples=16, seed=0)
+    vdna2 = make_synthetic_vdna("layer-gaussian", "vgg16", num_samples=16, seed=1)
+    layer = list(vdna1.neurons_list)[0]
+    assert np.isclose(
+        float(FD(vdna1, vdna2, neuron_selection=NeuronSelection.from_layers([layer]))),
+        float(FD(vdna1, vdna2, use_neurons_from_layer=layer)),
+    )
+    with pytest.raises(ValueError):
+        FD(vdna1, vdna2, neuron_selection=NeuronSelection({layer: {0: 1.0, 1: 2.0}}))
+
+
 if __name__ == "__main__":
     distribution_name = "activation-ranges"
     feat_extractor = "mugs_vit_base"
@@ -5,6 +5,32 @@ import numpy as np
 import torch
 
 from vdna import EMD, FD, NFD, VDNA, VDNAProcessor, load_vdna_from_files
+from vdna.networks import FeatureExtractionModel
+from vdna.utils.settings import ExtractionSettings, NetworkSettings
+
+
+class ConvFeatExtractor(FeatureExtractionModel):
+    """Feature extractor with a single convolution, to test processing without building any real network."""
+
+    def __init__(
+        self,
+        extraction_settings: ExtractionSettings = ExtractionSettings(device="cpu"),
+        out_channels: int = 4,
+        kernel_size: int = 3,
+        with_relu: bool = False,
+        expected_size=(16, 16),
+        name: str = "conv",
+    ):
+        super().__init__(NetworkSettings(expected_size=expected_size), extraction_settings)
+        self.conv = torch.nn.Conv2d(3, out_channels, kernel_size)
+        self.with_relu = with_relu
+        self.name = name
+
+    def get_features(self, x):
+        feats = self.conv(x)
+        if self.with_relu:
+            return {"conv": feats, "relu": torch.relu(feats)}
+        return {"conv": feats}
 
 
 def check_same_dist_data(